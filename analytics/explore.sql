@@ -16,3 +16,12 @@ where
     event_name = 'fast_end'
     and extract(month from timestamp_saved) = extract(month from current_date)
 ;
+
+-- fasten individual stats from fasting_sessions
+select
+    chat_id,
+    count(*) as anzahl_fasten,
+    percentile_cont(0.5) within group (order by hours) as median_dauer
+from prod.fasting_sessions
+where ended_at is not null
+group by chat_id;
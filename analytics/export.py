@@ -0,0 +1,245 @@
+"""
+Export new rows of aya_messages and aya_events to zstd-compressed Parquet files partitioned by day,
+so reports read local files instead of querying the production tables.
+Each run streams the rows inserted since the table's watermark with a server-side cursor, and
+moves the new files into place before the watermark is advanced. The watermark is the db's
+inserted_at of the last exported row: timestamp_saved is stamped by the bot, e.g. when a row
+enters the write-behind buffer, and a row can be inserted long after it.
+
+    python export.py --create-schema    # add inserted_at to both tables, once
+    python export.py                    # export both tables to EXPORT_DIR
+    python export.py --tables aya_events
+
+Layout: EXPORT_DIR/<table>/day=YYYY-MM-DD/part-<watermark>-<n>.parquet, plus EXPORT_DIR/<table>/_watermark.
+"""
+import argparse
+import itertools
+import logging
+import os
+import shutil
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from utils import db_conn, db_cursor, get_schema
+
+EXPORT_DIR = os.environ.get("EXPORT_DIR", "export")
+# rows fetched from the server-side cursor and written per file at most
+EXPORT_CHUNK_SIZE = int(os.environ.get("EXPORT_CHUNK_SIZE", 100000))
+# rows inserted less than this many secs ago are left for the next run: a row becomes visible
+# when its transaction commits, which may be after rows inserted later were exported
+EXPORT_LAG_SECS = float(os.environ.get("EXPORT_LAG_SECS", 300))
+# insert time assigned by the db; rows from before the column existed fall back to timestamp_saved
+INSERTED_AT = "coalesce(inserted_at, timestamp_saved)"
+
+TABLES = {
+    "aya_messages": pa.schema(
+        [
+            ("chat_id", pa.int64()),
+            ("telegram_id", pa.int64()),
+            ("update_id", pa.int64()),
+            ("message_text", pa.string()),
+            ("event_name", pa.string()),
+            ("timestamp_received", pa.timestamp("us")),
+            ("timestamp_saved", pa.timestamp("us")),
+        ]
+    ),
+    "aya_events": pa.schema(
+        [
+            ("chat_id", pa.int64()),
+            ("telegram_id", pa.int64()),
+            ("event_name", pa.string()),
+            ("event_value", pa.float64()),
+            ("timestamp_saved", pa.timestamp("us")),
+        ]
+    ),
+}
+
+
+def ensure_schema(tables=tuple(TABLES)):
+    """
+    Add the inserted_at column, filled by the db on insert, and the index the export reads by.
+    Existing rows keep inserted_at null, so the column is added without rewriting the table.
+    """
+    schema = get_schema()
+    with db_cursor() as cur:
+        for table in tables:
+            cur.execute(
+                f"""
+                ALTER TABLE {schema}.{table} ADD COLUMN IF NOT EXISTS inserted_at timestamp;
+                ALTER TABLE {schema}.{table}
+                    ALTER COLUMN inserted_at SET DEFAULT statement_timestamp();
+                CREATE INDEX IF NOT EXISTS {table}_inserted_at_idx
+                    ON {schema}.{table} (({INSERTED_AT}));
+                """
+            )
+
+
+def load_watermark(table, export_dir=EXPORT_DIR):
+    """
+    :return: inserted_at up to which the table was exported, None before the first export
+    :rtype: datetime
+    """
+    try:
+        with open(os.path.join(export_dir, table, "_watermark")) as f:
+            return datetime.fromisoformat(f.read().strip())
+    except FileNotFoundError:
+        return None
+
+
+def save_watermark(table, watermark, export_dir=EXPORT_DIR):
+    path = os.path.join(export_dir, table, "_watermark")
+    # write and rename, so a crash never leaves a half-written watermark behind
+    with open(path + ".tmp", "w") as f:
+        f.write(watermark.isoformat())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def _select(table, schema):
+    columns = ", ".join(schema.names)
+    if table == "aya_events":
+        columns = columns.replace("event_value", "event_value::float8")
+    return f"""
+        select {columns}
+        from {get_schema()}.{table}
+        where {INSERTED_AT} > %s and {INSERTED_AT} <= %s
+        order by {INSERTED_AT};
+        """
+
+
+def _export_until(conn, lag_secs=EXPORT_LAG_SECS):
+    """
+    :return: db time lag_secs ago, the clock inserted_at is set by
+    :rtype: datetime
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            "select (statement_timestamp() - make_interval(secs => %s))::timestamp;",
+            (lag_secs,),
+        )
+        return cur.fetchone()[0]
+
+
+def export_table(
+    table, export_dir=EXPORT_DIR, chunk_size=EXPORT_CHUNK_SIZE, until=None
+):
+    """
+    Export the rows inserted after the watermark and up to `until` (default: EXPORT_LAG_SECS
+    ago, by the db's clock). Files are written to a staging directory first, so readers never
+    see a partial export.
+    If the run dies after moving files but before saving the watermark, the next run starts
+    from the same watermark and replaces the files that run left behind.
+    :return: number of rows exported
+    :rtype: int
+    """
+    schema = TABLES[table]
+    table_dir = os.path.join(export_dir, table)
+    os.makedirs(table_dir, exist_ok=True)
+    watermark = load_watermark(table, export_dir) or datetime(1970, 1, 1)
+    prefix = f"part-{watermark:%Y%m%dT%H%M%S%f}-"
+    staging = os.path.join(table_dir, "_staging")
+    exported = 0
+    file_number = itertools.count()
+    conn = db_conn()
+    try:
+        until = until or _export_until(conn)
+        if until <= watermark:
+            return 0
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        with conn.cursor(name=f"export_{table}") as cur:
+            cur.execute(_select(table, schema), (watermark, until))
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for day, day_rows in itertools.groupby(
+                    rows, key=lambda r: r[-1].date()
+                ):
+                    _write_part(
+                        staging,
+                        schema,
+                        list(day_rows),
+                        f"day={day.isoformat()}",
+                        f"{prefix}{next(file_number)}.parquet",
+                    )
+                exported += len(rows)
+                logging.info(f"exported {exported} rows of {table}")
+    finally:
+        conn.close()
+
+    for partition in os.listdir(table_dir):
+        if partition.startswith("day="):
+            for name in os.listdir(os.path.join(table_dir, partition)):
+                if name.startswith(prefix):
+                    os.remove(os.path.join(table_dir, partition, name))
+    for partition in os.listdir(staging):
+        os.makedirs(os.path.join(table_dir, partition), exist_ok=True)
+        for name in os.listdir(os.path.join(staging, partition)):
+            os.replace(
+                os.path.join(staging, partition, name),
+                os.path.join(table_dir, partition, name),
+            )
+    shutil.rmtree(staging)
+    save_watermark(table, until, export_dir)
+    return exported
+
+
+def _write_part(staging, schema, rows, partition, name):
+    os.makedirs(os.path.join(staging, partition), exist_ok=True)
+    columns = list(zip(*rows))
+    arrow_table = pa.table(
+        [pa.array(values, type=field.type) for values, field in zip(columns, schema)],
+        schema=schema,
+    )
+    pq.write_table(
+        arrow_table, os.path.join(staging, partition, name), compression="zstd"
+    )
+
+
+def read_export(table, export_dir=EXPORT_DIR, since=None, columns=None):
+    """
+    Read exported rows, memory-mapping the files.
+    :param since: only partitions of this day (date) or later
+    :param columns: only these columns
+    :return: batches of rows, oldest day first
+    :rtype: iterator of pyarrow.RecordBatch
+    """
+    table_dir = os.path.join(export_dir, table)
+    if not os.path.isdir(table_dir):
+        return
+    for partition in sorted(os.listdir(table_dir)):
+        if not partition.startswith("day="):
+            continue
+        if since and partition < f"day={since.isoformat()}":
+            continue
+        for name in sorted(os.listdir(os.path.join(table_dir, partition))):
+            parquet_file = pq.ParquetFile(
+                os.path.join(table_dir, partition, name), memory_map=True
+            )
+            yield from parquet_file.iter_batches(columns=columns)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)-8s %(message)s", level=logging.INFO
+    )
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "--tables", nargs="+", choices=list(TABLES), default=list(TABLES)
+    )
+    parser.add_argument("--export-dir", default=EXPORT_DIR)
+    parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE)
+    parser.add_argument(
+        "--create-schema", action="store_true", help="add inserted_at, then exit"
+    )
+    args = parser.parse_args()
+    if args.create_schema:
+        ensure_schema(args.tables)
+        parser.exit()
+    for table in args.tables:
+        rows = export_table(table, args.export_dir, args.chunk_size)
+        logging.info(f"{table}: exported {rows} rows to {args.export_dir}")
@@ -1,8 +1,276 @@
 """
-Get total hours fasted for group
+Get fasting stats for the group and per user over a rolling window of days.
+fast_end events (event_value = hours fasted) are streamed from SCHEMA.aya_events with a
+server-side cursor and folded chunk by chunk into fixed-size NumPy arrays, so memory is
+bounded by the number of users, not the number of events.
+
+    python get_overview.py --days 30
+    python get_overview.py --days 30 --users
+    python get_overview.py --days 30 --export-dir export   # read the files of export.py
+    python get_overview.py benchmark --rows 20000000
 """
+import argparse
+import json
+import logging
+import os
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+import numpy as np
+
+from utils import db_conn, get_schema
+
+# rows fetched from the server-side cursor at once
+CHUNK_SIZE = int(os.environ.get("ANALYTICS_CHUNK_SIZE", 500000))
+# resolution and range of the hour histograms the percentiles are read from,
+# longer fasts are counted in the last bin
+HOURS_PER_BIN = 0.5
+MAX_HOURS = 72
+PERCENTILES = (50, 90, 99)
+# per-user percentiles are computed for this many users at a time, to bound temporary arrays
+USERS_PER_BLOCK = 10000
+
+
+def _grow(array, capacity):
+    """
+    :return: array with `capacity` rows, the existing rows copied over and the rest zero
+    """
+    grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+    grown[: len(array)] = array
+    return grown
+
+
+class FastingStats:
+    """
+    Per-user fasts, hours, hour histogram and a day bitmap of the window.
+    Users get a row on first sight, rows grow by doubling.
+    Memory is about (bins * 4 + days) bytes per user.
+    """
 
-from utils import db_conn
+    def __init__(self, days, hours_per_bin=HOURS_PER_BIN, max_hours=MAX_HOURS):
+        self.days = days
+        self.hours_per_bin = hours_per_bin
+        self.bins = int(np.ceil(max_hours / hours_per_bin)) + 1
+        self.telegram_ids = np.empty(0, dtype=np.int64)
+        self._sorted_ids = np.empty(0, dtype=np.int64)
+        self._sorted_rows = np.empty(0, dtype=np.int64)
+        self.fasts = np.zeros(0, dtype=np.int64)
+        self.hours = np.zeros(0, dtype=np.float64)
+        self.histogram = np.zeros((0, self.bins), dtype=np.int32)
+        self.fasted_on = np.zeros((0, days), dtype=np.bool_)
+        self._allocate(1024)
+
+    def _allocate(self, capacity):
+        self.fasts = _grow(self.fasts, capacity)
+        self.hours = _grow(self.hours, capacity)
+        self.histogram = _grow(self.histogram, capacity)
+        self.fasted_on = _grow(self.fasted_on, capacity)
+
+    @property
+    def users(self):
+        return len(self.telegram_ids)
+
+    def _rows(self, telegram_ids):
+        """
+        :return: row of each telegram_id, new users are added
+        """
+        unique_ids = np.unique(telegram_ids)
+        positions = np.searchsorted(self._sorted_ids, unique_ids)
+        known = positions < len(self._sorted_ids)
+        known[known] = self._sorted_ids[positions[known]] == unique_ids[known]
+        new_ids = unique_ids[~known]
+        if len(new_ids):
+            new_rows = np.arange(self.users, self.users + len(new_ids))
+            self.telegram_ids = np.concatenate([self.telegram_ids, new_ids])
+            if self.users > len(self.fasts):
+                self._allocate(max(self.users, 2 * len(self.fasts)))
+            ids = np.concatenate([self._sorted_ids, new_ids])
+            rows = np.concatenate([self._sorted_rows, new_rows])
+            order = np.argsort(ids, kind="stable")
+            self._sorted_ids, self._sorted_rows = ids[order], rows[order]
+        return self._sorted_rows[np.searchsorted(self._sorted_ids, telegram_ids)]
+
+    def add(self, telegram_ids, hours, days):
+        """
+        :param telegram_ids: int array
+        :param hours: float array of hours fasted
+        :param days: int array, day of the window the fast ended on (0 = first day)
+        """
+        rows = self._rows(telegram_ids)
+        n = self.users
+        self.fasts[:n] += np.bincount(rows, minlength=n)
+        self.hours[:n] += np.bincount(rows, weights=hours, minlength=n)
+        bins = np.clip((hours / self.hours_per_bin).astype(np.int64), 0, self.bins - 1)
+        cells, counts = np.unique(rows * self.bins + bins, return_counts=True)
+        self.histogram.reshape(-1)[cells] += counts.astype(np.int32)
+        self.fasted_on[rows, days] = True
+
+    def _percentiles(self, histogram):
+        """
+        :param histogram: (n, bins) counts
+        :return: (n, len(PERCENTILES)) hours, interpolated within the bin
+        """
+        cumulative = np.cumsum(histogram, axis=1, dtype=histogram.dtype)
+        total = cumulative[:, -1:]
+        result = np.zeros((len(histogram), len(PERCENTILES)))
+        for i, percentile in enumerate(PERCENTILES):
+            target = total * percentile / 100
+            bin_index = (cumulative < target).sum(axis=1)
+            bin_index = np.minimum(bin_index, self.bins - 1)
+            rows = np.arange(len(histogram))
+            below = np.where(bin_index > 0, cumulative[rows, bin_index - 1], 0)
+            in_bin = np.maximum(histogram[rows, bin_index], 1)
+            fraction = (target[:, 0] - below) / in_bin
+            result[:, i] = (bin_index + fraction) * self.hours_per_bin
+        result[total[:, 0] == 0] = np.nan
+        return result
+
+    def _streaks(self):
+        """
+        :return: longest streak and current streak (ending on the last day) in days, per user
+        """
+        n = self.users
+        width = self.days + 2
+        padded = np.zeros((n, width), dtype=np.int8)
+        padded[:, 1:-1] = self.fasted_on[:n]
+        change = np.diff(padded.ravel())
+        starts = np.flatnonzero(change == 1) + 1
+        ends = np.flatnonzero(change == -1) + 1
+        lengths = ends - starts
+        rows = starts // width
+        longest = np.zeros(n, dtype=np.int64)
+        np.maximum.at(longest, rows, lengths)
+        current = np.zeros(n, dtype=np.int64)
+        ending_today = ends % width == width - 1
+        current[rows[ending_today]] = lengths[ending_today]
+        return longest, current
+
+    def per_user(self):
+        """
+        :return: column name -> array, one entry per user
+        :rtype: dict
+        """
+        n = self.users
+        longest, current = self._streaks()
+        percentiles = np.concatenate(
+            [np.zeros((0, len(PERCENTILES)))]
+            + [
+                self._percentiles(
+                    self.histogram[start : min(start + USERS_PER_BLOCK, n)]
+                )
+                for start in range(0, n, USERS_PER_BLOCK)
+            ]
+        )
+        stats = {
+            "telegram_id": self.telegram_ids,
+            "fasts": self.fasts[:n],
+            "total_hours": self.hours[:n],
+            "avg_hours": self.hours[:n] / np.maximum(self.fasts[:n], 1),
+            "longest_streak": longest,
+            "current_streak": current,
+        }
+        for i, percentile in enumerate(PERCENTILES):
+            stats[f"p{percentile}_hours"] = percentiles[:, i]
+        return stats
+
+    def group(self):
+        """
+        :return: totals, average and percentiles over all users
+        :rtype: dict
+        """
+        n = self.users
+        fasts = int(self.fasts[:n].sum())
+        total_hours = float(self.hours[:n].sum())
+        percentiles = self._percentiles(
+            self.histogram[:n].sum(axis=0, dtype=np.int64)[np.newaxis]
+        )[0]
+        longest, current = self._streaks()
+        stats = {
+            "days": self.days,
+            "users": n,
+            "fasts": fasts,
+            "total_hours": round(total_hours, 2),
+            "avg_hours": round(total_hours / fasts, 2) if fasts else None,
+            "users_on_streak": int((current > 0).sum()),
+            "longest_streak": int(longest.max()) if n else 0,
+        }
+        for percentile, hours in zip(PERCENTILES, percentiles):
+            stats[f"p{percentile}_hours"] = None if np.isnan(hours) else round(hours, 2)
+        return stats
+
+
+def iter_fast_ends(days, chunk_size=CHUNK_SIZE, today=None):
+    """
+    Stream the fast_end events of the last `days` days.
+    :return: chunks of (telegram_ids, hours, day of window)
+    :rtype: iterator of (np.ndarray, np.ndarray, np.ndarray)
+    """
+    first_day = (today or date.today()) - timedelta(days=days - 1)
+    conn = db_conn()
+    try:
+        with conn.cursor(name="fasting_overview") as cur:
+            cur.execute(
+                f"""
+                select
+                    telegram_id,
+                    event_value::float8,
+                    timestamp_saved::date - %s::date
+                from {get_schema()}.aya_events
+                where
+                    event_name = 'fast_end'
+                    and event_value is not null
+                    and timestamp_saved >= %s
+                    and timestamp_saved < %s;
+                """,
+                (first_day, first_day, first_day + timedelta(days=days)),
+            )
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                chunk = np.array(rows, dtype=np.float64)
+                yield (
+                    chunk[:, 0].astype(np.int64),
+                    chunk[:, 1],
+                    chunk[:, 2].astype(np.int64),
+                )
+    finally:
+        conn.close()
+
+
+def iter_exported_fast_ends(days, export_dir, today=None):
+    """
+    Same as iter_fast_ends, read from the Parquet files written by export.py instead of the db.
+    """
+    from export import read_export
+
+    first_day = np.datetime64((today or date.today()) - timedelta(days=days - 1), "D")
+    columns = ["telegram_id", "event_name", "event_value", "timestamp_saved"]
+    for batch in read_export("aya_events", export_dir, first_day.item(), columns):
+        telegram_ids, event_names, hours, saved = (
+            batch.column(name).to_numpy(zero_copy_only=False) for name in columns
+        )
+        day = (saved.astype("datetime64[D]") - first_day).astype(np.int64)
+        keep = (
+            (event_names == "fast_end") & ~np.isnan(hours) & (day >= 0) & (day < days)
+        )
+        yield telegram_ids[keep], hours[keep], day[keep]
+
+
+def load_fasting_stats(days, chunk_size=CHUNK_SIZE, export_dir=None):
+    """
+    :param export_dir: read the files of export.py in this directory instead of the db
+    :rtype: FastingStats
+    """
+    stats = FastingStats(days)
+    if export_dir:
+        chunks = iter_exported_fast_ends(days, export_dir)
+    else:
+        chunks = iter_fast_ends(days, chunk_size)
+    for telegram_ids, hours, day in chunks:
+        stats.add(telegram_ids, hours, day)
+    return stats
 
 
 def load_fasting_hours(OBSERVATION_PERIOD_IN_DAYS):
@@ -11,21 +279,74 @@ def load_fasting_hours(OBSERVATION_PERIOD_IN_DAYS):
     :return: total hours fasted
     :rtype: float
     """
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                f"""
-                select
-                    u.telegram_id, u.name
-                from {os.environ.get('DB_PROD_LEVEL')}.users u
-                join (
-                        select telegram_id, max(status_timestamp) as max_timestamp
-                        from {os.environ.get('DB_PROD_LEVEL')}.users group by telegram_id
-                    ) s
-                on
-                    u.telegram_id = s.telegram_id
-                    and u.status_timestamp = s.max_timestamp
-                ;"""
+    return load_fasting_stats(OBSERVATION_PERIOD_IN_DAYS).group()["total_hours"]
+
+
+def benchmark(rows, users, days, chunk_size=CHUNK_SIZE, seed=0):
+    """
+    Fold `rows` synthetic events into FastingStats, chunk by chunk as they would come from the db.
+    :return: rows/s and peak memory
+    :rtype: dict
+    """
+    rng = np.random.default_rng(seed)
+    stats = FastingStats(days)
+    tracemalloc.start()
+    started = time.perf_counter()
+    for offset in range(0, rows, chunk_size):
+        n = min(chunk_size, rows - offset)
+        stats.add(
+            rng.integers(0, users, n) + 10**8,
+            rng.gamma(8, 2, n),
+            rng.integers(0, days, n),
+        )
+    stats.group()
+    stats.per_user()
+    secs = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "rows": rows,
+        "users": users,
+        "days": days,
+        "chunk_size": chunk_size,
+        "secs": round(secs, 2),
+        "rows_per_sec": round(rows / secs),
+        "peak_mb": round(peak / 2**20, 1),
+    }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)-8s %(message)s", level=logging.INFO
+    )
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "command", nargs="?", choices=["stats", "benchmark"], default="stats"
+    )
+    parser.add_argument("--days", type=int, default=30, help="rolling window in days")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--users", action="store_true", help="print per-user stats")
+    parser.add_argument(
+        "--export-dir", help="read the files written by export.py instead of the db"
+    )
+    parser.add_argument("--rows", type=int, default=20000000, help="benchmark rows")
+    parser.add_argument("--benchmark-users", type=int, default=100000)
+    args = parser.parse_args()
+
+    if args.command == "benchmark":
+        print(
+            json.dumps(
+                benchmark(args.rows, args.benchmark_users, args.days, args.chunk_size)
             )
-            df_users = cur.fetchall()
-    return {row[0]: row[1] for row in df_users}
+        )
+    else:
+        stats = load_fasting_stats(args.days, args.chunk_size, args.export_dir)
+        print(json.dumps(stats.group()))
+        if args.users:
+            per_user = stats.per_user()
+            for i in range(stats.users):
+                print(
+                    json.dumps(
+                        {name: values[i].item() for name, values in per_user.items()}
+                    )
+                )
@@ -0,0 +1,140 @@
+"""
+Local stand-in for the Telegram Bot API: serves scripted getUpdates batches and records sendMessage calls.
+"""
+import json
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# how long an empty getUpdates is held open, instead of the real long polling timeout
+EMPTY_POLL_SECS = 0.05
+
+
+class FakeTelegramApi:
+    """
+    Serves `updates` in getUpdates batches of at most `limit` and records every reply.
+    Every update is expected to get exactly one reply. Reply latency is measured from the moment an update was handed out by getUpdates
+    to the sendMessage for the same chat (replies of one chat are matched in order).
+    """
+
+    def __init__(self, updates=()):
+        self._lock = threading.Lock()
+        self._message_id = 0
+        self.script(updates)
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._server.api = self
+
+    def script(self, updates):
+        """
+        Serve a new set of updates and reset all counters.
+        update_ids must be higher than the ones served before.
+        """
+        with self._lock:
+            self._updates = sorted(updates, key=lambda update: update["update_id"])
+            self._next = 0
+            self._pending = defaultdict(deque)  # chat_id -> [(update_id, served_at)]
+            self.calls = Counter()
+            self.latencies = []
+            self.replied = threading.Event()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}/botTOKEN/"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def get_updates(self, offset, limit):
+        with self._lock:
+            self.calls["getUpdates"] += 1
+            if offset:
+                while (
+                    self._next < len(self._updates)
+                    and self._updates[self._next]["update_id"] < offset
+                ):
+                    self._next += 1
+            batch = self._updates[self._next : self._next + limit]
+            now = time.perf_counter()
+            for update in batch:
+                chat_id = _chat_id(update)
+                if not any(
+                    update_id == update["update_id"]
+                    for update_id, _ in self._pending[chat_id]
+                ):
+                    self._pending[chat_id].append((update["update_id"], now))
+        if not batch:
+            time.sleep(EMPTY_POLL_SECS)
+        return {"ok": True, "result": batch}
+
+    def send_message(self, body):
+        with self._lock:
+            self.calls["sendMessage"] += 1
+            self._message_id += 1
+            chat_id = body["chat_id"]
+            if self._pending[chat_id]:
+                _, served_at = self._pending[chat_id].popleft()
+                self.latencies.append(time.perf_counter() - served_at)
+            if len(self.latencies) == len(self._updates):
+                self.replied.set()
+            return {
+                "ok": True,
+                "result": {
+                    "message_id": self._message_id,
+                    "from": {"id": 987654321, "is_bot": True, "first_name": "TEST_BOT"},
+                    "chat": {"id": chat_id, "type": "private"},
+                    "date": int(time.time()),
+                    "text": body["text"],
+                },
+            }
+
+    def answer(self, method):
+        with self._lock:
+            self.calls[method] += 1
+        return {"ok": True, "result": True}
+
+
+def _chat_id(update):
+    if "callback_query" in update:
+        return update["callback_query"]["message"]["chat"]["id"]
+    return update["message"]["chat"]["id"]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        method = url.path.rsplit("/", 1)[-1]
+        if method == "getUpdates":
+            js = self.server.api.get_updates(
+                int(params.get("offset", 0)), int(params.get("limit", 100))
+            )
+        else:
+            js = self.server.api.answer(method)
+        self._respond(js)
+
+    def do_POST(self):
+        method = urlparse(self.path).path.rsplit("/", 1)[-1]
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        if method == "sendMessage":
+            js = self.server.api.send_message(body)
+        else:
+            js = self.server.api.answer(method)
+        self._respond(js)
+
+    def _respond(self, js):
+        content = json.dumps(js).encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
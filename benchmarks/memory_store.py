@@ -0,0 +1,114 @@
+"""
+In-memory stand-in for the db helpers in utils, counting calls per helper.
+"""
+import contextlib
+from collections import Counter
+
+import psycopg2.errors
+
+import user_directory
+import utils
+
+
+class MemoryStore:
+    """
+    Keeps users, messages, events and fasting sessions in lists/dicts.
+    install() replaces the db helpers of utils, so it must run before
+    telegram_sender/telegram_listener import them.
+    """
+
+    def __init__(self):
+        self.users = {}  # name -> telegram_id
+        self.messages = []
+        self.update_ids = set()
+        self.events = []
+        self.open_fasts = {}
+        self.sessions = []
+        self.calls = Counter()
+
+    def install(self):
+        for name in [
+            "load_user_name",
+            "load_user_names",
+            "load_user_id_by_name",
+            "write_user_to_db",
+            "write_msg_to_db",
+            "write_event_to_db",
+            "_load_time_at_fasting_start",
+            "start_fasting_session",
+            "end_fasting_session",
+            "load_open_fasting_sessions",
+            "check_message_dedup",
+        ]:
+            setattr(utils, name, self._counted(name, getattr(self, name)))
+        # there is no db to LISTEN on or to open a transaction in
+        user_directory.start_listener = lambda: None
+        utils.update_transaction = contextlib.nullcontext
+        return self
+
+    def _counted(self, name, func):
+        def counted(*args, **kwargs):
+            self.calls[name] += 1
+            return func(*args, **kwargs)
+
+        return counted
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def load_user_name(self, telegram_id):
+        for name, owner in self.users.items():
+            if owner == telegram_id:
+                return name
+        return None
+
+    def load_user_names(self, telegram_ids):
+        return {t: n for n, t in self.users.items() if t in telegram_ids}
+
+    def load_user_id_by_name(self, name):
+        return self.users.get(name)
+
+    def write_user_to_db(self, telegram_id, name):
+        if self.users.get(name, telegram_id) != telegram_id:
+            raise psycopg2.errors.UniqueViolation()
+        self.users = {n: t for n, t in self.users.items() if t != telegram_id}
+        self.users[name] = telegram_id
+
+    def write_msg_to_db(
+        self,
+        chat_id,
+        telegram_id,
+        message_text,
+        timestamp_received,
+        update_id=None,
+        event_name=None,
+    ):
+        if update_id is not None and update_id in self.update_ids:
+            return False
+        self.update_ids.add(update_id)
+        self.messages.append(
+            (chat_id, telegram_id, update_id, message_text, event_name)
+        )
+        return True
+
+    def write_event_to_db(self, telegram_id, event_name, event_value=None):
+        self.events.append((telegram_id, event_name, event_value))
+
+    def _load_time_at_fasting_start(self, telegram_id):
+        return self.open_fasts.get(telegram_id), False
+
+    def start_fasting_session(self, telegram_id, started_at):
+        self.open_fasts.setdefault(telegram_id, started_at)
+        utils.set_fasting_state(telegram_id, started_at)
+
+    def end_fasting_session(self, telegram_id, ended_at, hours):
+        started_at = self.open_fasts.pop(telegram_id, None)
+        self.sessions.append((telegram_id, started_at, ended_at, hours))
+        utils.set_fasting_state(telegram_id, None)
+
+    def load_open_fasting_sessions(self, limit=None):
+        return sorted(self.open_fasts.items(), key=lambda row: row[1])[:limit]
+
+    def check_message_dedup(self):
+        return True
@@ -0,0 +1,158 @@
+"""
+End-to-end throughput benchmark of open_connection_to_telegram_chatbot
+against a local fake Telegram api and an in-memory (or real) store.
+
+For every command of find_response, scripted updates are served in getUpdates batches and
+the run ends once every update got its reply. Reports throughput, p50/p95/p99 reply latency and
+db/http calls per update, and writes the results as json for tracking regressions:
+
+    PYTHONPATH=src python benchmarks/run_benchmark.py --updates 1000 --chats 100 --output bench.json
+
+--store postgres uses the db configured in DB/DB_PROD_LEVEL instead of the in-memory store
+and counts pooled connection checkouts as db calls.
+"""
+import argparse
+import json
+import logging
+import platform
+import sys
+import threading
+import time
+from datetime import datetime
+
+import utils
+from fake_telegram_api import FakeTelegramApi
+from memory_store import MemoryStore
+from offset_store import NoOffsetStore
+
+# name of scenario -> message text sent by every chat
+COMMANDS = {
+    "start": "/start",
+    "name": "/name user{chat_id}",
+    "fasten": "/fasten",
+    "ende": "/ende",
+    "rezepte": "/rezepte",
+    "cheat_meal": "/cheat_meal",
+    "default_fallback": "hi there",
+}
+FIRST_CHAT_ID = 100000000
+
+
+def build_updates(command, updates, chats, first_update_id):
+    """
+    :return: `updates` text message updates, spread round-robin over `chats` chats
+    """
+    return [
+        {
+            "update_id": first_update_id + i,
+            "message": {
+                "message_id": i,
+                "from": {"id": FIRST_CHAT_ID + i % chats, "is_bot": False},
+                "chat": {"id": FIRST_CHAT_ID + i % chats, "type": "private"},
+                "date": int(time.time()),
+                "text": COMMANDS[command].format(chat_id=FIRST_CHAT_ID + i % chats),
+            },
+        }
+        for i in range(updates)
+    ]
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of unsorted values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+
+def run_scenario(api, command, updates, chats, first_update_id, timeout, db_calls):
+    api.script(build_updates(command, updates, chats, first_update_id))
+    db_calls_before = db_calls()
+    started = time.perf_counter()
+    finished = api.replied.wait(timeout)
+    elapsed = time.perf_counter() - started
+    latencies_ms = [latency * 1000 for latency in api.latencies]
+    return {
+        "command": command,
+        "updates": updates,
+        "replies": len(api.latencies),
+        "completed": finished,
+        "elapsed_secs": round(elapsed, 4),
+        "updates_per_sec": round(len(api.latencies) / elapsed, 2),
+        "latency_ms": {
+            f"p{p}": round(percentile(latencies_ms, p), 3) for p in (50, 95, 99)
+        }
+        if latencies_ms
+        else None,
+        "db_calls_per_update": round((db_calls() - db_calls_before) / updates, 3),
+        "http_calls_per_update": round(sum(api.calls.values()) / updates, 3),
+        "http_calls": dict(api.calls),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--updates", type=int, default=1000)
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--commands", default=",".join(COMMANDS))
+    parser.add_argument("--store", choices=["memory", "postgres"], default="memory")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument(
+        "--output", default="benchmark_results.json", help="json results file"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.store == "memory":
+        store = MemoryStore().install()
+        db_calls = lambda: store.total_calls
+    else:
+        db_calls = lambda: utils.get_pool().stats["checkouts"]
+
+    import run_telegram
+    import telegram_client
+
+    api = FakeTelegramApi().start()
+    telegram_client._CLIENT = telegram_client.TelegramClient(base_url=api.base_url)
+    run_telegram.start_shared_services()
+    # no snapshot, so the fake users aren't saved where the bot would load them from
+    run_telegram.start_bot_services(snapshot_file="")
+    # one loop for all scenarios. Each scenario gets a higher update_id range,
+    # so the loop's offset never skips updates of the next scenario.
+    threading.Thread(
+        target=run_telegram.open_connection_to_telegram_chatbot,
+        kwargs={"offset_store": NoOffsetStore()},
+        daemon=True,
+    ).start()
+    results = []
+    for i, command in enumerate(args.commands.split(",")):
+        result = run_scenario(
+            api,
+            command,
+            args.updates,
+            args.chats,
+            first_update_id=(i + 1) * 10**8,
+            timeout=args.timeout,
+            db_calls=db_calls,
+        )
+        results.append(result)
+        print(
+            f"\n{command:>16}: {result['updates_per_sec']:>9} updates/s, "
+            f"latency {result['latency_ms']}, "
+            f"{result['db_calls_per_update']} db / {result['http_calls_per_update']} http calls per update",
+            file=sys.stderr,
+        )
+
+    report = {
+        "timestamp": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "store": args.store,
+        "chats": args.chats,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+The bot an update belongs to, when one process hosts several bots (see run_multibot.py).
+Code that depends on the bot (the Telegram token, the db schema, cache keys, metric labels)
+reads it from a context variable instead of the environment, so the same handlers serve
+every bot. Outside of a bot's context, TELEGRAM_TOKEN and DB_PROD_LEVEL are used as before.
+
+BOTS lists the hosted bots as comma separated name:schema:token triples, e.g.
+    BOTS=aya:prod:123:ABC,aya_test:test:456:DEF
+"""
+import contextvars
+import os
+import threading
+from contextlib import contextmanager
+
+BOTS = os.environ.get("BOTS", "")
+
+
+class Bot:
+    """
+    :param name: used in offset files, thread names and the `bot` label of metrics
+    :param schema: db schema of the bot's tables
+    :param token: Telegram bot token
+    """
+
+    __slots__ = ("name", "schema", "token")
+
+    def __init__(self, name, schema, token):
+        self.name = name
+        self.schema = schema
+        self.token = token
+
+    @property
+    def url(self):
+        return f"https://api.telegram.org/bot{self.token}/"
+
+    def __repr__(self):
+        return f"Bot({self.name!r}, schema={self.schema!r})"
+
+
+_CURRENT = contextvars.ContextVar("bot", default=None)
+
+
+def parse_bots(spec=BOTS):
+    """
+    :param spec: comma separated name:schema:token, see BOTS
+    :rtype: list of Bot
+    """
+    bots = []
+    for entry in spec.split(","):
+        if not entry.strip():
+            continue
+        name, schema, token = entry.strip().split(":", 2)
+        bots.append(Bot(name, schema, token))
+    if len({bot.name for bot in bots}) != len(bots):
+        raise ValueError(f"bot names in BOTS must be unique: {spec}")
+    return bots
+
+
+def current_bot():
+    """
+    :return: the bot of the current context, None outside of one
+    :rtype: Bot
+    """
+    return _CURRENT.get()
+
+
+def current_bot_name():
+    """
+    :return: name of the current bot, "" outside of a bot's context
+    """
+    bot = _CURRENT.get()
+    return bot.name if bot else ""
+
+
+def get_schema():
+    """
+    :return: db schema of the current bot, DB_PROD_LEVEL outside of a bot's context
+    """
+    bot = _CURRENT.get()
+    return bot.schema if bot else os.environ.get("DB_PROD_LEVEL")
+
+
+@contextmanager
+def bot_context(bot):
+    """
+    Run the block as `bot`.
+    """
+    token = _CURRENT.set(bot)
+    try:
+        yield bot
+    finally:
+        _CURRENT.reset(token)
+
+
+def start_thread(target, name, args=()):
+    """
+    Start a daemon thread that runs `target` in a copy of the current context, so it keeps
+    working for the bot that started it (new threads start with an empty context).
+    :rtype: threading.Thread
+    """
+    context = contextvars.copy_context()
+    thread = threading.Thread(
+        target=context.run, args=(target, *args), name=name, daemon=True
+    )
+    thread.start()
+    return thread
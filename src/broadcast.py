@@ -0,0 +1,419 @@
+"""
+Broadcast a message to every user in SCHEMA.users, e.g. to announce a group fasting challenge.
+Recipients are streamed with a server-side cursor and sent through a SendDispatcher of their own,
+concurrently and within BROADCAST_RATE. Telegram's limit is per bot token, so while a job runs
+the bot's send queue (SEND_QUEUE=1) lowers its own rate by BROADCAST_RATE, see BroadcastWatch:
+the job sends a heartbeat to broadcast_jobs, which the bot polls. Every recipient is claimed in
+SCHEMA.broadcast_recipients before the message is queued, so a job that crashed resumes
+with the users it hasn't reached and nobody gets the message twice.
+Results and the outgoing aya_messages rows are written in batches.
+
+    python broadcast.py schema
+    python broadcast.py create "Am Montag startet unsere Fasten-Challenge!"
+    python broadcast.py run JOB_ID
+    python broadcast.py status JOB_ID
+"""
+import argparse
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from functools import partial
+
+from psycopg2.errors import UndefinedTable
+from psycopg2.extras import execute_values
+
+from bots import current_bot_name, start_thread
+from send_dispatcher import SendDispatcher, get_dispatcher
+from telegram_sender import _extract_response
+from utils import (
+    db_conn,
+    db_cursor,
+    get_schema,
+    update_transaction,
+    SEND_RATE_GLOBAL,
+    SEND_RATE_PER_CHAT,
+    BROADCAST_RATE,
+    BROADCAST_WORKERS,
+    BROADCAST_BATCH_SIZE,
+    BROADCAST_MAX_PENDING,
+    BROADCAST_REPORT_SECS,
+)
+from write_buffer import _write_rows
+
+EVENT_NAME = "broadcast"
+# a job without a heartbeat for this long counts as crashed
+HEARTBEAT_TIMEOUT_SECS = 3 * BROADCAST_REPORT_SECS
+
+
+def ensure_schema():
+    """
+    Create broadcast_jobs and broadcast_recipients if they don't exist yet.
+    """
+    schema = get_schema()
+    with db_cursor() as cur:
+        cur.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {schema}.broadcast_jobs (
+                job_id bigserial PRIMARY KEY,
+                message_text text NOT NULL,
+                created_at timestamp NOT NULL,
+                finished_at timestamp,
+                heartbeat_at timestamp
+            );
+            ALTER TABLE {schema}.broadcast_jobs ADD COLUMN IF NOT EXISTS heartbeat_at timestamp;
+            CREATE TABLE IF NOT EXISTS {schema}.broadcast_recipients (
+                job_id bigint NOT NULL REFERENCES {schema}.broadcast_jobs,
+                telegram_id bigint NOT NULL,
+                status text NOT NULL,
+                sent_at timestamp,
+                PRIMARY KEY (job_id, telegram_id)
+            );
+            """
+        )
+
+
+def create_job(message_text):
+    """
+    :return: job_id
+    :rtype: int
+    """
+    with db_cursor() as cur:
+        cur.execute(
+            f"""
+            INSERT INTO {get_schema()}.broadcast_jobs (message_text, created_at)
+            VALUES (%s, %s) RETURNING job_id;
+            """,
+            (message_text, datetime.now()),
+        )
+        return cur.fetchone()[0]
+
+
+def job_status(job_id):
+    """
+    :return: number of recipients per status ("sending" = queued when a run stopped, outcome unknown)
+    :rtype: dict
+    """
+    with db_cursor() as cur:
+        cur.execute(
+            f"""
+            select status, count(*) from {get_schema()}.broadcast_recipients
+            where job_id = %s group by status;
+            """,
+            (job_id,),
+        )
+        return dict(cur.fetchall())
+
+
+def running_jobs():
+    """
+    :return: number of unfinished jobs whose run sent a heartbeat in the last HEARTBEAT_TIMEOUT_SECS
+    :rtype: int
+    """
+    with db_cursor() as cur:
+        cur.execute(
+            f"""
+            select count(*) from {get_schema()}.broadcast_jobs
+            where finished_at is null
+            and heartbeat_at > localtimestamp - %s * interval '1 second';
+            """,
+            (HEARTBEAT_TIMEOUT_SECS,),
+        )
+        return cur.fetchone()[0]
+
+
+def format_progress(done, remaining, elapsed):
+    """
+    :return: throughput and ETA of a job, e.g. "12.5 msgs/s, eta 0:01:20"
+    :rtype: str
+    """
+    rate = done / elapsed if elapsed > 0 else 0
+    if not rate:
+        return "0.0 msgs/s, eta unknown"
+    return f"{rate:.1f} msgs/s, eta {timedelta(seconds=round(remaining / rate))}"
+
+
+class BroadcastJob:
+    """
+    One run of a job. At most `max_pending` messages are queued at once, so memory stays
+    bounded however many users there are.
+    """
+
+    def __init__(
+        self,
+        job_id,
+        dispatcher=None,
+        batch_size=BROADCAST_BATCH_SIZE,
+        max_pending=BROADCAST_MAX_PENDING,
+        report_secs=BROADCAST_REPORT_SECS,
+    ):
+        self.job_id = job_id
+        self._dispatcher = dispatcher or SendDispatcher(
+            global_rate=BROADCAST_RATE,
+            global_burst=BROADCAST_RATE,
+            workers=BROADCAST_WORKERS,
+        )
+        self._batch_size = batch_size
+        self._max_pending = max_pending
+        self._report_secs = report_secs
+        self._schema = get_schema()
+        self._condition = threading.Condition()
+        self._pending = 0
+        self._results = []  # (telegram_id, status, sent_at)
+        self._messages = []  # aya_messages rows of sent messages
+        self._flush_lock = threading.Lock()
+        self.stats = {"sent": 0, "failed": 0, "remaining": 0}
+
+    def run(self):
+        """
+        Send the message to every user of SCHEMA.users that wasn't claimed by an earlier run.
+        :return: stats
+        :rtype: dict
+        """
+        message_text = self._load_text()
+        self.stats["remaining"] = self._count_remaining()
+        logging.info(f"job {self.job_id}: {self.stats['remaining']} recipients left")
+        # lets the bot slow down before the first message goes out
+        self._heartbeat()
+        self._dispatcher.start()
+        self._started = time.monotonic()
+        self._reported = self._started
+        conn = db_conn()
+        try:
+            with conn.cursor(name=f"broadcast_{self.job_id}") as cur:
+                cur.execute(
+                    f"""
+                    select distinct telegram_id from {self._schema}.users u
+                    where not exists (
+                        select 1 from {self._schema}.broadcast_recipients r
+                        where r.job_id = %s and r.telegram_id = u.telegram_id
+                    )
+                    order by telegram_id;
+                    """,
+                    (self.job_id,),
+                )
+                while True:
+                    telegram_ids = [row[0] for row in cur.fetchmany(self._batch_size)]
+                    if not telegram_ids:
+                        break
+                    self._claim(telegram_ids)
+                    for telegram_id in telegram_ids:
+                        self._wait_for_capacity(self._max_pending - 1)
+                        self._submit(telegram_id, message_text)
+                    if time.monotonic() - self._reported >= self._report_secs:
+                        self._report()
+        finally:
+            conn.close()
+        self._wait_for_capacity(0)
+        self._dispatcher.stop(timeout=0)
+        self._flush()
+        self._report()
+        self._finish()
+        return self.stats
+
+    def _load_text(self):
+        with db_cursor() as cur:
+            cur.execute(
+                f"select message_text from {self._schema}.broadcast_jobs where job_id = %s;",
+                (self.job_id,),
+            )
+            return cur.fetchone()[0]
+
+    def _count_remaining(self):
+        with db_cursor() as cur:
+            cur.execute(
+                f"""
+                select count(distinct telegram_id) from {self._schema}.users u
+                where not exists (
+                    select 1 from {self._schema}.broadcast_recipients r
+                    where r.job_id = %s and r.telegram_id = u.telegram_id
+                );
+                """,
+                (self.job_id,),
+            )
+            return cur.fetchone()[0]
+
+    def _claim(self, telegram_ids):
+        with db_cursor() as cur:
+            execute_values(
+                cur,
+                f"""
+                INSERT INTO {self._schema}.broadcast_recipients (job_id, telegram_id, status)
+                VALUES %s ON CONFLICT DO NOTHING""",
+                [(self.job_id, telegram_id, "sending") for telegram_id in telegram_ids],
+                page_size=len(telegram_ids),
+            )
+
+    def _submit(self, telegram_id, message_text):
+        with self._condition:
+            self._pending += 1
+        self._dispatcher.submit(
+            telegram_id,
+            message_text,
+            on_sent=partial(self._sent, telegram_id),
+            on_dropped=partial(self._done, telegram_id, "failed"),
+        )
+
+    def _sent(self, telegram_id, response):
+        chat_id, from_id, text, timestamp_received = _extract_response(response)
+        row = (
+            chat_id,
+            from_id,
+            None,
+            text,
+            EVENT_NAME,
+            timestamp_received,
+            datetime.now(),
+        )
+        self._done(telegram_id, "sent", row)
+
+    def _done(self, telegram_id, status, message_row=None):
+        with self._condition:
+            self._pending -= 1
+            self.stats[status] += 1
+            self.stats["remaining"] = max(self.stats["remaining"] - 1, 0)
+            self._results.append((telegram_id, status, datetime.now()))
+            if message_row:
+                self._messages.append(message_row)
+            full = len(self._results) >= self._batch_size
+            self._condition.notify_all()
+        if full:
+            self._flush()
+
+    def _wait_for_capacity(self, max_pending):
+        with self._condition:
+            while self._pending > max_pending:
+                self._condition.wait(self._report_secs)
+                if time.monotonic() - self._reported >= self._report_secs:
+                    self._report()
+
+    def _flush(self):
+        """
+        Save the results and the sent aya_messages rows of the batch in one transaction.
+        """
+        with self._flush_lock:
+            with self._condition:
+                results, self._results = self._results, []
+                messages, self._messages = self._messages, []
+            if not results:
+                return
+            with update_transaction():
+                with db_cursor() as cur:
+                    execute_values(
+                        cur,
+                        f"""
+                        UPDATE {self._schema}.broadcast_recipients r
+                        SET status = v.status, sent_at = v.sent_at::timestamp
+                        FROM (VALUES %s) AS v (telegram_id, status, sent_at)
+                        WHERE r.job_id = {int(self.job_id)} AND r.telegram_id = v.telegram_id""",
+                        results,
+                        page_size=len(results),
+                    )
+                _write_rows([("aya_messages", row) for row in messages])
+
+    def _finish(self):
+        with db_cursor() as cur:
+            cur.execute(
+                f"UPDATE {self._schema}.broadcast_jobs SET finished_at = %s WHERE job_id = %s;",
+                (datetime.now(), self.job_id),
+            )
+
+    def _heartbeat(self):
+        # the db clock, which the bot compares it with
+        with db_cursor() as cur:
+            cur.execute(
+                f"UPDATE {self._schema}.broadcast_jobs SET heartbeat_at = localtimestamp "
+                "WHERE job_id = %s;",
+                (self.job_id,),
+            )
+
+    def _report(self):
+        self._heartbeat()
+        self._reported = time.monotonic()
+        done = self.stats["sent"] + self.stats["failed"]
+        progress = format_progress(
+            done, self.stats["remaining"], self._reported - self._started
+        )
+        logging.info(
+            f"job {self.job_id}: {self.stats['sent']} sent, {self.stats['failed']} failed, "
+            f"{self.stats['remaining']} left, {progress}"
+        )
+
+
+class BroadcastWatch:
+    """
+    Lowers the global rate of the bot's send queue by BROADCAST_RATE per running job of the bot,
+    so the bot and its broadcasts together stay within SEND_RATE_GLOBAL. Replies keep at least
+    SEND_RATE_PER_CHAT msgs/s.
+    """
+
+    def __init__(
+        self, dispatcher, interval=BROADCAST_REPORT_SECS, running_jobs=running_jobs
+    ):
+        self._dispatcher = dispatcher
+        self._interval = interval
+        self._running_jobs = running_jobs
+        self._stopped = threading.Event()
+        self.jobs = 0
+
+    def check(self):
+        """
+        Set the rate of the dispatcher for the jobs running now.
+        """
+        try:
+            jobs = self._running_jobs()
+        except UndefinedTable:
+            jobs = 0  # `broadcast.py schema` wasn't run, so there are no jobs
+        except Exception as e:
+            logging.warning(f"could not check for running broadcasts: {e}")
+            return
+        if jobs == self.jobs:
+            return
+        self.jobs = jobs
+        rate = max(SEND_RATE_GLOBAL - jobs * BROADCAST_RATE, SEND_RATE_PER_CHAT)
+        self._dispatcher.set_global_rate(rate)
+        logging.info(f"{jobs} broadcasts running, sending at most {rate:g} msgs/s")
+
+    def start(self):
+        def run():
+            while not self._stopped.wait(self._interval):
+                self.check()
+
+        self.check()
+        name = current_bot_name()
+        start_thread(run, name=f"broadcast_watch_{name}" if name else "broadcast_watch")
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+
+def start_broadcast_watch(dispatcher=None):
+    """
+    Slow down the send queue of the current bot while broadcasts of the bot run.
+    :rtype: BroadcastWatch
+    """
+    return BroadcastWatch(dispatcher or get_dispatcher()).start()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)-8s %(message)s", level=logging.INFO
+    )
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("schema")
+    create_parser = subparsers.add_parser("create")
+    create_parser.add_argument("message_text")
+    for command in ["run", "status"]:
+        subparsers.add_parser(command).add_argument("job_id", type=int)
+    args = parser.parse_args()
+
+    if args.command == "schema":
+        ensure_schema()
+    elif args.command == "create":
+        print(create_job(args.message_text))
+    elif args.command == "run":
+        BroadcastJob(args.job_id).run()
+    else:
+        print(job_status(args.job_id))
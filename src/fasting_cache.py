@@ -0,0 +1,82 @@
+"""
+In-memory per-chat fasting state: start of the current fast, or None if the chat doesn't fast.
+"""
+import threading
+from collections import OrderedDict
+
+# returned by FastingCache.get for chats that are not cached (as opposed to None = not fasting)
+MISSING = object()
+
+
+class FastingCache:
+    """
+    LRU cache chat_id -> start of current fast (datetime) or None.
+    Holds at most `max_size` chats; evicted chats are looked up in the db again.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, chat_id):
+        """
+        :return: start of current fast, None if not fasting, MISSING if not cached
+        """
+        with self._lock:
+            if chat_id not in self._states:
+                self.stats["misses"] += 1
+                return MISSING
+            self._states.move_to_end(chat_id)
+            self.stats["hits"] += 1
+            return self._states[chat_id]
+
+    def set(self, chat_id, fast_start):
+        with self._lock:
+            self._set(chat_id, fast_start)
+
+    def _set(self, chat_id, fast_start):
+        if self.max_size <= 0:
+            return
+        self._states[chat_id] = fast_start
+        self._states.move_to_end(chat_id)
+        while len(self._states) > self.max_size:
+            self._states.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def discard(self, chat_id):
+        with self._lock:
+            self._states.pop(chat_id, None)
+
+    def replace(self, chat_id, expected, fast_start):
+        """
+        Set the state of a chat (MISSING: drop it) unless it changed from `expected`
+        (MISSING: not cached) in the meantime, e.g. to refresh a state loaded earlier
+        without overwriting a newer one.
+        """
+        with self._lock:
+            current = self._states.get(chat_id, MISSING)
+            if current is not expected and current != expected:
+                return
+            if fast_start is MISSING:
+                self._states.pop(chat_id, None)
+            else:
+                self._set(chat_id, fast_start)
+
+    def warm(self, states):
+        """
+        :param states: iterable of (chat_id, fast_start), least recently active first
+        """
+        for chat_id, fast_start in states:
+            self.set(chat_id, fast_start)
+
+    def items(self):
+        """
+        :return: [(chat_id, fast_start)], least recently active first
+        """
+        with self._lock:
+            return list(self._states.items())
+
+    def __len__(self):
+        return len(self._states)
@@ -0,0 +1,130 @@
+"""
+Schema and backfill of SCHEMA.fasting_sessions, one row per fast: (chat_id, started_at, ended_at, hours).
+Open fasts have ended_at = null; a partial unique index keeps at most one open fast per chat,
+so "is this user fasting" is a single index probe.
+
+Create the table and rebuild it from aya_messages with:
+    python fasting_sessions.py backfill [--chunk-size 10000]
+"""
+import argparse
+import logging
+
+from psycopg2.extras import execute_values
+
+from utils import db_conn, db_cursor, get_schema
+
+BACKFILL_CHUNK_SIZE = 10000
+
+
+def ensure_schema():
+    """
+    Create fasting_sessions and its indexes if they don't exist yet.
+    """
+    schema = get_schema()
+    with db_cursor() as cur:
+        cur.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {schema}.fasting_sessions (
+                id bigserial PRIMARY KEY,
+                chat_id bigint NOT NULL,
+                started_at timestamp NOT NULL,
+                ended_at timestamp,
+                hours double precision
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS fasting_sessions_open_idx
+                ON {schema}.fasting_sessions (chat_id) WHERE ended_at IS NULL;
+            CREATE INDEX IF NOT EXISTS fasting_sessions_chat_id_started_at_idx
+                ON {schema}.fasting_sessions (chat_id, started_at);
+            CREATE INDEX IF NOT EXISTS fasting_sessions_ended_at_idx
+                ON {schema}.fasting_sessions (ended_at);
+            """
+        )
+
+
+def build_sessions(events):
+    """
+    Turn fast_start/fast_end messages into sessions, the same way the bot interprets them:
+    a fast_start opens a fast if none is open, a fast_end closes the open fast.
+    :param events: (chat_id, event_name, timestamp_received), sorted by chat_id and timestamp_received
+    :return: generator of (chat_id, started_at, ended_at, hours); ended_at and hours are None for open fasts
+    """
+    current_chat_id, started_at = None, None
+    for chat_id, event_name, timestamp in events:
+        if chat_id != current_chat_id:
+            if started_at is not None:
+                yield current_chat_id, started_at, None, None
+            current_chat_id, started_at = chat_id, None
+        if event_name == "fast_start" and started_at is None:
+            started_at = timestamp
+        elif event_name == "fast_end" and started_at is not None:
+            hours = round((timestamp - started_at).total_seconds() / 60 / 60, 4)
+            yield chat_id, started_at, timestamp, hours
+            started_at = None
+    if started_at is not None:
+        yield current_chat_id, started_at, None, None
+
+
+def backfill(chunk_size=BACKFILL_CHUNK_SIZE):
+    """
+    Rebuild fasting_sessions from aya_messages.
+    Messages are streamed with a server-side cursor and sessions are written in chunks,
+    so memory use is bounded by chunk_size regardless of table size.
+    :return: number of sessions written
+    """
+    ensure_schema()
+    schema = get_schema()
+    written = 0
+    with db_conn() as read_conn, db_conn() as write_conn:
+        with read_conn.cursor(name="fasting_sessions_backfill") as read_cur:
+            read_cur.itersize = chunk_size
+            read_cur.execute(
+                f"""
+                select chat_id, event_name, timestamp_received
+                from {schema}.aya_messages
+                where event_name in ('fast_start', 'fast_end')
+                order by chat_id, timestamp_received;
+                """
+            )
+            with write_conn.cursor() as write_cur:
+                write_cur.execute(f"TRUNCATE {schema}.fasting_sessions")
+                chunk = []
+                for session in build_sessions(read_cur):
+                    chunk.append(session)
+                    if len(chunk) >= chunk_size:
+                        written += _write_sessions(write_cur, schema, chunk)
+                        chunk = []
+                        logging.info(f"backfilled {written} fasting sessions")
+                written += _write_sessions(write_cur, schema, chunk)
+    read_conn.close()
+    write_conn.close()
+    logging.info(f"backfilled {written} fasting sessions in total")
+    return written
+
+
+def _write_sessions(cur, schema, sessions):
+    if sessions:
+        execute_values(
+            cur,
+            f"INSERT INTO {schema}.fasting_sessions (chat_id, started_at, ended_at, hours) VALUES %s",
+            sessions,
+            page_size=len(sessions),
+        )
+    return len(sessions)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)-8s %(message)s", level=logging.INFO
+    )
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("schema", help="create table and indexes")
+    backfill_parser = subparsers.add_parser(
+        "backfill", help="rebuild sessions from aya_messages"
+    )
+    backfill_parser.add_argument("--chunk-size", type=int, default=BACKFILL_CHUNK_SIZE)
+    args = parser.parse_args()
+    if args.command == "schema":
+        ensure_schema()
+    else:
+        backfill(args.chunk_size)
@@ -0,0 +1,274 @@
+"""
+Background download of photos and documents users send, e.g. meal photos for analysis.
+Handlers only queue the file; worker threads resolve it with getFile and stream it to disk
+in chunks. Files are stored under their file_unique_id, which Telegram keeps the same for the
+same file, so a file sent twice is downloaded once. The cache is kept below MEDIA_CACHE_BYTES
+by evicting the least recently used files.
+"""
+import contextvars
+import logging
+import os
+import queue
+import threading
+from collections import OrderedDict
+
+import metrics
+from telegram_client import get_client
+from utils import (
+    MEDIA_DIR,
+    MEDIA_CACHE_BYTES,
+    MEDIA_WORKERS,
+    MEDIA_QUEUE_SIZE,
+    MEDIA_CHUNK_BYTES,
+)
+
+MEDIA_DOWNLOADS = metrics.Counter(
+    "aya_media_downloads_total", "Media files by outcome.", ("outcome",)
+)
+
+
+class MediaCache:
+    """
+    Files in `directory`, named by file_unique_id and fanned out by its first two characters.
+    Tracks the size of every file and evicts the least recently used ones above max_bytes.
+    Downloads in progress are written to tmp/, named after the process and thread writing them.
+    """
+
+    def __init__(self, directory=MEDIA_DIR, max_bytes=MEDIA_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # file_unique_id -> bytes, least recently used first
+        self._sizes = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(directory, "tmp"), exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        # downloads of processes that died while writing them
+        for f in os.scandir(os.path.join(self.directory, "tmp")):
+            if not _is_running(f.name):
+                try:
+                    os.remove(f.path)
+                except FileNotFoundError:
+                    pass
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_dir() or entry.name == "tmp":
+                continue
+            for f in os.scandir(entry.path):
+                stat = f.stat()
+                files.append((stat.st_mtime, f.name, stat.st_size))
+        for _, file_unique_id, size in sorted(files):
+            self._sizes[file_unique_id] = size
+            self._bytes += size
+
+    def path(self, file_unique_id):
+        return os.path.join(self.directory, file_unique_id[:2], file_unique_id)
+
+    def tmp_path(self, file_unique_id):
+        return os.path.join(
+            self.directory,
+            "tmp",
+            f"{file_unique_id}.{os.getpid()}.{threading.get_ident()}",
+        )
+
+    def __contains__(self, file_unique_id):
+        with self._lock:
+            if file_unique_id not in self._sizes:
+                return False
+            self._sizes.move_to_end(file_unique_id)
+        try:
+            os.utime(self.path(file_unique_id))
+        except FileNotFoundError:
+            # deleted behind our back, e.g. by another process sharing the directory
+            with self._lock:
+                self._bytes -= self._sizes.pop(file_unique_id, 0)
+            return False
+        return True
+
+    def add(self, file_unique_id, tmp_path, size):
+        """
+        Move a downloaded file into the cache and evict files above max_bytes.
+        """
+        path = self.path(file_unique_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._bytes += size - self._sizes.pop(file_unique_id, 0)
+            self._sizes[file_unique_id] = size
+            evicted = []
+            while self._bytes > self.max_bytes and len(self._sizes) > 1:
+                old_id, old_size = self._sizes.popitem(last=False)
+                self._bytes -= old_size
+                evicted.append(old_id)
+        for old_id in evicted:
+            try:
+                os.remove(self.path(old_id))
+            except FileNotFoundError:
+                pass
+
+    @property
+    def bytes(self):
+        return self._bytes
+
+    def __len__(self):
+        return len(self._sizes)
+
+
+def _is_running(tmp_name):
+    """
+    :param tmp_name: name of a file in tmp/, see MediaCache.tmp_path()
+    :return: True if the process writing it is still running
+    """
+    parts = tmp_name.rsplit(".", 2)
+    if len(parts) != 3 or not parts[1].isdigit():
+        return False
+    try:
+        os.kill(int(parts[1]), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class MediaFetcher:
+    """
+    Bounded queue of files to download, worked off by `workers` threads.
+    submit() never blocks: when the queue is full the file is skipped.
+    """
+
+    def __init__(
+        self,
+        cache=None,
+        workers=MEDIA_WORKERS,
+        queue_size=MEDIA_QUEUE_SIZE,
+        chunk_bytes=MEDIA_CHUNK_BYTES,
+    ):
+        self.cache = cache if cache is not None else MediaCache()
+        self._queue = queue.Queue(queue_size)
+        self._chunk_bytes = chunk_bytes
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self._threads = [
+            threading.Thread(target=self._run, name=f"media_fetcher_{i}", daemon=True)
+            for i in range(workers)
+        ]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def submit(self, file_id, file_unique_id):
+        """
+        Queue a file for download, unless it is cached or already queued.
+        :return: False if the file was skipped because the queue is full
+        """
+        if file_unique_id in self.cache:
+            MEDIA_DOWNLOADS.inc(outcome="cached")
+            return True
+        with self._lock:
+            if file_unique_id in self._in_flight:
+                return True
+            self._in_flight.add(file_unique_id)
+        try:
+            self._queue.put_nowait(
+                (file_id, file_unique_id, contextvars.copy_context())
+            )
+        except queue.Full:
+            with self._lock:
+                self._in_flight.discard(file_unique_id)
+            logging.warning(f"media queue full, skipping file {file_unique_id}")
+            MEDIA_DOWNLOADS.inc(outcome="skipped")
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            file_id, file_unique_id, context = item
+            try:
+                # downloaded with the token of the bot that received the file
+                context.run(self._download, file_id, file_unique_id)
+                MEDIA_DOWNLOADS.inc(outcome="downloaded")
+            except Exception as e:
+                MEDIA_DOWNLOADS.inc(outcome="failed")
+                metrics.ERRORS.inc(stage="media_fetch")
+                logging.exception(e)
+            finally:
+                with self._lock:
+                    self._in_flight.discard(file_unique_id)
+                self._queue.task_done()
+
+    def _download(self, file_id, file_unique_id):
+        file_path = get_client().get_file(file_id)["result"]["file_path"]
+        tmp_path = self.cache.tmp_path(file_unique_id)
+        try:
+            with open(tmp_path, "wb") as f:
+                size = get_client().download_file(file_path, f, self._chunk_bytes)
+            self.cache.add(file_unique_id, tmp_path, size)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def stop(self):
+        """
+        Stop the workers after their current download; files still queued are skipped.
+        """
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                with self._lock:
+                    self._in_flight.discard(item[1])
+                MEDIA_DOWNLOADS.inc(outcome="skipped")
+            self._queue.task_done()
+        for _ in self._threads:
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                # submitted again meanwhile, the daemon threads end with the process
+                break
+        for thread in self._threads:
+            thread.join(timeout=1)
+
+
+_FETCHER = None
+metrics.Gauge(
+    "aya_media_queue_depth",
+    "Media files waiting for download.",
+    lambda: _FETCHER.depth if _FETCHER else None,
+)
+metrics.Gauge(
+    "aya_media_cache_bytes",
+    "Bytes of cached media files.",
+    lambda: _FETCHER.cache.bytes if _FETCHER else None,
+)
+
+
+def get_media_fetcher():
+    """
+    :return: the running MediaFetcher, None if media is not downloaded
+    """
+    return _FETCHER
+
+
+def start_media_fetcher(**kwargs):
+    """
+    Start downloading the photos and documents of incoming messages in the background.
+    :rtype: MediaFetcher
+    """
+    global _FETCHER
+    _FETCHER = MediaFetcher(**kwargs).start()
+    logging.info(f"media fetcher enabled, caching in {_FETCHER.cache.directory}")
+    return _FETCHER
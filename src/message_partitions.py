@@ -0,0 +1,305 @@
+"""
+Monthly partitions of SCHEMA.aya_messages on timestamp_received, and retention of old months.
+Partitions are created PARTITION_MONTHS_AHEAD months in advance; rows without a matching
+partition (e.g. timestamp_received is null, or `schema` didn't run for months) land in
+aya_messages_default instead of failing. Postgres refuses to create a partition for rows the
+default partition holds, so a missing month is created as a table of its own, its rows are moved
+out of the default partition into it, and then it is attached.
+The retention command streams every month older than RETENTION_MONTHS to a gzipped CSV file in
+ARCHIVE_DIR (restorable with COPY ... FROM ... CSV HEADER), then detaches or drops the partition,
+so indexes and vacuum only cover recent months.
+
+    python message_partitions.py partition        # turn an existing aya_messages into a partitioned table
+    python message_partitions.py schema           # create partitions and indexes, run e.g. daily from cron
+    python message_partitions.py retention [--keep-months 12] [--drop]
+"""
+import argparse
+import gzip
+import logging
+import os
+import re
+from datetime import date, datetime
+
+from utils import (
+    db_conn,
+    db_cursor,
+    get_schema,
+    PARTITION_MONTHS_AHEAD,
+    RETENTION_MONTHS,
+    ARCHIVE_DIR,
+)
+
+TABLE = "aya_messages"
+# upper bound of a range partition as shown by pg_get_expr(relpartbound)
+UPPER_BOUND = re.compile(r"TO \('([^']+)'\)")
+
+
+def month_start(day):
+    """
+    :param day: date or datetime
+    :return: first day of the month
+    :rtype: date
+    """
+    return date(day.year, day.month, 1)
+
+
+def add_months(month, months):
+    """
+    :param month: first day of a month
+    :rtype: date
+    """
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"{TABLE}_p{month:%Y_%m}"
+
+
+def upper_bound(partition_bound):
+    """
+    :param partition_bound: e.g. "FOR VALUES FROM ('2022-04-01 00:00:00') TO ('2022-05-01 00:00:00')"
+    :return: exclusive upper bound, None for the default partition
+    :rtype: datetime
+    """
+    match = UPPER_BOUND.search(partition_bound)
+    return datetime.fromisoformat(match.group(1)) if match else None
+
+
+def expired_partitions(partitions, today, keep_months=RETENTION_MONTHS):
+    """
+    :param partitions: [(name, partition bound)]
+    :return: names of the partitions whose rows all are older than the last keep_months months
+        (the current one included), oldest first
+    :rtype: list
+    """
+    cutoff = datetime.combine(
+        add_months(month_start(today), 1 - keep_months), datetime.min.time()
+    )
+    expired = []
+    for name, bound in partitions:
+        upper = upper_bound(bound)
+        if upper is not None and upper <= cutoff:
+            expired.append((upper, name))
+    return [name for _, name in sorted(expired)]
+
+
+def legacy_index_name(name):
+    """
+    :param name: index of the unpartitioned aya_messages, e.g. "aya_messages_chat_id_idx"
+    :return: its name once the table is aya_messages_legacy, e.g. "aya_messages_legacy_chat_id_idx"
+    """
+    return f"{TABLE}_legacy_{name[len(TABLE) + 1:]}"
+
+
+def _partition_sql(schema, month):
+    name = partition_name(month)
+    start, end = month, add_months(month, 1)
+    return f"""
+        CREATE TABLE {schema}.{name} (LIKE {schema}.{TABLE} INCLUDING DEFAULTS);
+        WITH moved AS (
+            DELETE FROM {schema}.{TABLE}_default
+            WHERE timestamp_received >= '{start}' AND timestamp_received < '{end}'
+            RETURNING *
+        )
+        INSERT INTO {schema}.{name} SELECT * FROM moved;
+        ALTER TABLE {schema}.{TABLE} ATTACH PARTITION {schema}.{name}
+            FOR VALUES FROM ('{start}') TO ('{end}');
+        """
+
+
+def _partitions_sql(schema, month, months_ahead, existing=()):
+    """
+    :param existing: names of the partitions that exist already
+    """
+    statements = [
+        f"CREATE TABLE IF NOT EXISTS {schema}.{TABLE}_default "
+        f"PARTITION OF {schema}.{TABLE} DEFAULT;"
+    ]
+    for _ in range(months_ahead + 1):
+        if partition_name(month) not in existing:
+            statements.append(_partition_sql(schema, month))
+        month = add_months(month, 1)
+    # created on the parent, postgres creates and attaches the index of every partition.
+    # A unique index of a partitioned table has to include the partition key: an update is
+    # saved with the date of its message, so a redelivered update still conflicts.
+    statements.append(
+        f"""
+        CREATE UNIQUE INDEX IF NOT EXISTS {TABLE}_update_id_received_idx
+            ON {schema}.{TABLE} (update_id, timestamp_received) WHERE update_id IS NOT NULL;
+        CREATE INDEX IF NOT EXISTS {TABLE}_chat_id_received_idx
+            ON {schema}.{TABLE} (chat_id, timestamp_received);
+        CREATE INDEX IF NOT EXISTS {TABLE}_timestamp_saved_idx
+            ON {schema}.{TABLE} (timestamp_saved);
+        """
+    )
+    return "\n".join(statements)
+
+
+def ensure_partitions(today=None, months_ahead=PARTITION_MONTHS_AHEAD):
+    """
+    Create the partitions of the current month and the next `months_ahead` months,
+    the default partition and the indexes, if they don't exist yet.
+    """
+    schema = get_schema()
+    month = month_start(today or date.today())
+    existing = {name for name, _ in list_partitions()}
+    with db_cursor() as cur:
+        cur.execute(_partitions_sql(schema, month, months_ahead, existing))
+    logging.info(
+        f"partitions of {schema}.{TABLE} exist up to {add_months(month, months_ahead)}"
+    )
+
+
+def partition_table(today=None, months_ahead=PARTITION_MONTHS_AHEAD):
+    """
+    Turn an unpartitioned aya_messages into a partitioned one, in one transaction.
+    The existing table is kept as partition aya_messages_legacy, holding everything before
+    the first monthly partition, so no rows are copied. Its indexes are renamed to
+    aya_messages_legacy_*, since index names are unique per schema and the partitioned table
+    takes over the names (e.g. the one offset_store.py creates); equal indexes are attached to
+    the new ones instead of built again. Indexes that only other modules create (e.g. the
+    inserted_at one of analytics/export.py) are left on the legacy partition: run their schema
+    command again. Blocks writes to aya_messages meanwhile.
+    """
+    schema = get_schema()
+    with db_cursor() as cur:
+        cur.execute(
+            f"LOCK TABLE {schema}.{TABLE} IN ACCESS EXCLUSIVE MODE;"
+            f"select count(*) filter (where timestamp_received is null), max(timestamp_received) "
+            f"from {schema}.{TABLE};"
+        )
+        nulls, newest = cur.fetchone()
+        if nulls:
+            raise ValueError(
+                f"{nulls} rows of {schema}.{TABLE} have no timestamp_received, "
+                "set it before partitioning"
+            )
+        first_month = add_months(month_start(today or date.today()), 1)
+        if newest and newest.date() >= first_month:
+            first_month = add_months(month_start(newest), 1)
+        cur.execute(
+            "select indexname from pg_indexes where schemaname = %s and tablename = %s;",
+            (schema, TABLE),
+        )
+        renames = "".join(
+            f"ALTER INDEX {schema}.{name} RENAME TO {legacy_index_name(name)};\n"
+            for (name,) in cur.fetchall()
+            if name.startswith(f"{TABLE}_")
+        )
+        cur.execute(
+            f"""
+            ALTER TABLE {schema}.{TABLE} RENAME TO {TABLE}_legacy;
+            {renames}
+            CREATE TABLE {schema}.{TABLE}
+                (LIKE {schema}.{TABLE}_legacy INCLUDING DEFAULTS)
+                PARTITION BY RANGE (timestamp_received);
+            ALTER TABLE {schema}.{TABLE} ATTACH PARTITION {schema}.{TABLE}_legacy
+                FOR VALUES FROM (MINVALUE) TO ('{first_month}');
+            """
+            + _partitions_sql(schema, first_month, months_ahead)
+        )
+    logging.info(f"partitioned {schema}.{TABLE}, older rows are in {TABLE}_legacy")
+
+
+def list_partitions():
+    """
+    :return: [(name, partition bound)] of aya_messages
+    :rtype: list
+    """
+    with db_cursor() as cur:
+        cur.execute(
+            """
+            select c.relname, pg_get_expr(c.relpartbound, c.oid)
+            from pg_inherits i
+            join pg_class c on c.oid = i.inhrelid
+            join pg_class p on p.oid = i.inhparent
+            join pg_namespace n on n.oid = p.relnamespace
+            where n.nspname = %s and p.relname = %s;
+            """,
+            (get_schema(), TABLE),
+        )
+        return cur.fetchall()
+
+
+def archive_partition(name, archive_dir=ARCHIVE_DIR):
+    """
+    Stream a partition to archive_dir/SCHEMA/<name>.csv.gz with COPY.
+    :return: path of the archive and number of rows written
+    """
+    schema = get_schema()
+    directory = os.path.join(archive_dir, schema)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{name}.csv.gz")
+    conn = db_conn()
+    try:
+        # repeatable read, so the count and the copy see the same rows
+        conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+        with conn.cursor() as cur:
+            cur.execute(f"select count(*) from {schema}.{name};")
+            rows = cur.fetchone()[0]
+            # write and rename, so a crash never leaves a truncated archive behind
+            with gzip.open(path + ".tmp", "wb") as f:
+                cur.copy_expert(
+                    f"COPY {schema}.{name} TO STDOUT WITH (FORMAT csv, HEADER)", f
+                )
+            if cur.rowcount not in (-1, rows):
+                raise RuntimeError(f"archived {cur.rowcount} of {rows} rows of {name}")
+        conn.rollback()
+    finally:
+        conn.close()
+    with open(path + ".tmp", "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+    return path, rows
+
+
+def apply_retention(
+    keep_months=RETENTION_MONTHS, archive_dir=ARCHIVE_DIR, drop=False, today=None
+):
+    """
+    Archive the partitions older than keep_months months, then detach (or drop) them.
+    A detached partition stays in the schema as an ordinary table.
+    :return: names of the partitions removed from aya_messages
+    :rtype: list
+    """
+    schema = get_schema()
+    expired = expired_partitions(list_partitions(), today or date.today(), keep_months)
+    for name in expired:
+        path, rows = archive_partition(name, archive_dir)
+        with db_cursor() as cur:
+            cur.execute(
+                f"ALTER TABLE {schema}.{TABLE} DETACH PARTITION {schema}.{name};"
+            )
+            if drop:
+                cur.execute(f"DROP TABLE {schema}.{name};")
+        logging.info(
+            f"archived {rows} rows of {name} to {path} and "
+            f"{'dropped' if drop else 'detached'} it"
+        )
+    return expired
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)-8s %(message)s", level=logging.INFO
+    )
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("partition", help="partition an existing aya_messages")
+    subparsers.add_parser("schema", help="create upcoming partitions and indexes")
+    retention_parser = subparsers.add_parser(
+        "retention", help="archive and remove old partitions"
+    )
+    retention_parser.add_argument("--keep-months", type=int, default=RETENTION_MONTHS)
+    retention_parser.add_argument("--archive-dir", default=ARCHIVE_DIR)
+    retention_parser.add_argument(
+        "--drop", action="store_true", help="drop instead of detach archived partitions"
+    )
+    args = parser.parse_args()
+    if args.command == "partition":
+        partition_table()
+    elif args.command == "schema":
+        ensure_partitions()
+    else:
+        apply_retention(args.keep_months, args.archive_dir, args.drop)
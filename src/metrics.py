@@ -0,0 +1,242 @@
+"""
+Low-overhead counters, gauges and histograms for the bot pipeline,
+exposed in Prometheus text format on a local http endpoint.
+Set METRICS=0 to turn all recording off; every call is then a no-op.
+"""
+import bisect
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bots import current_bot_name
+
+ENABLED = os.environ.get("METRICS", "1") == "1"
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9100))
+
+# secs, from a cache hit to a slow Telegram round trip
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+# utils imports metrics first, so this is close to the start of the process, see startup.py
+PROCESS_STARTED = time.monotonic()
+
+_REGISTRY = []
+
+
+def _key(labelnames, labels):
+    # the bot an observation was made for is the last value of every key, see bots.py
+    return tuple(labels.get(name, "") for name in labelnames) + (current_bot_name(),)
+
+
+def _format_labels(labelnames, values, extra=()):
+    if values and values[-1]:
+        labelnames = labelnames + ("bot",)
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        _REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        if not ENABLED:
+            return
+        key = _key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+
+class Gauge:
+    """
+    Value read on every scrape from `function`, e.g. a queue depth.
+    Nothing is exported while `function` returns None, e.g. before a queue is started.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, function):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        _REGISTRY.append(self)
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.type}"
+        try:
+            value = self.function()
+        except Exception:
+            return
+        if value is not None:
+            yield f"{self.name} {value}"
+
+
+class FunctionCounter(Gauge):
+    """
+    Counter read on every scrape from `function`, e.g. the hits counted by a cache.
+    """
+
+    type = "counter"
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._values = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        _REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        if not ENABLED:
+            return
+        key = _key(self.labelnames, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(self.buckets) + 3)
+            values[index] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in self._values.items()]
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [("le", bound)])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {counts[-2]}"
+            yield f"{self.name}_count{labels} {counts[-1]}"
+
+
+STAGE_SECONDS = Histogram(
+    "aya_stage_seconds", "Duration of pipeline stages.", ("stage",)
+)
+DB_SECONDS = Histogram("aya_db_seconds", "Duration of db helpers.", ("helper",))
+ERRORS = Counter("aya_errors_total", "Errors by pipeline stage.", ("stage",))
+UPDATES = Counter("aya_updates_total", "Updates processed.")
+COMMANDS = Counter("aya_commands_total", "Replies by event_name.", ("command",))
+
+
+@contextmanager
+def stage(name):
+    """
+    Time a pipeline stage and count its errors.
+    """
+    if not ENABLED:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        ERRORS.inc(stage=name)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=name)
+
+
+def timed_db(func):
+    """
+    Decorator that records the duration and errors of a db helper.
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not ENABLED:
+            return func(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            ERRORS.inc(stage=func.__name__)
+            raise
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - started, helper=func.__name__)
+
+    return wrapper
+
+
+def render():
+    """
+    :return: all metrics in Prometheus text format
+    :rtype: str
+    """
+    lines = []
+    for metric in _REGISTRY:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        content = render().encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """
+    Serve /metrics from a daemon thread. Does nothing if metrics are disabled.
+    :rtype: ThreadingHTTPServer
+    """
+    if not ENABLED:
+        return None
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"serving metrics on http://{host}:{port}/metrics")
+    return server
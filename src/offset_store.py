@@ -0,0 +1,146 @@
+"""
+Durable getUpdates offset and update_id deduplication, so a restarted bot resumes where it
+stopped instead of handling pending updates a second time.
+
+OFFSET_STORE=file keeps the offset in OFFSET_FILE, OFFSET_STORE=db in SCHEMA.aya_offsets.
+Create aya_offsets and the unique index on aya_messages (update_id, timestamp_received) with:
+    python offset_store.py schema
+Run it once per schema before starting the bot on an existing db. Until the index exists, the bot
+logs a warning on start and saves messages without deduplication, see utils.check_message_dedup().
+"""
+import argparse
+import logging
+import os
+import threading
+from collections import deque
+
+from utils import db_cursor, get_schema, OFFSET_STORE, OFFSET_FILE, DEDUP_WINDOW
+
+
+class FileOffsetStore:
+    def __init__(self, path=OFFSET_FILE):
+        self.path = path
+
+    def load(self):
+        """
+        :return: next update_id to fetch, None if nothing was saved yet
+        :rtype: int
+        """
+        try:
+            with open(self.path) as f:
+                return int(f.read().strip())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save(self, next_update_id):
+        # write and rename, so a crash never leaves a half-written offset behind
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(str(next_update_id))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+class DbOffsetStore:
+    def __init__(self, bot="default"):
+        self.bot = bot
+
+    def load(self):
+        with db_cursor() as cur:
+            cur.execute(
+                f"""
+                select next_update_id from {get_schema()}.aya_offsets
+                where bot = %s;
+                """,
+                (self.bot,),
+            )
+            rows = cur.fetchall()
+        return rows[0][0] if rows else None
+
+    def save(self, next_update_id):
+        with db_cursor() as cur:
+            cur.execute(
+                f"""
+                INSERT INTO {get_schema()}.aya_offsets
+                    (bot, next_update_id, updated_at)
+                VALUES
+                    (%s, %s, now())
+                ON CONFLICT (bot) DO UPDATE
+                SET next_update_id = excluded.next_update_id, updated_at = excluded.updated_at""",
+                (self.bot, next_update_id),
+            )
+
+
+class NoOffsetStore:
+    def load(self):
+        return None
+
+    def save(self, next_update_id):
+        pass
+
+
+def get_offset_store(bot="default"):
+    """
+    :return: offset store configured by OFFSET_STORE (file, db or none)
+    """
+    if OFFSET_STORE == "db":
+        return DbOffsetStore(bot)
+    if OFFSET_STORE == "file":
+        path = OFFSET_FILE if bot == "default" else f"{OFFSET_FILE}.{bot}"
+        return FileOffsetStore(path)
+    return NoOffsetStore()
+
+
+class RecentUpdateIds:
+    """
+    The last `max_size` update_ids seen by this process.
+    """
+
+    def __init__(self, max_size=DEDUP_WINDOW):
+        self._order = deque()
+        self._ids = set()
+        self._max_size = max_size
+        self._lock = threading.Lock()
+
+    def seen(self, update_id):
+        """
+        Remember an update_id.
+        :return: True if it was seen before
+        :rtype: bool
+        """
+        with self._lock:
+            if update_id in self._ids:
+                return True
+            self._ids.add(update_id)
+            self._order.append(update_id)
+            if len(self._order) > self._max_size:
+                self._ids.discard(self._order.popleft())
+            return False
+
+
+def ensure_schema():
+    schema = get_schema()
+    with db_cursor() as cur:
+        cur.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {schema}.aya_offsets (
+                bot text PRIMARY KEY,
+                next_update_id bigint NOT NULL,
+                updated_at timestamp NOT NULL
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS aya_messages_update_id_received_idx
+                ON {schema}.aya_messages (update_id, timestamp_received)
+                WHERE update_id IS NOT NULL;
+            """
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)-8s %(message)s", level=logging.INFO
+    )
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("command", choices=["schema"])
+    parser.parse_args()
+    ensure_schema()
@@ -0,0 +1,263 @@
+"""
+Reminders when a fast reaches a milestone (e.g. 12h, 16h, 24h), and a nudge for users who
+seem to have forgotten /ende. One timer per open fast is kept in memory, loaded from
+fasting_sessions at startup and updated by find_response on /fasten and /ende (once the
+update is committed), so the db is never polled for due reminders.
+"""
+import heapq
+import logging
+import threading
+import time
+
+import metrics
+import utils
+from bots import current_bot_name, start_thread
+from utils import (
+    REMINDER_MILESTONES,
+    REMINDER_FORGOT_AFTER,
+    REMINDER_BATCH_SIZE,
+)
+
+REMINDERS_SENT = metrics.Counter(
+    "aya_reminders_total", "Reminders handed to the sender.", ("kind",)
+)
+
+# the heap is rebuilt once it holds this many more entries than there are timers
+COMPACT_AFTER = 10000
+
+
+def milestone_text(hours):
+    return f"Du fastest jetzt seit {hours:g} Stunden. Weiter so 🙂."
+
+
+def forgot_text(hours):
+    return (
+        f"Du fastest seit {hours:g} Stunden. "
+        "Hast du vergessen, dein Fasten mit /ende zu beenden?"
+    )
+
+
+class ReminderScheduler:
+    """
+    Heap of (due, chat_id, seq) with one live entry per open fast.
+    A chat's steps (milestones, then the forgot-/ende nudge) are fired one after another:
+    when a step is due the next one is pushed. If several steps of a chat are due at once
+    (e.g. after downtime), only the latest one is fired. Rescheduled and cancelled timers stay in the
+    heap until they are popped (their seq no longer matches), so every update is O(log n).
+    """
+
+    def __init__(
+        self,
+        send,
+        milestones=REMINDER_MILESTONES,
+        forgot_after=REMINDER_FORGOT_AFTER,
+        batch_size=REMINDER_BATCH_SIZE,
+        clock=time.time,
+    ):
+        """
+        :param send: called with (chat_id, message_text, event_name) for every due reminder
+        :param clock: wall clock in secs, fasts start at local datetimes
+        """
+        self._send = send
+        self._steps = sorted(
+            [(hours * 3600, hours, "milestone") for hours in milestones]
+            + [(forgot_after * 3600, forgot_after, "forgot")]
+        )
+        self._batch_size = batch_size
+        self._clock = clock
+        self._heap = []
+        self._timers = {}  # chat_id -> (start of fast in secs, index of next step, seq)
+        self._seq = 0
+        self._condition = threading.Condition()
+        self._loading = False
+        self._ended_while_loading = set()
+        self._stopped = False
+        self._thread = None
+
+    def __len__(self):
+        return len(self._timers)
+
+    def schedule(self, chat_id, fast_start):
+        """
+        Set the timer of a fast, replacing the chat's previous one.
+        Milestones already passed are skipped.
+        :param fast_start: start of fast (datetime)
+        """
+        with self._condition:
+            self._ended_while_loading.discard(chat_id)
+            self._set(chat_id, fast_start.timestamp(), self._clock())
+
+    def cancel(self, chat_id):
+        with self._condition:
+            self._timers.pop(chat_id, None)
+            if self._loading:
+                self._ended_while_loading.add(chat_id)
+
+    def load(self, sessions):
+        """
+        Add timers for open fasts, keeping timers set or cancelled since loading began.
+        :param sessions: iterable of (chat_id, started_at)
+        """
+        now = self._clock()
+        with self._condition:
+            for chat_id, started_at in sessions:
+                if chat_id in self._timers or chat_id in self._ended_while_loading:
+                    continue
+                self._set(chat_id, started_at.timestamp(), now)
+            self._loading = False
+            self._ended_while_loading.clear()
+
+    def _set(self, chat_id, start, now):
+        index = 0
+        while index < len(self._steps) and start + self._steps[index][0] <= now:
+            index += 1
+        self._push(chat_id, start, index)
+
+    def _push(self, chat_id, start, index):
+        if index >= len(self._steps):
+            self._timers.pop(chat_id, None)
+            return
+        self._seq += 1
+        due = start + self._steps[index][0]
+        self._timers[chat_id] = (start, index, self._seq)
+        heapq.heappush(self._heap, (due, chat_id, self._seq))
+        if len(self._heap) > len(self._timers) + COMPACT_AFTER:
+            self._compact()
+        if self._heap[0][2] == self._seq:
+            self._condition.notify()
+
+    def _compact(self):
+        self._heap = [
+            (start + self._steps[index][0], chat_id, seq)
+            for chat_id, (start, index, seq) in self._timers.items()
+        ]
+        heapq.heapify(self._heap)
+
+    def pop_due(self, now=None):
+        """
+        Take up to batch_size due reminders and schedule the next step of their fasts.
+        Steps that were passed while their reminder waited are skipped.
+        :return: [(chat_id, message_text, event_name)]
+        """
+        now = self._clock() if now is None else now
+        due = []
+        with self._condition:
+            while self._heap and len(due) < self._batch_size:
+                at, chat_id, seq = self._heap[0]
+                if at > now:
+                    break
+                heapq.heappop(self._heap)
+                timer = self._timers.get(chat_id)
+                if timer is None or timer[2] != seq:
+                    continue
+                start, index, _ = timer
+                while (
+                    index + 1 < len(self._steps)
+                    and start + self._steps[index + 1][0] <= now
+                ):
+                    index += 1
+                _, hours, kind = self._steps[index]
+                if kind == "milestone":
+                    due.append((chat_id, milestone_text(hours), "fast_milestone"))
+                else:
+                    due.append((chat_id, forgot_text(hours), "fast_forgot_end"))
+                self._push(chat_id, start, index + 1)
+        return due
+
+    def _next_due_in(self):
+        while self._heap:
+            at, chat_id, seq = self._heap[0]
+            timer = self._timers.get(chat_id)
+            if timer is not None and timer[2] == seq:
+                return max(at - self._clock(), 0)
+            heapq.heappop(self._heap)
+        return None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._stopped:
+                    return
+                wait = self._next_due_in()
+                if wait is None or wait > 0:
+                    self._condition.wait(wait)
+                    continue
+            self._send_batch(self.pop_due())
+
+    def _send_batch(self, due):
+        for chat_id, message_text, event_name in due:
+            try:
+                self._send(chat_id, message_text, event_name)
+                REMINDERS_SENT.inc(kind=event_name)
+            except Exception as e:
+                metrics.ERRORS.inc(stage="reminders")
+                logging.exception(e)
+
+    def start(self, load_sessions=None):
+        """
+        :param load_sessions: returns the open fasts to load, called from the scheduler thread
+        """
+        self._loading = load_sessions is not None
+
+        def run():
+            if load_sessions is not None:
+                try:
+                    self.load(load_sessions())
+                    logging.info(f"loaded {len(self)} fasting reminders")
+                except Exception as e:
+                    logging.exception(e)
+                    with self._condition:
+                        self._loading = False
+            self._run()
+
+        # in the context of the bot that started it, so reminders are sent by that bot
+        name = current_bot_name()
+        self._thread = start_thread(
+            run, name=f"reminder_scheduler_{name}" if name else "reminder_scheduler"
+        )
+        return self
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._thread:
+            self._thread.join(timeout=1)
+
+
+_SCHEDULERS = {}  # bot name -> ReminderScheduler, "" outside of a bot's context
+_SCHEDULERS_LOCK = threading.Lock()
+
+
+def get_reminder_scheduler():
+    """
+    :return: the running ReminderScheduler of the current bot, None if reminders are off
+    """
+    return _SCHEDULERS.get(current_bot_name())
+
+
+def start_reminder_scheduler(send, owns_chat=None, **kwargs):
+    """
+    Start reminding the open fasts in fasting_sessions of the current bot.
+    :param send: called with (chat_id, message_text, event_name)
+    :param owns_chat: only remind chats for which this returns True, e.g. the chats of a shard
+    :rtype: ReminderScheduler
+    """
+
+    def load_sessions():
+        sessions = utils.load_open_fasting_sessions()
+        if owns_chat:
+            sessions = [s for s in sessions if owns_chat(s[0])]
+        return sessions
+
+    scheduler = ReminderScheduler(send, **kwargs).start(load_sessions)
+    with _SCHEDULERS_LOCK:
+        if not _SCHEDULERS:
+            metrics.Gauge(
+                "aya_reminder_timers",
+                "Open fasts with a pending reminder.",
+                lambda: sum(len(s) for s in list(_SCHEDULERS.values())),
+            )
+        _SCHEDULERS[current_bot_name()] = scheduler
+    logging.info("fasting reminders enabled")
+    return scheduler
@@ -0,0 +1,67 @@
+"""
+Multi-bot run mode: one process hosts every bot listed in BOTS (see bots.py), e.g. a
+production and a test bot, or one bot per fasting group. Each bot polls getUpdates in its own
+thread with its own offset, db schema and caches; the Telegram session, db pool, write buffer,
+send queue and metrics endpoint are shared, and metrics are labelled with the bot's name.
+Keep TELEGRAM_POOL_SIZE above the number of bots, every long poll holds a connection.
+If a bot stops, e.g. on an error, the process exits so that it is restarted with all its bots.
+Start with `BOTS=name:schema:token,... python run_multibot.py`.
+"""
+import logging
+import sys
+import threading
+import time
+
+from bots import bot_context, parse_bots
+from offset_store import get_offset_store
+from run_telegram import (
+    open_connection_to_telegram_chatbot,
+    start_bot_services,
+    start_shared_services,
+)
+from utils import SNAPSHOT_FILE
+
+
+def run_bot(bot):
+    """
+    Start the services of one bot and poll its updates, forever.
+    """
+    with bot_context(bot):
+        try:
+            start_bot_services(
+                snapshot_file=f"{SNAPSHOT_FILE}.{bot.name}" if SNAPSHOT_FILE else ""
+            )
+            open_connection_to_telegram_chatbot(offset_store=get_offset_store(bot.name))
+        except Exception as e:
+            logging.exception(e)
+
+
+def main(bots):
+    start_shared_services()
+    threads = [
+        threading.Thread(
+            target=run_bot, args=(bot,), name=f"bot_{bot.name}", daemon=True
+        )
+        for bot in bots
+    ]
+    for thread in threads:
+        thread.start()
+    logging.info(f"running bots {', '.join(bot.name for bot in bots)}")
+    # poll instead of join, so that the main thread still handles SIGTERM and ctrl-c
+    while all(thread.is_alive() for thread in threads):
+        time.sleep(1)
+    # the services of a bot can't be started twice in one process, so exit to be restarted,
+    # via sys.exit so that atexit handlers (e.g. flushing the write buffer) run
+    stopped = [thread.name for thread in threads if not thread.is_alive()]
+    sys.exit(f"{', '.join(stopped)} stopped, exiting")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)-8s [%(threadName)s] %(message)s",
+        level=logging.INFO,
+    )
+    bots = parse_bots()
+    if not bots:
+        sys.exit("set BOTS to name:schema:token,... to run several bots")
+    main(bots)
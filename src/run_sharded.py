@@ -0,0 +1,230 @@
+"""
+Sharded run mode: one poller process fetches updates and routes them to SHARD_WORKERS worker
+processes by chat_id, so updates of a chat are handled in order by the same worker while
+different chats use all cores. Each worker has its own db pool, caches and services.
+
+The next getUpdates offset is only committed to Telegram once every update of the batch
+has been acknowledged by its worker. Crashed or stuck workers are restarted and get their
+unacknowledged updates again, except for an update that brought its worker down
+SHARD_MAX_ATTEMPTS times: it is logged and dropped, so it can't block its shard forever.
+Start with `python run_sharded.py`.
+"""
+import logging
+import multiprocessing
+import queue
+import signal
+import time
+
+import metrics
+from offset_store import get_offset_store
+from telegram_listener import get_chat_id, get_incoming_messages_and_next_update_id
+from utils import SHARD_WORKERS, SHARD_ACK_TIMEOUT, SHARD_MAX_ATTEMPTS
+
+ERROR_BACKOFF_IN_SECS = 0.5
+# how often the poller checks worker health while waiting for acks
+HEALTH_CHECK_SECS = 1
+
+RESTARTS = metrics.Counter(
+    "aya_shard_worker_restarts_total", "Restarted shard workers.", ("worker",)
+)
+DROPPED = metrics.Counter(
+    "aya_shard_updates_dropped_total", "Updates given up on after SHARD_MAX_ATTEMPTS."
+)
+
+
+def shard_of(chat_id, workers):
+    """
+    :return: index of the worker that handles this chat
+    :rtype: int
+    """
+    return chat_id % workers if chat_id is not None else 0
+
+
+def worker_main(index, workers, updates, acks):
+    """
+    Handle updates of one shard until a None sentinel arrives.
+    """
+    logging.basicConfig(
+        format=f"%(asctime)s %(levelname)-8s [worker {index}] %(message)s",
+        level=logging.INFO,
+    )
+    # ctrl-c reaches the whole process group, the poller decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from run_telegram import process_update, start_services
+
+    start_services(
+        metrics_port=metrics.METRICS_PORT + 1 + index,
+        owns_chat=lambda chat_id: shard_of(chat_id, workers) == index,
+    )
+    while True:
+        incoming_message = updates.get()
+        if incoming_message is None:
+            return
+        process_update(incoming_message)
+        acks.put((index, incoming_message["update_id"]))
+
+
+class ShardSupervisor:
+    def __init__(
+        self,
+        workers=SHARD_WORKERS,
+        ack_timeout=SHARD_ACK_TIMEOUT,
+        max_attempts=SHARD_MAX_ATTEMPTS,
+    ):
+        self._context = multiprocessing.get_context("spawn")
+        self._acks = self._context.Queue()
+        self._ack_timeout = ack_timeout
+        self._max_attempts = max_attempts
+        self._queues = [None] * workers
+        self._processes = [None] * workers
+        # worker index -> {update_id: update} sent but not acknowledged yet
+        self._in_flight = [{} for _ in range(workers)]
+        # update_id -> workers it crashed or stalled, see _restart_worker()
+        self._attempts = {}
+        self._last_ack = [time.monotonic()] * workers
+
+    def start(self):
+        for index in range(len(self._processes)):
+            self._start_worker(index)
+        return self
+
+    def _start_worker(self, index):
+        self._queues[index] = self._context.Queue()
+        self._processes[index] = self._context.Process(
+            target=worker_main,
+            args=(index, len(self._queues), self._queues[index], self._acks),
+            name=f"shard_worker_{index}",
+        )
+        self._processes[index].start()
+        self._last_ack[index] = time.monotonic()
+        for update_id in sorted(self._in_flight[index]):
+            self._queues[index].put(self._in_flight[index][update_id])
+
+    def _restart_worker(self, index, reason):
+        in_flight = self._in_flight[index]
+        if in_flight:
+            # a worker handles its updates in order, so the oldest one brought it down
+            update_id = min(in_flight)
+            self._attempts[update_id] = self._attempts.get(update_id, 0) + 1
+            if self._attempts[update_id] >= self._max_attempts:
+                logging.error(
+                    f"dropping update {update_id} after {self._attempts[update_id]} "
+                    f"attempts: {in_flight[update_id]}"
+                )
+                DROPPED.inc()
+                self._ack(index, update_id)
+        logging.error(
+            f"restarting worker {index} ({reason}), resending {len(in_flight)} updates"
+        )
+        RESTARTS.inc(worker=index)
+        process = self._processes[index]
+        if process.is_alive():
+            process.kill()
+        process.join()
+        self._start_worker(index)
+
+    def submit(self, incoming_message):
+        index = shard_of(get_chat_id(incoming_message), len(self._processes))
+        if not self._in_flight[index]:
+            self._last_ack[index] = time.monotonic()
+        self._in_flight[index][incoming_message["update_id"]] = incoming_message
+        self._queues[index].put(incoming_message)
+
+    def wait_for_acks(self):
+        """
+        Block until every submitted update is acknowledged, restarting dead or stuck workers.
+        """
+        while any(self._in_flight):
+            try:
+                index, update_id = self._acks.get(timeout=HEALTH_CHECK_SECS)
+                self._ack(index, update_id)
+                self._last_ack[index] = time.monotonic()
+            except queue.Empty:
+                pass
+            self.check_health()
+
+    def _ack(self, index, update_id):
+        self._in_flight[index].pop(update_id, None)
+        self._attempts.pop(update_id, None)
+
+    def check_health(self):
+        for index, process in enumerate(self._processes):
+            if not process.is_alive():
+                self._restart_worker(index, f"exit code {process.exitcode}")
+            elif (
+                self._in_flight[index]
+                and time.monotonic() - self._last_ack[index] > self._ack_timeout
+            ):
+                self._restart_worker(index, f"no ack for {self._ack_timeout} secs")
+
+    def stop(self):
+        for worker_queue in self._queues:
+            worker_queue.put(None)
+        for process in self._processes:
+            process.join()
+
+
+class _StopPolling(Exception):
+    pass
+
+
+def open_connection_to_telegram_chatbot(supervisor):
+    """
+    Poll until SIGINT/SIGTERM. A signal interrupts a pending long poll right away,
+    but a batch in progress is finished and committed first.
+    The offset is saved after every acknowledged batch, so a restart resumes from there.
+    """
+    state = {"polling": False, "stopping": False}
+
+    def on_signal(signum, frame):
+        state["stopping"] = True
+        if state["polling"]:
+            raise _StopPolling()
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, on_signal)
+    offset_store = get_offset_store()
+    next_update_id = offset_store.load()
+    logging.info(f"starting sharded Telegram_Listener at offset {next_update_id}")
+    while not state["stopping"]:
+        try:
+            state["polling"] = True
+            with metrics.stage("get_updates"):
+                (
+                    incoming_messages,
+                    last_update_id,
+                ) = get_incoming_messages_and_next_update_id(offset=next_update_id)
+        except _StopPolling:
+            break
+        except Exception as e:
+            state["polling"] = False
+            logging.exception(e)
+            time.sleep(ERROR_BACKOFF_IN_SECS)
+            continue
+        finally:
+            state["polling"] = False
+        for incoming_message in incoming_messages:
+            supervisor.submit(incoming_message)
+        supervisor.wait_for_acks()
+        if last_update_id:
+            next_update_id = last_update_id
+            offset_store.save(next_update_id)
+        supervisor.check_health()
+    if next_update_id:
+        # confirm the last batch, so Telegram doesn't send it again after a restart
+        get_incoming_messages_and_next_update_id(
+            offset=next_update_id, limit=1, timeout=0
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)-8s [poller] %(message)s", level=logging.INFO
+    )
+    metrics.start_metrics_server()
+    supervisor = ShardSupervisor().start()
+    try:
+        open_connection_to_telegram_chatbot(supervisor)
+    finally:
+        logging.info("stopping workers")
+        supervisor.stop()
@@ -5,26 +5,142 @@ Open and maintain connection to Telegram chatbot.
 """
 
 import logging
+import metrics
+import signal
 import time
 import sys
-from telegram_listener import get_incoming_message_and_next_update_id, extract_main
-from telegram_sender import find_response
+from bots import current_bot_name
+from broadcast import start_broadcast_watch
+from telegram_listener import get_incoming_messages_and_next_update_id, extract_main
+from telegram_sender import find_response, _send_message_to_telegram
+from offset_store import RecentUpdateIds, get_offset_store
+from media_fetcher import start_media_fetcher
+from reminders import start_reminder_scheduler
+from send_dispatcher import start_send_dispatcher
+from user_directory import start_listener
+from startup import mark_update_processed, warm_start
+from update_profiler import command_of, profile_update, start_update_profiler
+from utils import (
+    WRITE_BEHIND,
+    SEND_QUEUE,
+    REMINDERS,
+    MEDIA_FETCH,
+    PROFILE_UPDATES,
+    SNAPSHOT_FILE,
+    check_message_dedup,
+    update_transaction,
+)
+from write_buffer import start_write_buffer
 
-def open_connection_to_telegram_chatbot(chat_id=None):
-    # last_update_id is used to make sure that messages are only retrieved once
-    next_update_id = None
-    logging.info(f"starting Telegram_Listener")
+# wait before polling again if getUpdates itself failed (e.g. network down)
+ERROR_BACKOFF_IN_SECS = 0.5
+
+RECENT_UPDATES = RecentUpdateIds()
+
+
+def open_connection_to_telegram_chatbot(chat_id=None, offset_store=None):
+    # next_update_id is used to make sure that messages are only retrieved once,
+    # it is saved after every batch so that a restart resumes from there
+    offset_store = offset_store or get_offset_store()
+    next_update_id = offset_store.load()
+    logging.info(f"starting Telegram_Listener at offset {next_update_id}")
     while True:
         try:
-            incoming_message, next_update_id = get_incoming_message_and_next_update_id(offset=next_update_id)
-            if incoming_message:
-                chat_id, message_text = extract_main(incoming_message)
-                find_response(chat_id, message_text)
+            with metrics.stage("get_updates"):
+                (
+                    incoming_messages,
+                    last_update_id,
+                ) = get_incoming_messages_and_next_update_id(offset=next_update_id)
+        except Exception as e:
+            logging.exception(e)
+            time.sleep(ERROR_BACKOFF_IN_SECS)
+            continue
+        for incoming_message in incoming_messages:
+            process_update(incoming_message)
+        if last_update_id:
+            next_update_id = last_update_id
+            offset_store.save(next_update_id)
+        sys.stdout.write(".")
+        sys.stdout.flush()
+
+
+def process_update(incoming_message):
+    """
+    Handle a single update in one db transaction, see utils.update_transaction().
+    Errors are logged so that the rest of the batch is still handled.
+    :param incoming_message: incoming message as json, in Telegram message format.
+    :return: None
+    """
+    if RECENT_UPDATES.seen((current_bot_name(), incoming_message["update_id"])):
+        logging.info(f"skipping duplicate update {incoming_message['update_id']}")
+        return
+    metrics.UPDATES.inc()
+    with profile_update(incoming_message["update_id"]) as capture:
+        try:
+            with update_transaction():
+                with metrics.stage("extract_main"), capture.stage("extract_main"):
+                    chat_id, message_text = extract_main(incoming_message)
+                capture.command = command_of(message_text)
+                if chat_id:
+                    with metrics.stage("find_response"), capture.stage("find_response"):
+                        find_response(chat_id, message_text)
         except Exception as e:
             logging.exception(e)
-        time.sleep(0.5)
-        sys.stdout.write('.'); sys.stdout.flush()
+    mark_update_processed()
+
+
+def start_services(metrics_port=metrics.METRICS_PORT, owns_chat=None):
+    """
+    Start the optional background services and warm caches. Shared by all run modes.
+    Nothing connects to the db before this is called.
+    :param metrics_port: port of the metrics endpoint, processes running side by side need their own
+    :param owns_chat: returns True for the chats this process handles, if it doesn't handle all
+    """
+    start_shared_services(metrics_port)
+    start_bot_services(owns_chat)
+
+
+def start_shared_services(metrics_port=metrics.METRICS_PORT):
+    """
+    Start the services shared by all bots of the process.
+    The send queue is started after the write buffer, so at exit it is drained first
+    and the saved outgoing messages still make it into the buffer.
+    """
+    # exit via sys.exit on SIGTERM so that atexit handlers (e.g. flushing the write buffer) run
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if WRITE_BEHIND:
+        start_write_buffer()
+    if SEND_QUEUE:
+        start_send_dispatcher()
+    if MEDIA_FETCH:
+        start_media_fetcher()
+    if PROFILE_UPDATES:
+        start_update_profiler()
+    metrics.start_metrics_server(port=metrics_port)
+
+
+def start_bot_services(owns_chat=None, snapshot_file=SNAPSHOT_FILE):
+    """
+    Start the services of the current bot (see bots.py) and warm its caches.
+    :param snapshot_file: see startup.warm_start()
+    """
+    start_listener()
+    check_message_dedup()
+    warm_start(snapshot_file)
+    if SEND_QUEUE:
+        start_broadcast_watch()
+    if REMINDERS:
+        start_reminder_scheduler(
+            lambda chat_id, text, event_name: _send_message_to_telegram(
+                chat_id, text, event_name=event_name
+            ),
+            owns_chat=owns_chat,
+        )
+
 
-if __name__ == '__main__':
-    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO)
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)-8s %(message)s", level=logging.INFO
+    )
+    start_services()
     open_connection_to_telegram_chatbot()
@@ -0,0 +1,242 @@
+"""
+Asyncio run mode: keep long polling while updates of different chats are handled concurrently.
+Updates of the same chat are still handled one after another in update_id order.
+Polling pauses while ASYNC_MAX_PENDING updates wait to be handled, so a backlog stays at Telegram.
+Start with `python run_telegram_async.py`; `run_telegram.py` stays the synchronous entry point.
+"""
+
+import asyncio
+import logging
+import signal
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+import metrics
+from offset_store import get_offset_store
+from run_telegram import process_update, start_services
+from telegram_client import TelegramApiError, get_client
+from telegram_listener import get_chat_id, _get_incoming_messages_and_next_update_id
+from utils import (
+    POLL_LIMIT,
+    POLL_TIMEOUT,
+    TELEGRAM_CONNECT_TIMEOUT,
+    TELEGRAM_READ_TIMEOUT,
+    ASYNC_CONCURRENCY,
+    ASYNC_DRAIN_TIMEOUT,
+    ASYNC_MAX_PENDING,
+    DB_POOL_MAX,
+)
+
+ERROR_BACKOFF_IN_SECS = 0.5
+
+
+class ChatScheduler:
+    """
+    Run handlers concurrently across chats, at most `concurrency` at a time.
+    Each update waits for the previous update of its chat, so per-chat order is kept.
+    """
+
+    def __init__(self, handle, concurrency=ASYNC_CONCURRENCY):
+        self._handle = handle
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._tails = {}  # chat_id -> task of the latest update of that chat
+        self._tasks = set()  # tasks of the updates not handled yet
+
+    def submit(self, chat_id, incoming_message):
+        previous = self._tails.get(chat_id)
+        task = asyncio.ensure_future(self._run(previous, incoming_message))
+        self._tails[chat_id] = task
+        self._tasks.add(task)
+        task.add_done_callback(lambda t: self._forget(chat_id, t))
+        return task
+
+    async def _run(self, previous, incoming_message):
+        if previous:
+            await asyncio.wait([previous])
+        async with self._semaphore:
+            try:
+                await self._handle(incoming_message)
+            except Exception as e:
+                logging.exception(e)
+
+    def _forget(self, chat_id, task):
+        self._tasks.discard(task)
+        if self._tails.get(chat_id) is task:
+            del self._tails[chat_id]
+
+    @property
+    def pending(self):
+        """Number of submitted updates not handled yet."""
+        return len(self._tasks)
+
+    async def wait_for_room(self, max_pending):
+        """
+        Wait until fewer than max_pending updates are pending.
+        """
+        while len(self._tasks) >= max_pending:
+            await asyncio.wait(list(self._tasks), return_when=asyncio.FIRST_COMPLETED)
+
+    async def cancel(self):
+        """
+        Cancel the updates not handled yet, e.g. after a drain timed out.
+        A handler already running in a thread finishes, but isn't waited for.
+        """
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def drain(self, timeout=None):
+        """
+        Wait until all submitted updates are handled.
+        :return: True if drained within timeout
+        """
+        tails = list(self._tails.values())
+        if not tails:
+            return True
+        _, not_done = await asyncio.wait(tails, timeout=timeout)
+        return not not_done
+
+
+async def get_incoming_messages_and_next_update_id(
+    session, offset=None, limit=POLL_LIMIT, timeout=POLL_TIMEOUT
+):
+    """
+    Async counterpart of telegram_listener.get_incoming_messages_and_next_update_id.
+    :param session: aiohttp.ClientSession
+    :return: incoming messages sorted by update_id + next update id
+    :rtype: list, int
+    """
+    params = {"timeout": timeout, "limit": limit}
+    if offset:
+        params["offset"] = offset
+    client_timeout = aiohttp.ClientTimeout(
+        sock_connect=TELEGRAM_CONNECT_TIMEOUT, total=TELEGRAM_READ_TIMEOUT + timeout
+    )
+    async with session.get(
+        get_client().base_url + "getUpdates", params=params, timeout=client_timeout
+    ) as response:
+        js = await response.json(content_type=None)
+    if not js.get("ok"):
+        raise TelegramApiError(js)
+    return _get_incoming_messages_and_next_update_id(js)
+
+
+async def _unless_stopped(awaitable, stop):
+    """
+    :return: the done task of awaitable, None if stop was set first (awaitable is cancelled)
+    """
+    task = asyncio.ensure_future(awaitable)
+    stopped = asyncio.ensure_future(stop.wait())
+    await asyncio.wait([task, stopped], return_when=asyncio.FIRST_COMPLETED)
+    stopped.cancel()
+    if not task.done():
+        task.cancel()
+        return None
+    return task
+
+
+async def _save_offset_when_handled(offset_store, tasks, next_update_id, previous):
+    """
+    Save the offset of a batch once its updates and all earlier batches are handled.
+    """
+    if previous:
+        await previous
+    if tasks:
+        await asyncio.wait(tasks)
+    await asyncio.get_running_loop().run_in_executor(
+        None, offset_store.save, next_update_id
+    )
+
+
+async def open_connection_to_telegram_chatbot(
+    concurrency=ASYNC_CONCURRENCY,
+    drain_timeout=ASYNC_DRAIN_TIMEOUT,
+    offset_store=None,
+    max_pending=ASYNC_MAX_PENDING,
+):
+    """
+    Poll until SIGINT/SIGTERM, then stop polling and drain the updates already received.
+    Handlers are the synchronous extract_main/find_response pipeline, run on a thread pool
+    of `concurrency` threads that share the pooled db connections.
+    The offset of a batch is saved once the batch is handled, so a restart resumes from there.
+    At most max_pending updates are fetched ahead of the handlers.
+    The concurrency is capped at DB_POOL_MAX: more handlers would only queue for a connection
+    and time out in get_pool() under load.
+    """
+    if concurrency > DB_POOL_MAX:
+        logging.warning(
+            f"concurrency {concurrency} exceeds DB_POOL_MAX, using {DB_POOL_MAX}"
+        )
+        concurrency = DB_POOL_MAX
+    max_pending = max(max_pending, 1)
+    offset_store = offset_store or get_offset_store()
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    async def handle(incoming_message):
+        await loop.run_in_executor(executor, process_update, incoming_message)
+
+    scheduler = ChatScheduler(handle, concurrency)
+    next_update_id = offset_store.load()
+    commit = None
+    logging.info(
+        f"starting async Telegram_Listener at offset {next_update_id}, concurrency={concurrency}"
+    )
+    async with aiohttp.ClientSession() as session:
+        while not stop.is_set():
+            # handlers lag behind: leave further updates at Telegram until they catch up
+            if not await _unless_stopped(scheduler.wait_for_room(max_pending), stop):
+                break
+            poll = await _unless_stopped(
+                get_incoming_messages_and_next_update_id(
+                    session,
+                    next_update_id,
+                    limit=min(POLL_LIMIT, max_pending - scheduler.pending),
+                ),
+                stop,
+            )
+            if not poll:
+                break
+            try:
+                incoming_messages, last_update_id = poll.result()
+            except Exception as e:
+                metrics.ERRORS.inc(stage="get_updates")
+                logging.exception(e)
+                await asyncio.sleep(ERROR_BACKOFF_IN_SECS)
+                continue
+            tasks = [
+                scheduler.submit(get_chat_id(incoming_message), incoming_message)
+                for incoming_message in incoming_messages
+            ]
+            if last_update_id:
+                next_update_id = last_update_id
+                commit = asyncio.ensure_future(
+                    _save_offset_when_handled(
+                        offset_store, tasks, next_update_id, commit
+                    )
+                )
+
+    logging.info(f"draining {scheduler.pending} updates")
+    if not await scheduler.drain(drain_timeout):
+        logging.warning(f"drain timed out after {drain_timeout} secs")
+        # otherwise handlers finishing later report to the closed event loop
+        await scheduler.cancel()
+        if commit:
+            commit.cancel()
+    elif commit:
+        await commit
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)-8s %(message)s", level=logging.INFO
+    )
+    start_services()
+    asyncio.run(open_connection_to_telegram_chatbot())
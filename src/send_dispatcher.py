@@ -0,0 +1,401 @@
+"""
+Rate-limited outbound queue for sendMessage.
+Keeps within Telegram's limits (about 30 msgs/s per bot token, 1 msg/s per chat) with token
+buckets, and reschedules messages answered with 429 after the retry_after Telegram asks for,
+so bursts are delayed instead of lost. Messages of one chat are sent in order.
+When one process hosts several bots (see bots.py), every bot has its own limits and queues.
+"""
+import atexit
+import contextvars
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+import metrics
+from bots import current_bot_name
+from telegram_client import TelegramApiError, get_client
+from utils import (
+    SEND_RATE_GLOBAL,
+    SEND_BURST_GLOBAL,
+    SEND_RATE_PER_CHAT,
+    SEND_BURST_PER_CHAT,
+    SEND_WORKERS,
+    SEND_MAX_ATTEMPTS,
+    SEND_DRAIN_TIMEOUT,
+)
+
+SEND_LATENCY = metrics.Histogram(
+    "aya_send_queue_latency_seconds", "Secs from queueing a message until it was sent."
+)
+
+# idle per-chat buckets are pruned once more than this many chats are tracked
+MAX_IDLE_CHAT_BUCKETS = 10000
+
+
+class TokenBucket:
+    """
+    `rate` tokens per sec, at most `capacity` stored.
+    """
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._tokens = capacity
+        self._updated = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def wait_time(self):
+        """
+        :return: secs until a token is available, 0 if one is available now
+        """
+        self._refill()
+        return max(0.0, (1 - self._tokens) / self.rate)
+
+    def take(self):
+        self._refill()
+        self._tokens -= 1
+
+    def pause(self, secs):
+        """
+        Hand out no tokens for the next `secs` secs, e.g. after Telegram asked to retry later.
+        """
+        self._refill()
+        self._tokens = min(self._tokens, 1 - secs * self.rate)
+
+    def set_rate(self, rate, capacity):
+        self._refill()
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = min(self._tokens, capacity)
+
+    @property
+    def full(self):
+        self._refill()
+        return self._tokens >= self.capacity
+
+
+class OutboundMessage:
+    __slots__ = (
+        "bot",
+        "chat_id",
+        "text",
+        "reply_markup",
+        "on_sent",
+        "on_dropped",
+        "queued_at",
+        "attempts",
+        "context",
+    )
+
+    def __init__(self, chat_id, text, reply_markup=None, on_sent=None, on_dropped=None):
+        self.bot = current_bot_name()
+        self.chat_id = chat_id
+        self.text = text
+        self.reply_markup = reply_markup
+        self.on_sent = on_sent
+        self.on_dropped = on_dropped
+        self.queued_at = time.monotonic()
+        self.attempts = 0
+        # sent and reported back as the bot that queued it, see bots.py
+        self.context = contextvars.copy_context()
+
+    @property
+    def key(self):
+        """(bot name, chat_id), the queue of the message"""
+        return self.bot, self.chat_id
+
+
+class SendDispatcher:
+    """
+    Per-chat FIFO queues plus, per bot, a heap of (ready_at, seq, (bot, chat_id)) for chats that
+    have messages and are not being sent to right now. Worker threads pop the earliest ready chat
+    of a bot whose global token bucket has a token, and send the chat's oldest message.
+    """
+
+    def __init__(
+        self,
+        send=None,
+        global_rate=SEND_RATE_GLOBAL,
+        global_burst=SEND_BURST_GLOBAL,
+        chat_rate=SEND_RATE_PER_CHAT,
+        chat_burst=SEND_BURST_PER_CHAT,
+        workers=SEND_WORKERS,
+        max_attempts=SEND_MAX_ATTEMPTS,
+    ):
+        self._send = send or (
+            lambda message: get_client().send_message(
+                message.chat_id, message.text, reply_markup=message.reply_markup
+            )
+        )
+        self._global_rate = global_rate
+        self._global_burst = global_burst
+        self._global_buckets = {}  # bot name -> TokenBucket
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._chat_buckets = {}  # (bot name, chat_id) -> TokenBucket
+        self._chats = {}  # (bot name, chat_id) -> deque of OutboundMessage
+        self._heaps = {}  # bot name -> heap
+        self._seq = itertools.count()
+        self._condition = threading.Condition()
+        self._max_attempts = max_attempts
+        self._stopped = False
+        self._threads = [
+            threading.Thread(target=self._run, name=f"send_dispatcher_{i}", daemon=True)
+            for i in range(workers)
+        ]
+        self.stats = {
+            "sent": 0,
+            "retries": 0,
+            "rate_limited": 0,
+            "dropped": 0,
+            "latency_secs_total": 0.0,
+            "latency_secs_max": 0.0,
+        }
+        self._depth = 0
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    @property
+    def depth(self):
+        """Number of queued messages, including ones being sent."""
+        return self._depth
+
+    @property
+    def global_rate(self):
+        """msgs/s of the current bot"""
+        with self._condition:
+            return self._global_bucket(current_bot_name()).rate
+
+    def set_global_rate(self, rate):
+        """
+        Change the msgs/s of the current bot, e.g. while a broadcast shares the bot's limit.
+        The burst is capped at one sec worth of messages.
+        """
+        with self._condition:
+            bucket = self._global_bucket(current_bot_name())
+            bucket.set_rate(rate, min(self._global_burst, rate))
+            self._condition.notify_all()
+
+    def _global_bucket(self, bot):
+        bucket = self._global_buckets.get(bot)
+        if bucket is None:
+            bucket = self._global_buckets[bot] = TokenBucket(
+                self._global_rate, self._global_burst
+            )
+        return bucket
+
+    def _chat_bucket(self, key):
+        bucket = self._chat_buckets.get(key)
+        if bucket is None:
+            bucket = self._chat_buckets[key] = TokenBucket(
+                self._chat_rate, self._chat_burst
+            )
+        return bucket
+
+    def submit(self, chat_id, text, reply_markup=None, on_sent=None, on_dropped=None):
+        """
+        Queue a message.
+        :param on_sent: called with Telegram's response once the message was sent
+        :param on_dropped: called once the message is given up on
+        """
+        message = OutboundMessage(chat_id, text, reply_markup, on_sent, on_dropped)
+        key = message.key
+        with self._condition:
+            self._depth += 1
+            if key in self._chats:
+                self._chats[key].append(message)
+                return
+            self._chats[key] = deque([message])
+            self._schedule(key, time.monotonic())
+            if len(self._chat_buckets) > MAX_IDLE_CHAT_BUCKETS:
+                self._prune_buckets()
+
+    def _schedule(self, key, ready_at):
+        heap = self._heaps.setdefault(key[0], [])
+        heapq.heappush(heap, (ready_at, next(self._seq), key))
+        self._condition.notify()
+
+    def _prune_buckets(self):
+        for key in [
+            key
+            for key, bucket in self._chat_buckets.items()
+            if key not in self._chats and bucket.full
+        ]:
+            del self._chat_buckets[key]
+
+    def _next_message(self):
+        """
+        Block until a chat is ready and both buckets have a token.
+        :return: message to send, None once stopped and empty
+        """
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                delays = [
+                    (
+                        max(
+                            self._head_delay(heap, now),
+                            self._global_bucket(bot).wait_time(),
+                        ),
+                        bot,
+                    )
+                    for bot, heap in self._heaps.items()
+                    if heap
+                ]
+                if not delays:
+                    if self._stopped:
+                        return None
+                    self._condition.wait()
+                    continue
+                delay, bot = min(delays)
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                _, _, key = heapq.heappop(self._heaps[bot])
+                self._chat_bucket(key).take()
+                self._global_bucket(bot).take()
+                return self._chats[key][0]
+
+    def _head_delay(self, heap, now):
+        """
+        :return: secs until the first chat of a bot's heap can be sent to. Chats waiting for
+            their own bucket are moved back, so that other chats go first.
+        """
+        while True:
+            ready_at, _, key = heap[0]
+            if ready_at > now:
+                return ready_at - now
+            chat_delay = self._chat_bucket(key).wait_time()
+            if chat_delay <= 0:
+                return 0
+            heapq.heapreplace(heap, (now + chat_delay, next(self._seq), key))
+
+    def _run(self):
+        while True:
+            message = self._next_message()
+            if message is None:
+                return
+            message.attempts += 1
+            try:
+                response = message.context.run(self._send, message)
+            except TelegramApiError as e:
+                if e.error_code == 429:
+                    # the limit is per bot, so every chat of the bot waits, not only this one
+                    retry_after = e.parameters.get("retry_after", 1)
+                    with self._condition:
+                        self.stats["rate_limited"] += 1
+                        self._global_bucket(message.bot).pause(retry_after)
+                    self._retry(message, retry_after, count_attempt=False)
+                elif e.error_code and 400 <= e.error_code < 500:
+                    # e.g. the user blocked the bot, retrying won't help
+                    logging.warning(f"dropping message to {message.chat_id}: {e}")
+                    self._done(message, sent=False)
+                else:
+                    self._retry(message, 2**message.attempts)
+                continue
+            except Exception as e:
+                logging.exception(e)
+                self._retry(message, 2**message.attempts)
+                continue
+            self._done(message, sent=True)
+            if message.on_sent:
+                try:
+                    message.context.run(message.on_sent, response)
+                except Exception as e:
+                    logging.exception(e)
+
+    def _retry(self, message, delay, count_attempt=True):
+        if not count_attempt:
+            message.attempts -= 1
+        if message.attempts >= self._max_attempts:
+            logging.error(
+                f"dropping message to {message.chat_id} after {message.attempts} attempts"
+            )
+            self._done(message, sent=False)
+            return
+        with self._condition:
+            self.stats["retries"] += 1
+            self._schedule(message.key, time.monotonic() + delay)
+
+    def _done(self, message, sent):
+        latency = time.monotonic() - message.queued_at
+        with self._condition:
+            self._depth -= 1
+            if sent:
+                SEND_LATENCY.observe(latency)
+                self.stats["sent"] += 1
+                self.stats["latency_secs_total"] += latency
+                self.stats["latency_secs_max"] = max(
+                    self.stats["latency_secs_max"], latency
+                )
+            else:
+                self.stats["dropped"] += 1
+            pending = self._chats[message.key]
+            pending.popleft()
+            if pending:
+                self._schedule(message.key, time.monotonic())
+            else:
+                del self._chats[message.key]
+            self._condition.notify_all()
+        if not sent and message.on_dropped:
+            try:
+                message.context.run(message.on_dropped)
+            except Exception as e:
+                logging.exception(e)
+
+    def stop(self, timeout=SEND_DRAIN_TIMEOUT):
+        """
+        Send what is queued (for up to timeout secs), then stop the workers.
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self._depth and time.monotonic() < deadline:
+                self._condition.wait(deadline - time.monotonic())
+            if self._depth:
+                logging.warning(f"stopping with {self._depth} unsent messages")
+            self._stopped = True
+            self._heaps.clear()
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=1)
+
+
+_DISPATCHER = None
+metrics.Gauge(
+    "aya_send_queue_depth",
+    "Messages waiting to be sent.",
+    lambda: _DISPATCHER.depth if _DISPATCHER else None,
+)
+
+
+def get_dispatcher():
+    """
+    :return: the running SendDispatcher, None if messages are sent directly
+    """
+    return _DISPATCHER
+
+
+def start_send_dispatcher(**kwargs):
+    """
+    Start a dispatcher and queue all outgoing messages of _send_message_to_telegram through it.
+    Queued messages are sent before the interpreter exits.
+    :rtype: SendDispatcher
+    """
+    global _DISPATCHER
+    _DISPATCHER = SendDispatcher(**kwargs).start()
+    atexit.register(_DISPATCHER.stop)
+    logging.info("rate-limited send queue enabled")
+    return _DISPATCHER
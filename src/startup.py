@@ -0,0 +1,137 @@
+"""
+Fast application start: the in-memory caches (user names, fasting state) are warmed from a
+local snapshot file and refreshed from the db in a background thread, so the first updates
+don't wait for the db. The snapshot is written again after the refresh and at exit.
+The time from process start to the first processed update is logged and exported as a metric.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import os
+import time
+from datetime import datetime
+
+import metrics
+import utils
+from bots import start_thread
+from user_directory import get_user_directory
+from fasting_cache import MISSING
+from utils import SNAPSHOT_FILE, get_fasting_cache
+
+_FIRST_UPDATE = {"secs": None}
+metrics.Gauge(
+    "aya_startup_seconds",
+    "Secs from process start to the first processed update.",
+    lambda: _FIRST_UPDATE["secs"] or 0,
+)
+
+
+def save_snapshot(path=SNAPSHOT_FILE):
+    """
+    Write the cached users and fasting state of the current bot to `path`.
+    """
+    snapshot = {
+        "saved_at": datetime.now().isoformat(),
+        "users": get_user_directory().items(),
+        "fasting": [
+            [chat_id, fast_start.isoformat() if fast_start else None]
+            for chat_id, fast_start in get_fasting_cache().items()
+        ],
+    }
+    # write and rename, so a crash never leaves a half-written snapshot behind.
+    # Processes sharing the snapshot (run_sharded.py) write their own tmp file.
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path=SNAPSHOT_FILE):
+    """
+    Warm the caches from the snapshot at `path`. A missing or unreadable snapshot is skipped.
+    :return: the users and fasting states of the snapshot, None if there was none
+    :rtype: dict
+    """
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+        users = [(telegram_id, name) for telegram_id, name in snapshot["users"]]
+        fasting = [
+            (chat_id, datetime.fromisoformat(fast_start) if fast_start else None)
+            for chat_id, fast_start in snapshot["fasting"]
+        ]
+    except FileNotFoundError:
+        return None
+    except (ValueError, KeyError, TypeError) as e:
+        logging.warning(f"ignoring snapshot {path}: {e}")
+        return None
+    get_user_directory().warm(users)
+    get_fasting_cache().warm(fasting)
+    logging.info(
+        f"warmed caches with {len(users)} users and {len(fasting)} chats "
+        f"from snapshot of {snapshot.get('saved_at')}"
+    )
+    return {"saved_at": snapshot.get("saved_at"), "users": users, "fasting": fasting}
+
+
+def refresh_caches(snapshot=None, path=SNAPSHOT_FILE):
+    """
+    Bring the caches up to date with the db, then save a new snapshot.
+    Fasts and names from the snapshot may have changed while the bot was down:
+    users are reloaded and fasts that are no longer open are dropped from the cache.
+    Updates are handled while this runs, so only entries that are still as loaded from the
+    snapshot (or not cached at all) are replaced, not ones an update changed meanwhile.
+    :param snapshot: as returned by load_snapshot()
+    """
+    cache = get_fasting_cache()
+    snapshot_fasting = dict(snapshot["fasting"]) if snapshot else {}
+    open_sessions = utils.load_open_fasting_sessions(limit=cache.max_size)
+    for chat_id, fast_start in open_sessions:
+        cache.replace(chat_id, snapshot_fasting.get(chat_id, MISSING), fast_start)
+    open_chats = {chat_id for chat_id, _ in open_sessions}
+    for chat_id, fast_start in snapshot_fasting.items():
+        if fast_start and chat_id not in open_chats:
+            cache.replace(chat_id, fast_start, MISSING)
+    if snapshot:
+        directory = get_user_directory()
+        snapshot_names = dict(snapshot["users"])
+        names = utils.load_user_names(list(snapshot_names))
+        for telegram_id, name in snapshot_names.items():
+            directory.replace(telegram_id, name, names.get(telegram_id))
+    logging.info(f"refreshed caches, {len(cache)} chats cached")
+    if path:
+        save_snapshot(path)
+
+
+def warm_start(path=SNAPSHOT_FILE):
+    """
+    Warm the caches from the snapshot and refresh them from the db in a daemon thread.
+    Without a snapshot path the caches are warmed from the db right away.
+    Called in a bot's context (see bots.py), the caches of that bot are warmed and saved.
+    """
+    if not path:
+        utils.warm_fasting_cache()
+        return
+    snapshot = load_snapshot(path)
+
+    def refresh():
+        try:
+            refresh_caches(snapshot, path)
+        except Exception as e:
+            logging.exception(e)
+
+    start_thread(refresh, name="cache_refresh")
+    atexit.register(contextvars.copy_context().run, save_snapshot, path)
+
+
+def mark_update_processed():
+    """
+    Record the startup time when the first update of the process is processed.
+    """
+    if _FIRST_UPDATE["secs"] is not None:
+        return
+    _FIRST_UPDATE["secs"] = time.monotonic() - metrics.PROCESS_STARTED
+    logging.info(
+        f"first update processed {_FIRST_UPDATE['secs']:.3f} secs after process start"
+    )
@@ -0,0 +1,195 @@
+"""
+Shared HTTP client for the Telegram Bot API.
+"""
+import json
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from bots import current_bot
+
+from utils import (
+    URL,
+    TELEGRAM_CONNECT_TIMEOUT,
+    TELEGRAM_READ_TIMEOUT,
+    TELEGRAM_RETRIES,
+    TELEGRAM_POOL_SIZE,
+)
+
+
+class TelegramApiError(Exception):
+    """Telegram answered with {"ok": false, ...}."""
+
+    def __init__(self, js):
+        self.error_code = js.get("error_code")
+        self.description = js.get("description")
+        self.parameters = js.get("parameters") or {}
+        super().__init__(f"{self.error_code}: {self.description}")
+
+
+class TelegramClient:
+    """
+    Telegram api client on one keep-alive requests.Session,
+    so TLS handshakes to api.telegram.org are paid once per pooled connection instead of per call.
+    """
+
+    def __init__(
+        self,
+        base_url=URL,
+        connect_timeout=TELEGRAM_CONNECT_TIMEOUT,
+        read_timeout=TELEGRAM_READ_TIMEOUT,
+        retries=TELEGRAM_RETRIES,
+        pool_size=TELEGRAM_POOL_SIZE,
+        session=None,
+    ):
+        self.base_url = base_url
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.session = session or _build_session(retries, pool_size)
+
+    def call(self, method, params=None, json_body=None, read_timeout=None):
+        """
+        Call a Telegram api method. More details here: https://core.telegram.org/bots/api#making-requests
+        :param method: name of api method, e.g. "getUpdates"
+        :param params: query parameters, sent with GET
+        :param json_body: json body, sent with POST
+        :param read_timeout: overrides the default read timeout (e.g. for long polling)
+        :return: Telegram response
+        :rtype: dict
+        """
+        timeout = (self.connect_timeout, read_timeout or self.read_timeout)
+        if json_body is None:
+            response = self.session.get(
+                self.base_url + method, params=params, timeout=timeout
+            )
+        else:
+            response = self.session.post(
+                self.base_url + method, json=json_body, timeout=timeout
+            )
+        js = json.loads(response.content.decode("utf8"))
+        if not js.get("ok"):
+            raise TelegramApiError(js)
+        return js
+
+    def get_updates(self, offset=None, limit=100, timeout=0):
+        """
+        Long poll for updates. More details here: https://core.telegram.org/bots/api#getupdates
+        """
+        params = {"timeout": timeout, "limit": limit}
+        if offset:
+            params["offset"] = offset
+        return self.call(
+            "getUpdates", params=params, read_timeout=self.read_timeout + timeout
+        )
+
+    def answer_callback_query(self, callback_query_id):
+        return self.call(
+            "answerCallbackQuery", params={"callback_query_id": callback_query_id}
+        )
+
+    def set_webhook(self, url, secret_token=None, max_connections=None):
+        """
+        Let Telegram POST updates to url. More details here: https://core.telegram.org/bots/api#setwebhook
+        """
+        body = {"url": url}
+        if secret_token:
+            body["secret_token"] = secret_token
+        if max_connections:
+            body["max_connections"] = max_connections
+        return self.call("setWebhook", json_body=body)
+
+    def delete_webhook(self):
+        return self.call("deleteWebhook", json_body={})
+
+    def get_file(self, file_id):
+        """
+        Resolve a file_id to a file_path to download from. More details here: https://core.telegram.org/bots/api#getfile
+        """
+        return self.call("getFile", params={"file_id": file_id})
+
+    def download_file(self, file_path, f, chunk_size=64 * 1024):
+        """
+        Stream a file into the open binary file f, chunk by chunk.
+        :param file_path: file_path of get_file()
+        :return: number of bytes written
+        :rtype: int
+        """
+        url = self.base_url.replace("/bot", "/file/bot", 1) + file_path
+        written = 0
+        with self.session.get(
+            url, stream=True, timeout=(self.connect_timeout, self.read_timeout)
+        ) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size):
+                f.write(chunk)
+                written += len(chunk)
+        return written
+
+    def send_message(self, chat_id, text, reply_markup=None):
+        """
+        Send text as HTML without web page preview. More details here: https://core.telegram.org/bots/api#sendmessage
+        :param reply_markup: dict or json string, defaults to removing the custom keyboard
+        """
+        if isinstance(reply_markup, str):
+            reply_markup = json.loads(reply_markup)
+        body = {
+            "chat_id": chat_id,
+            "text": text,
+            "parse_mode": "HTML",
+            "disable_web_page_preview": True,
+            "reply_markup": reply_markup or {"remove_keyboard": True},
+        }
+        return self.call("sendMessage", json_body=body)
+
+
+def _build_session(retries, pool_size):
+    """
+    Session with a pooled HTTPAdapter. Connection errors are retried for every method;
+    5xx answers only for GET, so a sendMessage is never sent twice.
+    """
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=0,
+        status=retries,
+        backoff_factor=0.3,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset({"GET"}),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+_CLIENT = None
+_BOT_CLIENTS = {}  # bot name -> TelegramClient on the session of _CLIENT
+_CLIENT_LOCK = threading.Lock()
+
+
+def get_client():
+    """
+    Shared Telegram client, created on first use.
+    In a bot's context (see bots.py) the client calls that bot's api url, on the same session
+    and connection pool as every other bot.
+    :rtype: TelegramClient
+    """
+    global _CLIENT
+    bot = current_bot()
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            _CLIENT = TelegramClient()
+        if bot is None:
+            return _CLIENT
+        client = _BOT_CLIENTS.get(bot.name)
+        if client is None or client.session is not _CLIENT.session:
+            client = _BOT_CLIENTS[bot.name] = TelegramClient(
+                base_url=bot.url,
+                connect_timeout=_CLIENT.connect_timeout,
+                read_timeout=_CLIENT.read_timeout,
+                session=_CLIENT.session,
+            )
+    return client
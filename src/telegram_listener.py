@@ -4,12 +4,22 @@ Functions to listen for incoming messages from Telegram.
 
 import os
 from os.path import join, dirname
-import requests
 import json
 import logging
 from datetime import datetime
+from functools import partial
 
-from utils import URL, write_msg_to_db, convert_secs_to_datetime
+from media_fetcher import get_media_fetcher
+from telegram_client import get_client
+from utils import (
+    POLL_LIMIT,
+    POLL_TIMEOUT,
+    MEDIA_PHOTO_MAX_BYTES,
+    MEDIA_PHOTO_MAX_SIDE,
+    after_commit,
+    write_msg_to_db,
+    convert_secs_to_datetime,
+)
 
 
 def get_incoming_message_and_next_update_id(offset=None):
@@ -34,30 +44,33 @@ def get_incoming_message_and_next_update_id(offset=None):
         + next update id (min(update_id)+1 in incoming msgs)
     :rtype: json, int
     """
-    url = URL + "getUpdates?timeout=600"
-    if offset:
-        url += "&offset={}".format(offset)
-    
-    js = _call_telegram_url(url)
+    js = get_client().get_updates(offset=offset, timeout=600)
     incoming_message, next_update_id = _get_incoming_message_and_next_update_id(js)
     
     return incoming_message, next_update_id
 
 
-def _call_telegram_url(url):
+def get_incoming_messages_and_next_update_id(offset=None, limit=None, timeout=None):
     """
-    Call Telegram url and return response.
-    :param url: one of several endpoints to Telegram api.
-        More details here: https://core.telegram.org/bots/api#getupdates
-        and here: https://core.telegram.org/bots/api#answercallbackquery
-    :type url:  str
-    :return:    incoming msgs
-    :rtype:     json
+    Retrieve all incoming msgs of one getUpdates batch.
+    Uses long polling: Telegram holds the request open for up to `timeout` seconds
+    and answers as soon as at least one update is available, so no sleep between polls is needed.
+
+    :param offset:  ignore all update_ids until the requested offset
+    :type offset:   int
+    :param limit:   max number of updates per batch (1-100), defaults to TELEGRAM_POLL_LIMIT
+    :type limit:    int
+    :param timeout: long polling timeout in seconds, defaults to TELEGRAM_POLL_TIMEOUT
+    :type timeout:  int
+    :return:
+        incoming messages in Telegram format, sorted by update_id
+        + next update id (max(update_id)+1 in incoming msgs)
+    :rtype: list, int
     """
-    response = requests.get(url)
-    content = response.content.decode("utf8")
-    js = json.loads(content)
-    return js
+    limit = POLL_LIMIT if limit is None else limit
+    timeout = POLL_TIMEOUT if timeout is None else timeout
+    js = get_client().get_updates(offset=offset, limit=limit, timeout=timeout)
+    return _get_incoming_messages_and_next_update_id(js)
 
 
 def _get_incoming_message_and_next_update_id(js):
@@ -74,23 +87,59 @@ def _get_incoming_message_and_next_update_id(js):
         return None, None
 
 
+def _get_incoming_messages_and_next_update_id(js):
+    """
+    :param js: json that contains one or many incoming messages
+    :return: all messages sorted by update_id + next update id
+    :rtype: list, int
+    """
+    incoming_messages = sorted(js["result"], key=lambda row: row["update_id"])
+    if incoming_messages:
+        return incoming_messages, incoming_messages[-1]["update_id"] + 1
+    return [], None
+
+
+def get_chat_id(incoming_message):
+    """
+    Chat an update belongs to, without extracting or saving it. Used to keep updates of one chat in order.
+    :param incoming_message: incoming message as json, in Telegram message format.
+    :return: chat_id, None if the update has no chat
+    :rtype: int
+    """
+    for key in ["message", "edited_message", "my_chat_member"]:
+        if incoming_message.get(key):
+            return incoming_message[key]["chat"]["id"]
+    if incoming_message.get("callback_query", {}).get("message"):
+        return incoming_message["callback_query"]["message"]["chat"]["id"]
+    return None
+
+
 def extract_main(incoming_message):
     """
     Extract chat_id and text from incoming message. 
     Save message with update_id and return chat_id and message_text.
+    Updates that were saved before (e.g. fetched again after a restart) are not extracted.
     :param incoming_message: incoming message as json, in Telegram message format.
     :return: chat_id, text of incoming message
     :rtype: int, str
     """
     extraction_method = _set_extraction_method(incoming_message)
     if extraction_method == 'do_not_extract':
-        return None, None, None
+        return None, None
     if extraction_method == 'extract_message':
         chat_id, update_id, message_text, timestamp_received = _extract_message(incoming_message)
     elif extraction_method == 'extract_callback':
-        _answer_callback(incoming_message['callback_query']['id'])
         chat_id, update_id, message_text, timestamp_received = _extract_callback(incoming_message)
-    write_msg_to_db(chat_id, chat_id, message_text, timestamp_received, update_id=update_id)
+    if not write_msg_to_db(chat_id, chat_id, message_text, timestamp_received, update_id=update_id):
+        logging.info(f"skipping already saved update {update_id}")
+        return None, None
+    if extraction_method == 'extract_callback':
+        # only answered once: a redelivered callback was answered when it was first saved
+        after_commit(partial(_answer_callback, incoming_message['callback_query']['id']))
+    if extraction_method == 'extract_message' and get_media_fetcher():
+        media = _get_media(incoming_message["message"])
+        if media:
+            get_media_fetcher().submit(media["file_id"], media["file_unique_id"])
     return chat_id, message_text
 
 
@@ -112,9 +161,42 @@ def _set_extraction_method(incoming_message):
         return 'do_not_extract'
 
 
+def select_photo_size(photo, max_bytes=MEDIA_PHOTO_MAX_BYTES, max_side=MEDIA_PHOTO_MAX_SIDE):
+    """
+    Pick the largest size of a photo within the budget, or the smallest size if none fits.
+    :param photo: list of PhotoSize, as in message["photo"]
+    :param max_bytes: max file_size, None for no limit
+    :param max_side: max width and height in pixels, None for no limit
+    :return: PhotoSize
+    :rtype: dict
+    """
+    sizes = sorted(photo, key=lambda size: size["width"] * size["height"])
+    fitting = [
+        size for size in sizes
+        if (max_bytes is None or size.get("file_size", 0) <= max_bytes)
+        and (max_side is None or max(size["width"], size["height"]) <= max_side)
+    ]
+    return fitting[-1] if fitting else sizes[0]
+
+
+def _get_media(message):
+    """
+    :return: the document or the selected photo size of a message, None if it has neither
+    :rtype: dict
+    """
+    if message.get('text'):
+        return None
+    if message.get('document'):
+        return message["document"]
+    if message.get('photo'):
+        return select_photo_size(message["photo"])
+    return None
+
+
 def _extract_message(incoming_message):
     """
     If message is an img or document, only return Telegram's file id.
+    Of a photo's sizes, the one within MEDIA_PHOTO_MAX_BYTES/MEDIA_PHOTO_MAX_SIDE is used.
     :param incoming_message: incoming message as dict
     :return: chat_id, update_id, text of incoming message
     :rtype: int, int, str
@@ -124,13 +206,8 @@ def _extract_message(incoming_message):
     timestamp_received = convert_secs_to_datetime(incoming_message["message"]["date"])
     if incoming_message["message"].get('text'):
         message_text = incoming_message["message"]["text"]
-    elif incoming_message["message"].get('document'): # e.g. pdf
-        message_text = 'file: ' + incoming_message["message"]["document"]["file_id"]
-    elif incoming_message["message"].get('photo'): # e.g. jpg
-        try:
-            message_text = 'file: ' + incoming_message["message"]["photo"][3]["file_id"]
-        except:
-            message_text = 'file: ' + incoming_message["message"]["photo"][0]["file_id"]
+    elif _get_media(incoming_message["message"]): # e.g. pdf or jpg
+        message_text = 'file: ' + _get_media(incoming_message["message"])["file_id"]
     return chat_id, update_id, message_text, timestamp_received
 
 
@@ -140,8 +217,7 @@ def _answer_callback(callback_query_id):
     :param callback_query_id: 
     :return: None
     """
-    url = URL + f"answerCallbackQuery?callback_query_id={callback_query_id}"
-    _call_telegram_url(url)
+    get_client().answer_callback_query(callback_query_id)
 
 
 def _extract_callback(incoming_message):
@@ -1,21 +1,24 @@
 """
 Handle outgoing messages.
 """
-import urllib
-import requests
-import json
+from datetime import datetime
+from functools import partial
+
+import metrics
+from reminders import get_reminder_scheduler
+from send_dispatcher import get_dispatcher
+from telegram_client import get_client
+from user_directory import get_user_directory
 from utils import (
-    load_users,
-    URL,
-    write_user_to_db,
+    after_commit,
     write_msg_to_db,
     convert_secs_to_datetime,
     get_time_since_fasting_start,
+    start_fasting_session,
+    end_fasting_session,
     write_event_to_db,
 )
 
-USER_DICT = load_users()
-
 
 def find_response(telegram_id, message_text):
     """
@@ -31,15 +34,13 @@ def find_response(telegram_id, message_text):
         event_name = "start"
     elif first_word == "/name":
         name = message_text.split(" ")[1]
-        if name in USER_DICT.values():
+        if get_user_directory().set_name(telegram_id, name):
+            outgoing_txt = f"Willkommen, {name}"
+            event_name = "set_name"
+        else:
             outgoing_txt = (
                 "Name bereits vergeben. Bitte wähle einen anderen mit /name [dein Name]"
             )
-        else:
-            outgoing_txt = f"Willkommen, {name}"
-            USER_DICT[telegram_id] = name
-            write_user_to_db(telegram_id, name)
-            event_name = "set_name"
     elif first_word == "/fasten":
         _, hours_since_fasting_start_as_text = get_time_since_fasting_start(telegram_id)
         if hours_since_fasting_start_as_text:
@@ -48,6 +49,13 @@ def find_response(telegram_id, message_text):
         else:
             outgoing_txt = "Ich habe das Fasten gestartet. Viel Erfolg 🙂."
             event_name = "fast_start"
+            started_at = datetime.now().replace(microsecond=0)
+            start_fasting_session(telegram_id, started_at)
+            if get_reminder_scheduler():
+                # only once committed, a rolled back /fasten leaves no timer behind
+                after_commit(
+                    partial(get_reminder_scheduler().schedule, telegram_id, started_at)
+                )
     elif first_word == "/ende":
         (
             hours_since_fasting_start_as_float,
@@ -63,6 +71,11 @@ def find_response(telegram_id, message_text):
             write_event_to_db(
                 telegram_id, event_name, hours_since_fasting_start_as_float
             )
+            end_fasting_session(
+                telegram_id, datetime.now(), hours_since_fasting_start_as_float
+            )
+            if get_reminder_scheduler():
+                after_commit(partial(get_reminder_scheduler().cancel, telegram_id))
         else:
             outgoing_txt = "Aktuell fastest du nicht. Beginne das Fasten mit /fasten."
     elif first_word == "/rezepte":
@@ -76,6 +89,7 @@ def find_response(telegram_id, message_text):
     else:
         outgoing_txt = _get_rules()
         event_name = "default_fallback"
+    metrics.COMMANDS.inc(command=event_name or "none")
     _send_message_to_telegram(telegram_id, outgoing_txt, event_name=event_name)
 
 
@@ -103,18 +117,38 @@ def _send_message_to_telegram(
     :param inline_keyboard: provide inline keyboard (optional)
     :return: None
     """
-    parsed_message = urllib.parse.quote_plus(message_text)
-    url = URL + f"sendMessage?text={parsed_message}&chat_id={chat_id}"
-    url += "&parse_mode=HTML&disable_web_page_preview=true"
-    if inline_keyboard:
-        url += f"&reply_markup={inline_keyboard}"
-    else:
-        url += '&reply_markup={"remove_keyboard":%20true}'
-    response = requests.get(url)  # post msg to Telegram server
-    # create separate function for this
-    chat_id, telegram_id, message_text, timestamp_received = _extract_response(
-        json.loads(response.content.decode("utf8"))
-    )
+    dispatcher = get_dispatcher()
+    if dispatcher:
+        # queued once the update's changes are committed, see utils.update_transaction()
+        after_commit(
+            partial(
+                dispatcher.submit,
+                chat_id,
+                message_text,
+                reply_markup=inline_keyboard,
+                on_sent=partial(_save_response, event_name=event_name),
+            )
+        )
+        return
+
+    def send():
+        with metrics.stage("send_message"):
+            response = get_client().send_message(
+                chat_id, message_text, reply_markup=inline_keyboard
+            )
+        _save_response(response, event_name)
+
+    # sent once the update's changes are committed, see utils.update_transaction()
+    after_commit(send)
+
+
+def _save_response(response, event_name=None):
+    """
+    Save an outgoing message, as confirmed by Telegram.
+    :param response: response of Telegram's sendMessage() endpoint
+    :param event_name: event the message belongs to
+    """
+    chat_id, telegram_id, message_text, timestamp_received = _extract_response(response)
     write_msg_to_db(
         chat_id, telegram_id, message_text, timestamp_received, event_name=event_name
     )
@@ -0,0 +1,296 @@
+"""
+Sampling profiler for single updates, to find out why an update occasionally takes seconds.
+While an update is handled, a background thread records the stack of the handling thread every
+PROFILE_INTERVAL_SECS. Handlers don't pay for tracing every call, so every update can be watched:
+the samples are written to PROFILE_DIR for a random PROFILE_SAMPLE_RATE of updates and for every
+update slower than PROFILE_SLOW_SECS, and dropped otherwise. Each capture is a json file with the
+update_id, command, stage timings and stack samples; the oldest files are deleted once the
+directory holds more than PROFILE_MAX_BYTES.
+In the asyncio run mode, updates handled at the same time share the samples of the event loop thread.
+
+Summarize the captures with:
+    python update_profiler.py [--dir profiles] [--top 20]
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+import metrics
+from utils import (
+    PROFILE_DIR,
+    PROFILE_SAMPLE_RATE,
+    PROFILE_SLOW_SECS,
+    PROFILE_INTERVAL_SECS,
+    PROFILE_MAX_BYTES,
+)
+
+PROFILE_CAPTURES = metrics.Counter(
+    "aya_profile_captures_total", "Profiled updates written to disk.", ("reason",)
+)
+
+# frames kept per sample, innermost first
+MAX_DEPTH = 64
+
+
+def command_of(message_text):
+    """
+    :return: the command of a message, e.g. "/fasten", "text" for anything else
+    """
+    if message_text and message_text.startswith("/"):
+        return message_text.split()[0]
+    return "text"
+
+
+def _stack(frame):
+    stack = []
+    while frame is not None and len(stack) < MAX_DEPTH:
+        code = frame.f_code
+        stack.append(f"{code.co_filename}:{code.co_firstlineno}({code.co_name})")
+        frame = frame.f_back
+    return tuple(stack)
+
+
+class Capture:
+    """
+    Samples and timings of one update.
+    """
+
+    def __init__(self, update_id, thread_id):
+        self.update_id = update_id
+        self.thread_id = thread_id
+        self.command = None
+        self.started_at = datetime.now()
+        self.timings = {}
+        self.samples = Counter()  # stack -> number of samples
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = time.perf_counter() - started
+
+
+class _NoCapture:
+    command = None
+
+    def stage(self, name):
+        return nullcontext()
+
+
+class UpdateProfiler:
+    """
+    Samples the threads handling an update and saves the slow and sampled updates.
+    """
+
+    def __init__(
+        self,
+        directory=PROFILE_DIR,
+        sample_rate=PROFILE_SAMPLE_RATE,
+        slow_secs=PROFILE_SLOW_SECS,
+        interval=PROFILE_INTERVAL_SECS,
+        max_bytes=PROFILE_MAX_BYTES,
+        random=random.random,
+    ):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.slow_secs = slow_secs
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self._random = random
+        self._active = set()
+        self._lock = threading.Lock()
+        self._has_active = threading.Event()
+        self._files = deque()  # (name, bytes) of the captures on disk, oldest first
+        self._bytes = 0
+        os.makedirs(directory, exist_ok=True)
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".json"):
+                self._add_file(name, os.path.getsize(os.path.join(directory, name)))
+        self._thread = threading.Thread(
+            target=self._run, name="update_profiler", daemon=True
+        )
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    @contextmanager
+    def profile(self, update_id):
+        """
+        Sample the current thread while the block runs.
+        :rtype: Capture
+        """
+        capture = Capture(update_id, threading.get_ident())
+        with self._lock:
+            self._active.add(capture)
+            self._has_active.set()
+        started = time.perf_counter()
+        try:
+            yield capture
+        finally:
+            capture.timings["total"] = time.perf_counter() - started
+            with self._lock:
+                self._active.discard(capture)
+            if capture.timings["total"] >= self.slow_secs:
+                self._save(capture, "slow")
+            elif self._random() < self.sample_rate:
+                self._save(capture, "sampled")
+
+    def _run(self):
+        while True:
+            self._has_active.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for capture in self._active:
+                    frame = frames.get(capture.thread_id)
+                    if frame is not None:
+                        capture.samples[_stack(frame)] += 1
+                if not self._active:
+                    self._has_active.clear()
+
+    def _save(self, capture, reason):
+        name = f"{capture.started_at:%Y%m%dT%H%M%S%f}-{capture.update_id}.json"
+        content = json.dumps(
+            {
+                "update_id": capture.update_id,
+                "command": capture.command,
+                "reason": reason,
+                "started_at": capture.started_at.isoformat(),
+                "timings": capture.timings,
+                "interval": self.interval,
+                "samples": [
+                    [list(stack), count] for stack, count in capture.samples.items()
+                ],
+            }
+        )
+        try:
+            path = os.path.join(self.directory, name)
+            # write and rename, so the summary never reads a half-written capture
+            with open(path + ".tmp", "w") as f:
+                f.write(content)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logging.warning(
+                f"could not save profile of update {capture.update_id}: {e}"
+            )
+            return
+        PROFILE_CAPTURES.inc(reason=reason)
+        with self._lock:
+            self._add_file(name, len(content))
+            evicted = []
+            while self._bytes > self.max_bytes and len(self._files) > 1:
+                old_name, old_size = self._files.popleft()
+                self._bytes -= old_size
+                evicted.append(old_name)
+        for old_name in evicted:
+            try:
+                os.remove(os.path.join(self.directory, old_name))
+            except FileNotFoundError:
+                pass
+
+    def _add_file(self, name, size):
+        self._files.append((name, size))
+        self._bytes += size
+
+
+_PROFILER = None
+
+
+def start_update_profiler(**kwargs):
+    """
+    Start profiling updates, see profile_update().
+    :rtype: UpdateProfiler
+    """
+    global _PROFILER
+    _PROFILER = UpdateProfiler(**kwargs).start()
+    logging.info(f"update profiler enabled, writing to {_PROFILER.directory}")
+    return _PROFILER
+
+
+def profile_update(update_id):
+    """
+    Profile the handling of an update if the profiler is running.
+    :return: context manager yielding the Capture (a no-op one without profiler)
+    """
+    if _PROFILER is None:
+        return nullcontext(_NoCapture())
+    return _PROFILER.profile(update_id)
+
+
+def load_captures(directory=PROFILE_DIR):
+    """
+    :return: generator of captures (dicts), oldest first
+    """
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                yield json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"skipping capture {name}: {e}")
+
+
+def hot_functions(captures):
+    """
+    :return: (self secs, total secs) per function, summed over all captures. Self counts the
+        samples in which the function was running, total those in which it was on the stack.
+    :rtype: dict
+    """
+    functions = {}
+    for capture in captures:
+        interval = capture["interval"]
+        for stack, count in capture["samples"]:
+            secs = count * interval
+            functions.setdefault(stack[0], [0.0, 0.0])[0] += secs
+            for function in set(stack):
+                functions.setdefault(function, [0.0, 0.0])[1] += secs
+    return {function: tuple(secs) for function, secs in functions.items()}
+
+
+def summarize(directory=PROFILE_DIR, top=20):
+    """
+    :return: report of the hottest functions and slowest updates of the captures
+    :rtype: str
+    """
+    captures = list(load_captures(directory))
+    lines = [f"{len(captures)} captures in {directory}", ""]
+    lines.append(f"{'self secs':>10} {'total secs':>11}  function")
+    functions = hot_functions(captures)
+    for function, (self_secs, total_secs) in sorted(
+        functions.items(), key=lambda item: item[1][0], reverse=True
+    )[:top]:
+        lines.append(f"{self_secs:10.3f} {total_secs:11.3f}  {function}")
+    lines += ["", f"{'secs':>8}  update_id  command  timings"]
+    for capture in sorted(captures, key=lambda c: c["timings"]["total"], reverse=True)[
+        :top
+    ]:
+        timings = ", ".join(
+            f"{stage} {secs:.3f}"
+            for stage, secs in capture["timings"].items()
+            if stage != "total"
+        )
+        lines.append(
+            f"{capture['timings']['total']:8.3f}  {capture['update_id']}  "
+            f"{capture['command']}  {timings}"
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--dir", default=PROFILE_DIR)
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+    print(summarize(args.dir, args.top))
@@ -0,0 +1,246 @@
+"""
+Directory of user names with O(1) lookup by telegram_id and by name.
+Entries are loaded lazily from SCHEMA.user_names (one row per user holding a name, the name
+is the primary key) and kept in a bounded LRU cache. Processes announce changed users with
+NOTIFY, and every process drops its cached entry when it hears about it.
+
+Create and fill user_names from the users history with:
+    python user_directory.py schema
+"""
+import argparse
+import logging
+import os
+import select
+import threading
+from collections import OrderedDict
+
+import psycopg2
+import psycopg2.errors
+
+import utils
+from bots import current_bot_name, start_thread
+from utils import db_conn, db_cursor, get_schema, USER_DIRECTORY_SIZE, USERS_CHANNEL
+
+# secs between reconnect attempts of the LISTEN connection
+LISTEN_RETRY_SECS = 5
+# returned by lookups for users/names that are not cached
+MISSING = object()
+
+
+class UserDirectory:
+    """
+    telegram_id -> name and name -> telegram_id, bounded to `max_size` users (LRU).
+    Users without a name are cached as None, so repeated lookups don't hit the db.
+    """
+
+    def __init__(self, max_size=USER_DIRECTORY_SIZE):
+        self.max_size = max_size
+        self._names = OrderedDict()  # telegram_id -> name or None
+        self._ids = {}  # name -> telegram_id, for cached users with a name
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def _cached_name(self, telegram_id):
+        with self._lock:
+            if telegram_id not in self._names:
+                self.stats["misses"] += 1
+                return MISSING
+            self._names.move_to_end(telegram_id)
+            self.stats["hits"] += 1
+            return self._names[telegram_id]
+
+    def _cache(self, telegram_id, name):
+        with self._lock:
+            self._cache_locked(telegram_id, name)
+
+    def _cache_locked(self, telegram_id, name):
+        self._forget(telegram_id)
+        if self.max_size <= 0:
+            return
+        self._names[telegram_id] = name
+        if name is not None:
+            self._ids[name] = telegram_id
+        while len(self._names) > self.max_size:
+            self._forget(next(iter(self._names)))
+
+    def _forget(self, telegram_id):
+        name = self._names.pop(telegram_id, None)
+        if name is not None and self._ids.get(name) == telegram_id:
+            del self._ids[name]
+
+    def get_name(self, telegram_id):
+        """
+        :return: current name of a user, None if the user has no name
+        :rtype: str
+        """
+        name = self._cached_name(telegram_id)
+        if name is MISSING:
+            name = utils.load_user_name(telegram_id)
+            self._cache(telegram_id, name)
+        return name
+
+    def get_id(self, name):
+        """
+        :return: telegram_id of the user holding a name, None if the name is free
+        :rtype: int
+        """
+        with self._lock:
+            telegram_id = self._ids.get(name)
+        if telegram_id is not None:
+            return telegram_id
+        telegram_id = utils.load_user_id_by_name(name)
+        if telegram_id is not None:
+            self._cache(telegram_id, name)
+        return telegram_id
+
+    def set_name(self, telegram_id, name):
+        """
+        Claim a name for a user. The unique name in user_names decides between concurrent claims.
+        :return: False if another user holds the name
+        :rtype: bool
+        """
+        owner = self.get_id(name)
+        if owner is not None and owner != telegram_id:
+            return False
+        try:
+            utils.write_user_to_db(telegram_id, name)
+        except psycopg2.errors.UniqueViolation:
+            self.invalidate(telegram_id)
+            return False
+        self._cache(telegram_id, name)
+        return True
+
+    def invalidate(self, telegram_id):
+        with self._lock:
+            self._forget(telegram_id)
+            self.stats["invalidations"] += 1
+
+    def items(self):
+        """
+        :return: [(telegram_id, name)] of the cached users, least recently used first
+        """
+        with self._lock:
+            return list(self._names.items())
+
+    def warm(self, users):
+        """
+        :param users: iterable of (telegram_id, name), least recently used first
+        """
+        for telegram_id, name in users:
+            self._cache(telegram_id, name)
+
+    def replace(self, telegram_id, expected, name):
+        """
+        Cache the name of a user unless it changed from `expected` (MISSING: not cached)
+        in the meantime, e.g. to refresh a name loaded earlier without overwriting a newer one.
+        """
+        with self._lock:
+            if self._names.get(telegram_id, MISSING) != expected:
+                return
+            self._cache_locked(telegram_id, name)
+
+    def clear(self):
+        with self._lock:
+            self._names.clear()
+            self._ids.clear()
+
+    def __len__(self):
+        return len(self._names)
+
+
+def listen_for_changes(directory, stopped=None):
+    """
+    LISTEN for changed users and drop them from the directory. Runs until `stopped` is set,
+    reconnecting after connection errors. Notifications sent by this process are skipped.
+    :param stopped: threading.Event
+    """
+    stopped = stopped or threading.Event()
+    channel = USERS_CHANNEL.format(schema=get_schema())
+    own_pid = str(os.getpid())
+    while not stopped.is_set():
+        conn = None
+        try:
+            conn = db_conn()
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {channel};")
+            while not stopped.is_set():
+                if select.select([conn], [], [], LISTEN_RETRY_SECS) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    pid, _, telegram_id = conn.notifies.pop(0).payload.partition(":")
+                    if pid != own_pid:
+                        directory.invalidate(int(telegram_id))
+        except psycopg2.Error as e:
+            logging.exception(e)
+            # changes may have been missed while disconnected
+            directory.clear()
+            stopped.wait(LISTEN_RETRY_SECS)
+        finally:
+            if conn is not None:
+                conn.close()
+
+
+_DIRECTORIES = {}  # bot name -> UserDirectory, "" outside of a bot's context
+_DIRECTORY_LOCK = threading.Lock()
+
+
+def get_user_directory():
+    """
+    Shared user directory of the current bot, created on first use.
+    :rtype: UserDirectory
+    """
+    name = current_bot_name()
+    with _DIRECTORY_LOCK:
+        if name not in _DIRECTORIES:
+            _DIRECTORIES[name] = UserDirectory()
+        return _DIRECTORIES[name]
+
+
+def start_listener():
+    """
+    Keep the current bot's directory consistent with other processes from a daemon thread.
+    """
+    name = current_bot_name()
+    start_thread(
+        listen_for_changes,
+        name=f"user_directory_listener_{name}" if name else "user_directory_listener",
+        args=(get_user_directory(),),
+    )
+
+
+def ensure_schema():
+    """
+    Create user_names and fill it with the latest name of every user in users.
+    If two users hold the same name, the one who took it first keeps it.
+    """
+    schema = get_schema()
+    with db_cursor() as cur:
+        cur.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {schema}.user_names (
+                name text PRIMARY KEY,
+                telegram_id bigint NOT NULL UNIQUE
+            );
+            INSERT INTO {schema}.user_names (name, telegram_id)
+            SELECT name, telegram_id
+            FROM (
+                SELECT DISTINCT ON (telegram_id) telegram_id, name, status_timestamp
+                FROM {schema}.users
+                ORDER BY telegram_id, status_timestamp DESC
+            ) latest
+            ORDER BY status_timestamp
+            ON CONFLICT DO NOTHING;
+            """
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)-8s %(message)s", level=logging.INFO
+    )
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("command", choices=["schema"])
+    parser.parse_args()
+    ensure_schema()
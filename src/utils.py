@@ -1,77 +1,849 @@
 from urllib.parse import urlparse
+from contextlib import contextmanager
+from collections import OrderedDict
+from functools import lru_cache, partial
+import logging
 import os
+import threading
+import time
+import weakref
 import psycopg2
+import psycopg2.pool
 from datetime import datetime, timedelta
 import pytz
 
-from dotenv import load_dotenv, find_dotenv
+from dotenv import find_dotenv, load_dotenv
 
-load_dotenv(find_dotenv())
+import metrics
+from bots import current_bot_name, get_schema
+from fasting_cache import FastingCache, MISSING
+
+# .env of the repo root, loaded from a fixed path instead of searching the filesystem for one.
+# Where src/ is deployed without the repo around it (e.g. the Docker image), it is searched for
+_DOTENV_FILE = os.environ.get(
+    "DOTENV_FILE",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".env"),
+)
+load_dotenv(_DOTENV_FILE if os.path.isfile(_DOTENV_FILE) else find_dotenv())
 
 
 URL = f"https://api.telegram.org/bot{os.environ.get('TELEGRAM_TOKEN')}/"
+# getUpdates batch size and long polling timeout in seconds. Keep the timeout short, proxies
+# and NATs drop idle connections after a minute or so and a dead poll is only noticed then
+POLL_LIMIT = int(os.environ.get("TELEGRAM_POLL_LIMIT", 100))
+POLL_TIMEOUT = int(os.environ.get("TELEGRAM_POLL_TIMEOUT", 30))
+# http settings of the shared Telegram client, see telegram_client.get_client()
+TELEGRAM_CONNECT_TIMEOUT = float(os.environ.get("TELEGRAM_CONNECT_TIMEOUT", 5))
+TELEGRAM_READ_TIMEOUT = float(os.environ.get("TELEGRAM_READ_TIMEOUT", 30))
+TELEGRAM_RETRIES = int(os.environ.get("TELEGRAM_RETRIES", 3))
+TELEGRAM_POOL_SIZE = int(os.environ.get("TELEGRAM_POOL_SIZE", 10))
+# asyncio run mode: max updates handled at once, secs to wait for running handlers on shutdown.
+# Every running handler holds a db connection, so the concurrency defaults to DB_POOL_MAX
+ASYNC_CONCURRENCY = int(
+    os.environ.get("ASYNC_CONCURRENCY", os.environ.get("DB_POOL_MAX", 5))
+)
+ASYNC_DRAIN_TIMEOUT = float(os.environ.get("ASYNC_DRAIN_TIMEOUT", 30))
+# updates fetched but not handled yet at which polling pauses until handlers catch up
+ASYNC_MAX_PENDING = int(os.environ.get("ASYNC_MAX_PENDING", 4 * ASYNC_CONCURRENCY))
+# write-behind buffer for aya_messages/aya_events, see write_buffer.py
+WRITE_BEHIND = os.environ.get("WRITE_BEHIND", "0") == "1"
+WRITE_BUFFER_FLUSH_ROWS = int(os.environ.get("WRITE_BUFFER_FLUSH_ROWS", 100))
+WRITE_BUFFER_FLUSH_SECS = float(os.environ.get("WRITE_BUFFER_FLUSH_SECS", 1))
+WRITE_BUFFER_MAX_ROWS = int(os.environ.get("WRITE_BUFFER_MAX_ROWS", 10000))
+# secs an update waits for room in a full buffer, holding its db connection, before it fails
+WRITE_BUFFER_ADD_TIMEOUT = float(os.environ.get("WRITE_BUFFER_ADD_TIMEOUT", 2))
+# rate-limited send queue, see send_dispatcher.py
+SEND_QUEUE = os.environ.get("SEND_QUEUE", "0") == "1"
+SEND_RATE_GLOBAL = float(os.environ.get("SEND_RATE_GLOBAL", 30))
+SEND_BURST_GLOBAL = float(os.environ.get("SEND_BURST_GLOBAL", 30))
+SEND_RATE_PER_CHAT = float(os.environ.get("SEND_RATE_PER_CHAT", 1))
+SEND_BURST_PER_CHAT = float(os.environ.get("SEND_BURST_PER_CHAT", 3))
+SEND_WORKERS = int(os.environ.get("SEND_WORKERS", 4))
+SEND_MAX_ATTEMPTS = int(os.environ.get("SEND_MAX_ATTEMPTS", 5))
+SEND_DRAIN_TIMEOUT = float(os.environ.get("SEND_DRAIN_TIMEOUT", 30))
+# webhook run mode, see webhook_server.py
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", 4))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", 1000))
+# sharded run mode, see run_sharded.py
+SHARD_WORKERS = int(os.environ.get("SHARD_WORKERS", os.cpu_count() or 1))
+# a worker that doesn't acknowledge an update within this many secs is restarted
+SHARD_ACK_TIMEOUT = float(os.environ.get("SHARD_ACK_TIMEOUT", 120))
+# an update that crashed or stalled its worker this many times is dropped
+SHARD_MAX_ATTEMPTS = int(os.environ.get("SHARD_MAX_ATTEMPTS", 3))
+# where the getUpdates offset is kept between restarts (file, db or none), see offset_store.py
+OFFSET_STORE = os.environ.get("OFFSET_STORE", "file")
+OFFSET_FILE = os.environ.get("OFFSET_FILE", "aya_offset")
+# number of recent update_ids remembered to skip duplicates
+DEDUP_WINDOW = int(os.environ.get("DEDUP_WINDOW", 10000))
+# max number of users in the in-memory user directory, see user_directory.py
+USER_DIRECTORY_SIZE = int(os.environ.get("USER_DIRECTORY_SIZE", 100000))
+# LISTEN/NOTIFY channel announcing changed users
+USERS_CHANNEL = "{schema}_users"
+# max number of chats in the in-memory fasting state cache (0 disables it)
+FASTING_CACHE_SIZE = int(os.environ.get("FASTING_CACHE_SIZE", 100000))
+# fasting milestone reminders, see reminders.py: hours of the milestones, hours after which
+# users are asked whether they forgot /ende, max reminders handed to the sender at once
+REMINDERS = os.environ.get("REMINDERS", "0") == "1"
+REMINDER_MILESTONES = [
+    float(hours)
+    for hours in os.environ.get("REMINDER_MILESTONES", "12,16,24").split(",")
+]
+REMINDER_FORGOT_AFTER = float(os.environ.get("REMINDER_FORGOT_AFTER", 36))
+REMINDER_BATCH_SIZE = int(os.environ.get("REMINDER_BATCH_SIZE", 100))
+# background download of photos and documents, see media_fetcher.py
+MEDIA_FETCH = os.environ.get("MEDIA_FETCH", "0") == "1"
+MEDIA_DIR = os.environ.get("MEDIA_DIR", "media")
+MEDIA_CACHE_BYTES = int(os.environ.get("MEDIA_CACHE_BYTES", 1024**3))
+MEDIA_WORKERS = int(os.environ.get("MEDIA_WORKERS", 2))
+MEDIA_QUEUE_SIZE = int(os.environ.get("MEDIA_QUEUE_SIZE", 1000))
+MEDIA_CHUNK_BYTES = int(os.environ.get("MEDIA_CHUNK_BYTES", 64 * 1024))
+# budget for the photo size that is saved and downloaded, unset = the largest size
+MEDIA_PHOTO_MAX_BYTES = int(os.environ.get("MEDIA_PHOTO_MAX_BYTES", 0)) or None
+MEDIA_PHOTO_MAX_SIDE = int(os.environ.get("MEDIA_PHOTO_MAX_SIDE", 0)) or None
+# broadcast jobs, see broadcast.py: msgs/s (the bot sends that much slower while a job runs),
+# send threads, recipients claimed and results saved per batch, max messages queued at once
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", 20))
+BROADCAST_WORKERS = int(os.environ.get("BROADCAST_WORKERS", 8))
+BROADCAST_BATCH_SIZE = int(os.environ.get("BROADCAST_BATCH_SIZE", 500))
+BROADCAST_MAX_PENDING = int(os.environ.get("BROADCAST_MAX_PENDING", 1000))
+BROADCAST_REPORT_SECS = float(os.environ.get("BROADCAST_REPORT_SECS", 10))
+# sampling profiler of single updates, see update_profiler.py: share of updates written to disk,
+# updates slower than this many secs are always written, secs between stack samples
+PROFILE_UPDATES = os.environ.get("PROFILE_UPDATES", "0") == "1"
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0.001))
+PROFILE_SLOW_SECS = float(os.environ.get("PROFILE_SLOW_SECS", 1))
+PROFILE_INTERVAL_SECS = float(os.environ.get("PROFILE_INTERVAL_SECS", 0.005))
+PROFILE_MAX_BYTES = int(os.environ.get("PROFILE_MAX_BYTES", 100 * 1024**2))
+# monthly partitions of aya_messages, see message_partitions.py: months created in advance,
+# months kept before retention archives them, and where archives are written
+PARTITION_MONTHS_AHEAD = int(os.environ.get("PARTITION_MONTHS_AHEAD", 3))
+RETENTION_MONTHS = int(os.environ.get("RETENTION_MONTHS", 12))
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "archive")
+# local snapshot of users and fasting state to warm the caches on start, empty to disable, see startup.py
+SNAPSHOT_FILE = os.environ.get("SNAPSHOT_FILE", "aya_snapshot.json")
 
 DB = os.environ.get("DB")
-RESULT = urlparse(DB)
-USERNAME = RESULT.username
-PASSWORD = RESULT.password
-DATABASE = RESULT.path[1:]
-HOSTNAME = RESULT.hostname
-PORT = RESULT.port
-
-
-def db_conn():
-    """Connect to db"""
-    conn = psycopg2.connect(
-        database=DATABASE, user=USERNAME, password=PASSWORD, host=HOSTNAME, port=PORT
-    )
+# optional read replica of DB for read-only helpers whose results aren't cached, see read_session()
+DB_REPLICA = os.environ.get("DB_REPLICA")
+# reads go to the primary while the replica lags more than this many secs behind
+DB_REPLICA_MAX_LAG_SECS = float(os.environ.get("DB_REPLICA_MAX_LAG_SECS", 5))
+# secs between replica lag checks, also how long a failed replica is skipped
+DB_REPLICA_CHECK_SECS = float(os.environ.get("DB_REPLICA_CHECK_SECS", 1))
+
+# bounds of the shared connection pool, see get_pool()
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", 5))
+# max secs to wait for a free connection before giving up
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 10))
+# connections idle for longer than this are pinged with `select 1` on checkout
+DB_POOL_HEALTHCHECK_AFTER = float(os.environ.get("DB_POOL_HEALTHCHECK_AFTER", 30))
+
+
+def db_conn(url=None):
+    """Connect to db, or to the db at url (e.g. DB_REPLICA)"""
+    conn = psycopg2.connect(**_db_params(url or DB))
     return conn
 
 
+@lru_cache(maxsize=None)
+def _db_params(url):
+    """
+    Connection parameters from a db url, parsed on the first connect.
+    """
+    result = urlparse(url)
+    return dict(
+        database=result.path[1:],
+        user=result.username,
+        password=result.password,
+        host=result.hostname,
+        port=result.port,
+    )
+
+
+class ConnectionPool:
+    """
+    Bounded, thread-safe pool of psycopg2 connections.
+    Callers wait for a free connection (up to `timeout` secs) instead of failing once
+    `maxconn` connections are checked out. Idle connections are health checked on checkout
+    and broken ones are replaced by fresh connections.
+    """
+
+    def __init__(
+        self,
+        minconn=DB_POOL_MIN,
+        maxconn=DB_POOL_MAX,
+        timeout=DB_POOL_TIMEOUT,
+        healthcheck_after=DB_POOL_HEALTHCHECK_AFTER,
+        connect=db_conn,
+    ):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_after = healthcheck_after
+        self._connect = connect
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._idle = []  # [(conn, time of last use)]
+        self.stats = {
+            "checkouts": 0,
+            "wait_secs_total": 0.0,
+            "wait_secs_max": 0.0,
+            "timeouts": 0,
+            "reconnects": 0,
+        }
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def getconn(self):
+        """
+        Check out a healthy connection.
+        :return: open connection, not in a transaction
+        :rtype: psycopg2.extensions.connection
+        """
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.stats["timeouts"] += 1
+            raise psycopg2.pool.PoolError(
+                f"no free db connection after {self.timeout} secs"
+            )
+        waited = time.monotonic() - started
+        try:
+            conn = self._checkout()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.stats["checkouts"] += 1
+            self.stats["wait_secs_total"] += waited
+            self.stats["wait_secs_max"] = max(self.stats["wait_secs_max"], waited)
+        return conn
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                conn, last_used = self._idle.pop() if self._idle else (None, None)
+            if conn is None:
+                return self._connect()
+            if not conn.closed and (
+                time.monotonic() - last_used < self.healthcheck_after
+                or _is_healthy(conn)
+            ):
+                return conn
+            _close_quietly(conn)
+            with self._lock:
+                self.stats["reconnects"] += 1
+
+    def putconn(self, conn, close=False):
+        """
+        Return a connection to the pool.
+        :param close: discard the connection instead of reusing it (e.g. after a connection error)
+        """
+        try:
+            if close or conn.closed:
+                _close_quietly(conn)
+            else:
+                with self._lock:
+                    self._idle.append((conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    def closeall(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            _close_quietly(conn)
+
+
+def _is_healthy(conn):
+    try:
+        with conn.cursor() as cur:
+            cur.execute("select 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+
+_POOL = None
+_POOL_PID = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_pool():
+    """
+    Shared connection pool, created on first use (and again in forked child processes).
+    :rtype: ConnectionPool
+    """
+    global _POOL, _POOL_PID
+    with _POOL_LOCK:
+        if _POOL is None or _POOL_PID != os.getpid():
+            _POOL = ConnectionPool()
+            _POOL_PID = os.getpid()
+    return _POOL
+
+
+_WRITE_BUFFER = None
+
+
+def set_write_buffer(buffer):
+    """
+    Route message and event inserts through a write_buffer.WriteBuffer (None to write directly).
+    """
+    global _WRITE_BUFFER
+    _WRITE_BUFFER = buffer
+
+
+metrics.FunctionCounter(
+    "aya_db_pool_wait_seconds_total",
+    "Secs spent waiting for a pooled db connection.",
+    lambda: _POOL and _POOL.stats["wait_secs_total"],
+)
+metrics.FunctionCounter(
+    "aya_db_pool_timeouts_total",
+    "Checkouts that found no free db connection in time.",
+    lambda: _POOL and _POOL.stats["timeouts"],
+)
+
+
+# connection -> names of server-side prepared statements that exist on it
+_PREPARED = weakref.WeakKeyDictionary()
+_LOCAL = threading.local()
+
+UPDATE_DB_STATEMENTS = metrics.Histogram(
+    "aya_update_db_statements",
+    "Db statements per update.",
+    buckets=(1, 2, 3, 4, 5, 6, 8, 10, 15),
+)
+UPDATE_DB_ROUND_TRIPS = metrics.Histogram(
+    "aya_update_db_round_trips",
+    "Db round trips per update, including the commit.",
+    buckets=(1, 2, 3, 4, 5, 6, 8, 10, 15),
+)
+UPDATE_DB_SECONDS = metrics.Histogram(
+    "aya_update_db_seconds", "Secs spent in the db per update."
+)
+
+
+class DbSession:
+    """
+    One transaction on a pooled connection.
+    Statements run as server-side prepared statements, so the server plans them once per connection.
+    Writes whose result isn't needed can be deferred: they are sent together with the next
+    statement or at commit, in a single round trip.
+    """
+
+    def __init__(self, conn, cur):
+        self.conn = conn
+        self.cur = cur
+        self._prepared = set()  # prepared in this transaction, kept once it commits
+        self._deferred = []
+        self._rollback_hooks = []
+        self._commit_hooks = []
+        self.committed = False
+        self.replica = False  # connected to DB_REPLICA, see read_session()
+        self.statements = 0
+        self.round_trips = 0
+        self.db_secs = 0.0
+
+    def execute(self, name, sql, params=(), defer=False):
+        """
+        :param name: statement name, unique per sql text
+        :param sql: statement with %s placeholders
+        :param params: values of the placeholders
+        :param defer: send later, together with the next statement
+        :return: cursor with the result, None if deferred
+        """
+        name = f"{name}_{get_schema()}"
+        statement = ""
+        if name not in self._prepared and name not in _PREPARED.get(self.conn, ()):
+            statement = f"PREPARE {name} AS {_numbered_placeholders(sql)};\n"
+            self._prepared.add(name)
+        if params:
+            placeholders = ", ".join(["%s"] * len(params))
+            statement += self.cur.mogrify(
+                f"EXECUTE {name} ({placeholders})", params
+            ).decode("utf8")
+        else:
+            statement += f"EXECUTE {name}"
+        self.statements += 1
+        self._deferred.append(statement)
+        if defer:
+            return None
+        self.flush()
+        return self.cur
+
+    def on_rollback(self, hook):
+        """
+        Call hook if the transaction is rolled back, e.g. to drop cached state written with it.
+        """
+        self._rollback_hooks.append(hook)
+
+    def on_commit(self, hook):
+        """
+        Call hook once the transaction is committed.
+        """
+        self._commit_hooks.append(hook)
+
+    def flush(self):
+        """
+        Send all deferred statements in one round trip.
+        """
+        if not self._deferred:
+            return
+        statements, self._deferred = self._deferred, []
+        started = time.perf_counter()
+        self.cur.execute(";\n".join(statements))
+        self.db_secs += time.perf_counter() - started
+        self.round_trips += 1
+
+    def commit(self):
+        self.flush()
+        started = time.perf_counter()
+        self.conn.commit()
+        self.db_secs += time.perf_counter() - started
+        self.round_trips += 1
+        self.committed = True
+        _PREPARED.setdefault(self.conn, set()).update(self._prepared)
+        for hook in self._commit_hooks:
+            hook()
+
+    def rollback(self):
+        """
+        Roll back and deallocate the prepared statements of the connection:
+        depending on where the transaction failed they may or may not exist.
+        """
+        self._deferred = []
+        self.conn.rollback()
+        if self._prepared:
+            self.cur.execute("DEALLOCATE ALL;")
+            self.conn.commit()
+            _PREPARED.pop(self.conn, None)
+        for hook in self._rollback_hooks:
+            hook()
+
+
+def _numbered_placeholders(sql):
+    """
+    Turn %s placeholders into $1, $2, ... as used by PREPARE.
+    """
+    parts = sql.split("%s")
+    return "".join(
+        part + (f"${i + 1}" if i < len(parts) - 1 else "")
+        for i, part in enumerate(parts)
+    )
+
+
+@contextmanager
+def db_session():
+    """
+    DbSession on a pooled connection. Commits on success, rolls back on error.
+    Inside update_transaction() the transaction of the update is joined instead.
+    Connections that broke during use are discarded, so the next checkout reconnects.
+    """
+    session = getattr(_LOCAL, "session", None)
+    if session is not None:
+        yield session
+        return
+    pool = get_pool()
+    with _pooled_session(pool, pool.getconn()) as session:
+        yield session
+
+
+@contextmanager
+def _pooled_session(pool, conn):
+    broken = False
+    try:
+        with conn.cursor() as cur:
+            session = DbSession(conn, cur)
+            try:
+                yield session
+                session.commit()
+            finally:
+                if not session.committed and not conn.closed:
+                    session.rollback()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        pool.putconn(conn, close=broken or conn.closed)
+
+
+@contextmanager
+def db_cursor():
+    """
+    Cursor on a pooled connection, see db_session().
+    """
+    with db_session() as session:
+        session.flush()
+        yield session.cur
+
+
+@contextmanager
+def update_transaction():
+    """
+    Run all db helpers called while handling one update in a single transaction on one connection.
+    Deferred writes are sent together and the statement count, round trips and db time of
+    the update are recorded. Any error rolls the whole update back.
+    Network calls are passed to after_commit(), so the connection isn't held while they run.
+    """
+    if getattr(_LOCAL, "session", None) is not None:
+        yield _LOCAL.session
+        return
+    actions = []
+    with db_session() as session:
+        _LOCAL.session = session
+        _LOCAL.after_commit = actions
+        try:
+            yield session
+        finally:
+            _LOCAL.session = None
+            _LOCAL.after_commit = None
+            if session.statements:
+                UPDATE_DB_STATEMENTS.observe(session.statements)
+                UPDATE_DB_ROUND_TRIPS.observe(session.round_trips + 1)
+                UPDATE_DB_SECONDS.observe(session.db_secs)
+    for action in actions:
+        action()
+
+
+def in_update_transaction():
+    """
+    :return: True while this thread runs inside update_transaction()
+    """
+    return getattr(_LOCAL, "session", None) is not None
+
+
+def after_commit(action):
+    """
+    Call action (e.g. a Telegram request) once the transaction of the current update is
+    committed and its connection is back in the pool; right away outside update_transaction().
+    Actions of an update that is rolled back are not called.
+    """
+    actions = getattr(_LOCAL, "after_commit", None)
+    if actions is None:
+        action()
+    else:
+        actions.append(action)
+
+
+class RecentWrites:
+    """
+    Keys (e.g. the fasting state of a chat) written by this process in the last `window` secs.
+    The replica may not have these writes yet, so they are read from the primary.
+    """
+
+    def __init__(
+        self,
+        window=DB_REPLICA_MAX_LAG_SECS + DB_REPLICA_CHECK_SECS,
+        clock=time.monotonic,
+    ):
+        self.window = window
+        self._clock = clock
+        self._written = OrderedDict()  # key -> time of last write, oldest first
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        now = self._clock()
+        with self._lock:
+            self._written[key] = now
+            self._written.move_to_end(key)
+            while next(iter(self._written.values())) < now - self.window:
+                self._written.popitem(last=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            written = self._written.get(key)
+        return written is not None and self._clock() - written < self.window
+
+
+RECENT_WRITES = RecentWrites()
+
+DB_READS = metrics.Counter(
+    "aya_db_reads_total",
+    "Read-only helper calls by where they were routed and why.",
+    ("route", "reason"),
+)
+# lag of the replica in secs at the last check (None if unknown), and whether it failed
+_REPLICA = {"lag": None, "checked": None, "failed": False}
+metrics.Gauge(
+    "aya_db_replica_lag_seconds",
+    "Replication lag of DB_REPLICA at the last check.",
+    lambda: _REPLICA["lag"],
+)
+
+# 0 while the replica has replayed all WAL it received, so an idle primary doesn't look like lag
+REPLICA_LAG_SQL = """
+    select case
+        when not pg_is_in_recovery() then 0
+        when pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() then 0
+        else extract(epoch from now() - pg_last_xact_replay_timestamp())
+    end"""
+
+_REPLICA_POOL = None
+_REPLICA_POOL_PID = None
+
+
+def get_replica_pool():
+    """
+    Connection pool of DB_REPLICA, created on first use (and again in forked child processes).
+    :rtype: ConnectionPool
+    """
+    global _REPLICA_POOL, _REPLICA_POOL_PID
+    with _POOL_LOCK:
+        if _REPLICA_POOL is None or _REPLICA_POOL_PID != os.getpid():
+            _REPLICA_POOL = ConnectionPool(connect=lambda: db_conn(DB_REPLICA))
+            _REPLICA_POOL_PID = os.getpid()
+    return _REPLICA_POOL
+
+
+def mark_written(table, key=None):
+    """
+    Note a write, so that reads of it go to the primary for a while, see read_session().
+    """
+    if not DB_REPLICA:
+        return
+    key = (get_schema(), table, key)
+    RECENT_WRITES.add(key)
+    session = getattr(_LOCAL, "session", None)
+    if session is not None:
+        # the update's transaction may commit much later, count the window from then
+        session.on_commit(partial(RECENT_WRITES.add, key))
+
+
+def _primary_reason(table, key):
+    """
+    :return: why the read has to go to the primary, None if the replica may be used
+    """
+    if not DB_REPLICA:
+        return "no_replica"
+    if (get_schema(), table, key) in RECENT_WRITES:
+        return "read_your_writes"
+    checked = _REPLICA["checked"]
+    if checked is not None and time.monotonic() - checked < DB_REPLICA_CHECK_SECS:
+        if _REPLICA["failed"]:
+            return "replica_error"
+        if _REPLICA["lag"] is None or _REPLICA["lag"] > DB_REPLICA_MAX_LAG_SECS:
+            return "lag"
+    return None
+
+
+def _replica_failed(e):
+    logging.warning(f"reading from the primary, replica failed: {e}")
+    _REPLICA.update(lag=None, checked=time.monotonic(), failed=True)
+
+
+def _checkout_replica():
+    """
+    :return: (connection to the replica, None), (None, reason) if it lags too far behind or fails
+    """
+    try:
+        pool = get_replica_pool()
+        conn = pool.getconn()
+    except psycopg2.Error as e:
+        _replica_failed(e)
+        return None, "replica_error"
+    checked = _REPLICA["checked"]
+    if checked is None or time.monotonic() - checked >= DB_REPLICA_CHECK_SECS:
+        try:
+            with conn.cursor() as cur:
+                cur.execute(REPLICA_LAG_SQL)
+                lag = cur.fetchone()[0]
+            conn.rollback()
+        except psycopg2.Error as e:
+            pool.putconn(conn, close=True)
+            _replica_failed(e)
+            return None, "replica_error"
+        _REPLICA.update(
+            lag=None if lag is None else float(lag),
+            checked=time.monotonic(),
+            failed=False,
+        )
+    if _REPLICA["lag"] is None or _REPLICA["lag"] > DB_REPLICA_MAX_LAG_SECS:
+        pool.putconn(conn)
+        return None, "lag"
+    return conn, None
+
+
+@contextmanager
+def read_session(table, key=None):
+    """
+    DbSession for a read-only helper. Reads go to DB_REPLICA if it is configured, its lag is
+    at most DB_REPLICA_MAX_LAG_SECS and (table, key) wasn't written by this process recently
+    (see mark_written()). Otherwise, or if the replica can't be reached, they go to the primary.
+    Don't cache what was read from the replica (session.replica): it may be outdated, and nothing
+    would ever replace it in the cache.
+    :param table: table read
+    :param key: the part of the table read, e.g. a chat_id
+    """
+    conn, reason = None, _primary_reason(table, key)
+    if reason is None:
+        conn, reason = _checkout_replica()
+    if conn is None:
+        if DB_REPLICA:
+            DB_READS.inc(route="primary", reason=reason)
+        with db_session() as session:
+            yield session
+        return
+    DB_READS.inc(route="replica", reason="caught_up")
+    try:
+        with _pooled_session(get_replica_pool(), conn) as session:
+            session.replica = True
+            yield session
+    except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+        _replica_failed(e)
+        raise
+
+
+@contextmanager
+def read_cursor(table, key=None):
+    """
+    Cursor for a read-only helper, see read_session().
+    """
+    with read_session(table, key) as session:
+        session.flush()
+        yield session.cur
+
+
+@metrics.timed_db
 def load_users():
     """
     get the most recent telegram_id-name combination for each telegram_id
     :return: telegram_id-name combination of users
     :rtype: dict
     """
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                f"""
-                select
-                    u.telegram_id, u.name
-                from {os.environ.get('DB_PROD_LEVEL')}.users u
-                join (
-                        select telegram_id, max(status_timestamp) as max_timestamp
-                        from {os.environ.get('DB_PROD_LEVEL')}.users group by telegram_id
-                    ) s
-                on
-                    u.telegram_id = s.telegram_id
-                    and u.status_timestamp = s.max_timestamp
-                ;"""
-            )
-            df_users = cur.fetchall()
+    with read_cursor("users") as cur:
+        cur.execute(
+            f"""
+            select
+                u.telegram_id, u.name
+            from {get_schema()}.users u
+            join (
+                    select telegram_id, max(status_timestamp) as max_timestamp
+                    from {get_schema()}.users group by telegram_id
+                ) s
+            on
+                u.telegram_id = s.telegram_id
+                and u.status_timestamp = s.max_timestamp
+            ;"""
+        )
+        df_users = cur.fetchall()
     return {row[0]: row[1] for row in df_users}
 
 
+@metrics.timed_db
+def load_user_name(telegram_id):
+    """
+    :return: current name of a user, None if the user has no name
+    :rtype: str
+    """
+    with db_session() as db:
+        rows = db.execute(
+            "load_user_name",
+            f"""
+            select name from {get_schema()}.user_names
+            where telegram_id = %s
+            """,
+            (telegram_id,),
+        ).fetchall()
+    return rows[0][0] if rows else None
+
+
+@metrics.timed_db
+def load_user_id_by_name(name):
+    """
+    :return: telegram_id of the user currently holding a name, None if the name is free
+    :rtype: int
+    """
+    with db_session() as db:
+        rows = db.execute(
+            "load_user_id_by_name",
+            f"""
+            select telegram_id from {get_schema()}.user_names
+            where name = %s
+            """,
+            (name,),
+        ).fetchall()
+    return rows[0][0] if rows else None
+
+
+@metrics.timed_db
+def load_user_names(telegram_ids):
+    """
+    Read from the primary, the names are cached in the user directory.
+    :param telegram_ids: list of Telegram IDs
+    :return: telegram_id -> current name, users without a name are left out
+    :rtype: dict
+    """
+    with db_cursor() as cur:
+        cur.execute(
+            f"""
+            select telegram_id, name from {get_schema()}.user_names
+            where telegram_id = any(%s);
+            """,
+            (list(telegram_ids),),
+        )
+        return dict(cur.fetchall())
+
+
+@metrics.timed_db
 def write_user_to_db(telegram_id, name):
     """
     Write new users to database.
+    The name is claimed in SCHEMA.user_names, whose primary key keeps names unique, and
+    other processes are notified to drop their cached entry of this user.
+    Runs in a savepoint, so a taken name doesn't abort the transaction of the update.
     :param telegram_id: Telegram ID of user
     :param name: name of user
+    :raises psycopg2.errors.UniqueViolation: if another user holds the name
     """
-    with db_conn() as conn:
-        with conn.cursor() as cur:
+    schema = get_schema()
+    with db_cursor() as cur:
+        try:
             cur.execute(
                 f"""
-                INSERT INTO {os.environ.get('DB_PROD_LEVEL')}.users
-                    (telegram_id, name, status_timestamp)
-                VALUES
-                    ({telegram_id}, '{name}', '{datetime.now()}')
-                """
+            SAVEPOINT write_user;
+            DELETE FROM {schema}.user_names WHERE telegram_id = %s;
+            INSERT INTO {schema}.user_names (name, telegram_id) VALUES (%s, %s);
+            INSERT INTO {schema}.users
+                (telegram_id, name, status_timestamp)
+            VALUES
+                (%s, %s, %s);
+            SELECT pg_notify(%s, %s);
+            RELEASE SAVEPOINT write_user;
+            """,
+                (
+                    telegram_id,
+                    name,
+                    telegram_id,
+                    telegram_id,
+                    name,
+                    datetime.now(),
+                    USERS_CHANNEL.format(schema=schema),
+                    f"{os.getpid()}:{telegram_id}",
+                ),
             )
+        except psycopg2.errors.UniqueViolation:
+            cur.execute("ROLLBACK TO SAVEPOINT write_user;")
+            raise
+    mark_written("users")
+    mark_written("user_names")
 
 
+@metrics.timed_db
 def write_msg_to_db(
     chat_id,
     telegram_id,
@@ -82,66 +854,265 @@ def write_msg_to_db(
 ):
     """
     Write msg to database.
+    Incoming messages carry their update_id, which is unique in aya_messages (together with
+    timestamp_received, the partition key), so an update that was already saved is not saved again.
+    Outgoing messages (no update_id) are deferred and sent with the next statement of the update.
     :param telegram_id: Telegram ID of user
     :param name: name of user
+    :return: False if the update_id was already saved (always True when buffered)
+    :rtype: bool
     """
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                f"""
-                INSERT INTO {os.environ.get('DB_PROD_LEVEL')}.aya_messages
-                    (chat_id, telegram_id, update_id, message_text, event_name, timestamp_received, timestamp_saved)
-                VALUES
-                    (
-                        %s, %s, %s, %s, %s, %s, %s
-                    )""",
+    if _WRITE_BUFFER:
+        _WRITE_BUFFER.add(
+            "aya_messages",
+            (
+                chat_id,
+                telegram_id,
+                update_id,
+                message_text,
+                event_name,
+                timestamp_received,
+                datetime.now(),
+            ),
+        )
+        return True
+    conflict = message_conflict_clause()
+    with db_session() as db:
+        cur = db.execute(
+            "write_msg" if conflict else "write_msg_without_dedup",
+            f"""
+            INSERT INTO {get_schema()}.aya_messages
+                (chat_id, telegram_id, update_id, message_text, event_name, timestamp_received, timestamp_saved)
+            VALUES
                 (
-                    chat_id,
-                    telegram_id,
-                    update_id,
-                    message_text,
-                    event_name,
-                    timestamp_received,
-                    datetime.now(),
-                ),
-            )
+                    %s, %s, %s, %s, %s, %s, %s
+                ){conflict}""",
+            (
+                chat_id,
+                telegram_id,
+                update_id,
+                message_text,
+                event_name,
+                timestamp_received,
+                datetime.now(),
+            ),
+            defer=update_id is None,
+        )
+        return cur is None or cur.rowcount == 1
+
+
+# schema -> whether its aya_messages has the unique index on update_id, see check_message_dedup()
+_MESSAGE_DEDUP = {}
+
+
+def check_message_dedup():
+    """
+    Check that aya_messages of the current bot has the unique index `offset_store.py schema`
+    creates. Without it, ON CONFLICT would fail every insert, so messages are inserted without
+    it and an update redelivered after a crash may be saved twice.
+    :return: True if updates that were already saved are skipped
+    :rtype: bool
+    """
+    schema = get_schema()
+    with db_cursor() as cur:
+        cur.execute(
+            """
+            select exists (
+                select 1 from pg_indexes
+                where schemaname = %s and tablename = 'aya_messages'
+                and indexdef like
+                    'CREATE UNIQUE INDEX %% (update_id, timestamp_received) WHERE (update_id IS NOT NULL)'
+            );
+            """,
+            (schema,),
+        )
+        found = cur.fetchone()[0]
+    _MESSAGE_DEDUP[schema] = found
+    if not found:
+        logging.warning(
+            f"{schema}.aya_messages has no unique index on (update_id, timestamp_received), "
+            "saving messages without deduplication: run `python offset_store.py schema`"
+        )
+    return found
+
+
+def message_conflict_clause():
+    """
+    :return: ON CONFLICT clause of aya_messages inserts, "" if the index it needs is missing
+    """
+    if not _MESSAGE_DEDUP.get(get_schema(), True):
+        return ""
+    return (
+        " ON CONFLICT (update_id, timestamp_received) "
+        "WHERE update_id IS NOT NULL DO NOTHING"
+    )
 
 
 def convert_secs_to_datetime(secs):
     return datetime.fromtimestamp(secs).strftime("%Y-%m-%d %H:%M:%S")
 
 
+FASTING_CACHE = FastingCache(FASTING_CACHE_SIZE)
+# bot name -> cache of that bot's chats, the same chat_id may fast with one bot and not another
+_FASTING_CACHES = {"": FASTING_CACHE}
+
+
+def get_fasting_cache():
+    """
+    :return: fasting cache of the current bot, FASTING_CACHE outside of a bot's context
+    :rtype: FastingCache
+    """
+    name = current_bot_name()
+    cache = _FASTING_CACHES.get(name)
+    if cache is None:
+        cache = _FASTING_CACHES.setdefault(name, FastingCache(FASTING_CACHE_SIZE))
+    return cache
+
+
+metrics.FunctionCounter(
+    "aya_fasting_cache_hits_total",
+    "Fasting cache hits.",
+    lambda: sum(cache.stats["hits"] for cache in list(_FASTING_CACHES.values())),
+)
+metrics.FunctionCounter(
+    "aya_fasting_cache_misses_total",
+    "Fasting cache misses.",
+    lambda: sum(cache.stats["misses"] for cache in list(_FASTING_CACHES.values())),
+)
+
+
+@metrics.timed_db
 def get_time_since_fasting_start(telegram_id):
     """
     Get time since the user started to fast. If the user doesn't fast, return None.
+    The start of the current fast is served from the fasting cache, the db is only read on a cache miss.
     :param telegram_id: Telegram ID of user
     :return: time since start of fast
     :rtype: str
     """
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                f"""
-                select
-                    max_start
-                from (
-                select
-                    max(timestamp_received) filter(where event_name='fast_start') as max_start,
-                    max(timestamp_received) filter(where event_name='fast_end') as max_end
-                from {os.environ.get('DB_PROD_LEVEL')}.aya_messages
-                where chat_id = {telegram_id}
-                ) sub
-                where max_start > coalesce(max_end, '2001-01-01 00:00:00');
-                """
-            )
-            try:
-                time_at_fasting_start = cur.fetchall()[0][0]
-                hours_as_float, hours_as_text = _get_time_since_fasting_start(
-                    time_at_fasting_start
-                )
-            except:
-                hours_as_float, hours_as_text = None, None
-    return hours_as_float, hours_as_text
+    cache = get_fasting_cache()
+    time_at_fasting_start = cache.get(telegram_id)
+    if time_at_fasting_start is MISSING:
+        time_at_fasting_start, from_replica = _load_time_at_fasting_start(telegram_id)
+        # the replica may lag behind, so its answer is used once but not cached
+        if not from_replica:
+            cache.set(telegram_id, time_at_fasting_start)
+    if time_at_fasting_start is None:
+        return None, None
+    return _get_time_since_fasting_start(time_at_fasting_start)
+
+
+@metrics.timed_db
+def _load_time_at_fasting_start(telegram_id):
+    """
+    :return: start of the open fasting session (None if the user doesn't fast),
+        and whether it was read from the replica
+    :rtype: tuple
+    """
+    with read_session("fasting_sessions", telegram_id) as db:
+        rows = db.execute(
+            "load_time_at_fasting_start",
+            f"""
+            select started_at
+            from {get_schema()}.fasting_sessions
+            where chat_id = %s and ended_at is null
+            """,
+            (telegram_id,),
+        ).fetchall()
+    return (rows[0][0] if rows else None), db.replica
+
+
+def set_fasting_state(telegram_id, time_at_fasting_start):
+    """
+    Keep the fasting cache in sync when a fast is started (datetime) or ended (None).
+    """
+    get_fasting_cache().set(telegram_id, time_at_fasting_start)
+
+
+@metrics.timed_db
+def start_fasting_session(telegram_id, started_at):
+    """
+    Open a fasting session. A chat has at most one open session: if one is open already,
+    it is kept and the cached state is dropped, so the next lookup loads its start.
+    :param telegram_id: Telegram ID of user
+    :param started_at: start of fast
+    """
+    with db_session() as db:
+        cur = db.execute(
+            "start_fasting_session",
+            f"""
+            INSERT INTO {get_schema()}.fasting_sessions
+                (chat_id, started_at)
+            VALUES
+                (%s, %s)
+            ON CONFLICT (chat_id) WHERE ended_at IS NULL DO NOTHING
+            RETURNING started_at""",
+            (telegram_id, started_at),
+        )
+        started = cur.fetchone()
+        db.on_rollback(partial(get_fasting_cache().discard, telegram_id))
+    mark_written("fasting_sessions", telegram_id)
+    if started:
+        set_fasting_state(telegram_id, started[0])
+    else:
+        get_fasting_cache().discard(telegram_id)
+
+
+@metrics.timed_db
+def end_fasting_session(telegram_id, ended_at, hours):
+    """
+    Close the open fasting session of a chat.
+    :param telegram_id: Telegram ID of user
+    :param ended_at: end of fast
+    :param hours: hours fasted
+    """
+    with db_session() as db:
+        db.execute(
+            "end_fasting_session",
+            f"""
+            UPDATE {get_schema()}.fasting_sessions
+            SET ended_at = %s, hours = %s
+            WHERE chat_id = %s AND ended_at IS NULL""",
+            (ended_at, hours, telegram_id),
+            defer=True,
+        )
+        db.on_rollback(partial(get_fasting_cache().discard, telegram_id))
+    mark_written("fasting_sessions", telegram_id)
+    set_fasting_state(telegram_id, None)
+
+
+@metrics.timed_db
+def load_open_fasting_sessions(limit=None):
+    """
+    :param limit: only the most recently started sessions
+    :return: (chat_id, started_at) of all open fasting sessions, oldest first
+    :rtype: list
+    """
+    with db_cursor() as cur:
+        cur.execute(
+            f"""
+            select chat_id, started_at
+            from (
+                select chat_id, started_at
+                from {get_schema()}.fasting_sessions
+                where ended_at is null
+                order by started_at desc
+                limit %s
+            ) sub
+            order by started_at;
+            """,
+            (limit,),
+        )
+        return cur.fetchall()
+
+
+def warm_fasting_cache():
+    """
+    Fill the fasting cache with the open fasting sessions. Chats without an open session are looked up on demand.
+    """
+    cache = get_fasting_cache()
+    cache.warm(load_open_fasting_sessions(limit=FASTING_CACHE_SIZE))
+    logging.info(f"warmed fasting cache with {len(cache)} chats")
 
 
 def _get_time_since_fasting_start(time_at_fasting_start):
@@ -153,6 +1124,7 @@ def _get_time_since_fasting_start(time_at_fasting_start):
     return hours_as_float, hours_as_text
 
 
+@metrics.timed_db
 def write_event_to_db(telegram_id, event_name, event_value=None):
     """
     Write new event to SCHEMA.aya_events.
@@ -160,14 +1132,20 @@ def write_event_to_db(telegram_id, event_name, event_value=None):
     :param event_name: name of event
     :param event_value: value of event
     """
-
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                f"""
-                INSERT INTO {os.environ.get('DB_PROD_LEVEL')}.aya_events
-                    (chat_id, telegram_id, event_name, event_value, timestamp_saved)
-                VALUES
-                    (%s, %s, %s, %s, %s)""",
-                (telegram_id, telegram_id, event_name, event_value, datetime.now()),
-            )
+    if _WRITE_BUFFER:
+        _WRITE_BUFFER.add(
+            "aya_events",
+            (telegram_id, telegram_id, event_name, event_value, datetime.now()),
+        )
+        return
+    with db_session() as db:
+        db.execute(
+            "write_event",
+            f"""
+            INSERT INTO {get_schema()}.aya_events
+                (chat_id, telegram_id, event_name, event_value, timestamp_saved)
+            VALUES
+                (%s, %s, %s, %s, %s)""",
+            (telegram_id, telegram_id, event_name, event_value, datetime.now()),
+            defer=True,
+        )
@@ -0,0 +1,157 @@
+"""
+Webhook run mode: receive updates as POSTs from Telegram instead of long polling getUpdates.
+Updates are acknowledged right away and handled by worker threads; all updates of a chat
+go to the same worker, so they are handled in order.
+Start with `python webhook_server.py`; WEBHOOK_URL is registered with Telegram on startup.
+"""
+import hmac
+import json
+import logging
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from run_telegram import process_update, start_services
+from telegram_client import get_client
+from telegram_listener import get_chat_id
+from utils import (
+    WEBHOOK_URL,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_WORKERS,
+    WEBHOOK_QUEUE_SIZE,
+)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class UpdateWorkers:
+    """
+    Worker threads with one bounded queue each. Updates are routed by chat_id.
+    """
+
+    def __init__(
+        self,
+        handle=process_update,
+        workers=WEBHOOK_WORKERS,
+        queue_size=WEBHOOK_QUEUE_SIZE,
+    ):
+        self._handle = handle
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._threads = [
+            threading.Thread(target=self._run, args=(q,), name=f"webhook_worker_{i}")
+            for i, q in enumerate(self._queues)
+        ]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def submit(self, incoming_message):
+        """
+        :return: False if the worker of this chat is backed up
+        """
+        chat_id = get_chat_id(incoming_message)
+        worker_queue = self._queues[hash(chat_id) % len(self._queues)]
+        try:
+            worker_queue.put_nowait(incoming_message)
+        except queue.Full:
+            return False
+        return True
+
+    def _run(self, worker_queue):
+        while True:
+            incoming_message = worker_queue.get()
+            if incoming_message is None:
+                return
+            try:
+                self._handle(incoming_message)
+            except Exception as e:
+                logging.exception(e)
+
+    def stop(self):
+        """
+        Handle all queued updates, then stop the workers.
+        """
+        for worker_queue in self._queues:
+            worker_queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """
+    Accepts Telegram update POSTs on server.path. Answers 403 for a wrong secret token,
+    400 for a body that isn't a json object and 503 when the workers are backed up, so that Telegram retries later.
+    """
+
+    def do_POST(self):
+        if self.path != self.server.path:
+            return self._respond(404)
+        if self.server.secret and not hmac.compare_digest(
+            self.headers.get(SECRET_HEADER, ""), self.server.secret
+        ):
+            return self._respond(403)
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            incoming_message = json.loads(self.rfile.read(length))
+        except ValueError:
+            return self._respond(400)
+        if not isinstance(incoming_message, dict):
+            return self._respond(400)
+        if not self.server.workers.submit(incoming_message):
+            return self._respond(503)
+        self._respond(200)
+
+    def _respond(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+def create_server(
+    workers,
+    host=WEBHOOK_HOST,
+    port=WEBHOOK_PORT,
+    path=WEBHOOK_PATH,
+    secret=WEBHOOK_SECRET,
+):
+    """
+    :param workers: started UpdateWorkers
+    :rtype: ThreadingHTTPServer
+    """
+    server = ThreadingHTTPServer((host, port), WebhookHandler)
+    server.workers = workers
+    server.path = path
+    server.secret = secret
+    return server
+
+
+def run_webhook_server():
+    workers = UpdateWorkers().start()
+    server = create_server(workers)
+    if WEBHOOK_URL:
+        get_client().set_webhook(
+            WEBHOOK_URL, secret_token=WEBHOOK_SECRET, max_connections=WEBHOOK_WORKERS
+        )
+    logging.info(f"starting webhook server on {WEBHOOK_HOST}:{WEBHOOK_PORT}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        logging.info("draining webhook workers")
+        workers.stop()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)-8s %(message)s", level=logging.INFO
+    )
+    start_services()
+    run_webhook_server()
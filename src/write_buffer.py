@@ -0,0 +1,236 @@
+"""
+Write-behind buffer for aya_messages and aya_events rows.
+Rows are queued on the reply path and inserted in bulk by a background thread,
+so replies don't wait for a db commit per message.
+"""
+import atexit
+import logging
+import queue
+import threading
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+import metrics
+import utils
+from bots import bot_context, current_bot
+from utils import (
+    db_cursor,
+    get_schema,
+    WRITE_BUFFER_FLUSH_ROWS,
+    WRITE_BUFFER_FLUSH_SECS,
+    WRITE_BUFFER_MAX_ROWS,
+    WRITE_BUFFER_ADD_TIMEOUT,
+)
+
+COLUMNS = {
+    "aya_messages": (
+        "chat_id",
+        "telegram_id",
+        "update_id",
+        "message_text",
+        "event_name",
+        "timestamp_received",
+        "timestamp_saved",
+    ),
+    "aya_events": (
+        "chat_id",
+        "telegram_id",
+        "event_name",
+        "event_value",
+        "timestamp_saved",
+    ),
+}
+
+# errors caused by the values of a row: retrying won't help, the row is dropped
+ROW_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError)
+
+
+class WriteBuffer:
+    """
+    Bounded queue of rows, flushed with one multi-row insert per table
+    once `flush_rows` rows are queued or `flush_secs` have passed.
+    When `max_rows` rows are waiting, add() blocks until the flush thread catches up; rows of
+    a failed flush count as waiting, and no new rows are taken while they fail. Inside an
+    update's transaction add() gives up after `add_timeout` secs instead, so updates don't hold
+    every pooled connection while the flush thread needs one.
+    A batch rejected because of a row's values is split until the bad rows are found,
+    which are logged and dropped.
+    """
+
+    def __init__(
+        self,
+        flush_rows=WRITE_BUFFER_FLUSH_ROWS,
+        flush_secs=WRITE_BUFFER_FLUSH_SECS,
+        max_rows=WRITE_BUFFER_MAX_ROWS,
+        add_timeout=WRITE_BUFFER_ADD_TIMEOUT,
+    ):
+        self.flush_rows = flush_rows
+        self.flush_secs = flush_secs
+        self.add_timeout = add_timeout
+        self._queue = queue.Queue()
+        self._slots = threading.Semaphore(max_rows)  # released once a row is written
+        self._retry = []  # rows of a failed flush, written first on the next flush
+        self._flush_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.stats = {
+            "rows_added": 0,
+            "rows_written": 0,
+            "rows_dropped": 0,
+            "flushes": 0,
+            "errors": 0,
+            "add_timeouts": 0,
+        }
+
+    def add(self, table, row):
+        """
+        Queue a row, blocking while the buffer is full.
+        :param table: key of COLUMNS
+        :param row: tuple in the order of COLUMNS[table]
+        :raises queue.Full: if the buffer stayed full for add_timeout secs inside a transaction
+        """
+        if utils.in_update_transaction():
+            if not self._slots.acquire(timeout=self.add_timeout):
+                self._count("add_timeouts")
+                raise queue.Full(
+                    f"write buffer full for {self.add_timeout} secs, not adding {table} row"
+                )
+        else:
+            self._slots.acquire()
+        # rows are written to the schema of the bot that queued them, see bots.py
+        self._queue.put((current_bot(), (table, row)))
+        self._count("rows_added")
+        if self._queue.qsize() >= self.flush_rows:
+            self._wakeup.set()
+
+    def flush(self):
+        """
+        Write all queued rows now, e.g. before reading rows that may still be buffered.
+        """
+        with self._flush_lock:
+            if self._retry:
+                items, self._retry = self._retry, []
+                self._write_items(items)
+                if self._retry:
+                    return
+            items = []
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write_items(items)
+
+    def _write_items(self, items):
+        rows_by_bot = {}
+        for bot, row in items:
+            rows_by_bot.setdefault(bot, []).append(row)
+        for bot, rows in rows_by_bot.items():
+            self._retry.extend((bot, row) for row in self._write(bot, rows))
+
+    def _write(self, bot, rows):
+        """
+        Write rows of a bot, halving the batch on errors caused by a row's values
+        until the bad rows are found and dropped.
+        :return: rows that failed for other reasons, to be retried
+        """
+        try:
+            with bot_context(bot):
+                _write_rows(rows)
+        except ROW_ERRORS as e:
+            if len(rows) == 1:
+                table, row = rows[0]
+                logging.error(f"dropping {table} row {row}: {e}")
+                self._count("rows_dropped")
+                self._slots.release()
+                return []
+            middle = len(rows) // 2
+            failed = self._write(bot, rows[:middle])
+            if failed:
+                return failed + rows[middle:]
+            return self._write(bot, rows[middle:])
+        except Exception as e:
+            logging.exception(e)
+            self._count("errors")
+            return rows
+        self._count("rows_written", len(rows))
+        self._count("flushes")
+        self._slots.release(len(rows))
+        return []
+
+    def _count(self, stat, n=1):
+        # add() and the flush thread update the stats concurrently
+        with self._stats_lock:
+            self.stats[stat] += n
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="write_buffer", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_secs)
+            self._wakeup.clear()
+            self.flush()
+
+    def stop(self):
+        """
+        Stop the flush thread and write whatever is left.
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+
+    @property
+    def depth(self):
+        return self._queue.qsize() + len(self._retry)
+
+
+def _write_rows(rows):
+    schema = get_schema()
+    with db_cursor() as cur:
+        for table, columns in COLUMNS.items():
+            values = [row for row_table, row in rows if row_table == table]
+            if values:
+                execute_values(
+                    cur,
+                    f"INSERT INTO {schema}.{table} ({', '.join(columns)}) VALUES %s"
+                    # updates that were already saved are skipped, see offset_store.py
+                    + (
+                        utils.message_conflict_clause()
+                        if table == "aya_messages"
+                        else ""
+                    ),
+                    values,
+                    page_size=len(values),
+                )
+
+
+_BUFFER = None
+metrics.Gauge(
+    "aya_write_buffer_depth",
+    "Rows waiting to be written.",
+    lambda: _BUFFER.depth if _BUFFER else None,
+)
+
+
+def start_write_buffer(**kwargs):
+    """
+    Start a buffer and route write_msg_to_db/write_event_to_db through it.
+    The buffer is flushed at interpreter exit, so make sure SIGTERM exits via sys.exit.
+    :rtype: WriteBuffer
+    """
+    global _BUFFER
+    _BUFFER = WriteBuffer(**kwargs).start()
+    utils.set_write_buffer(_BUFFER)
+    atexit.register(_BUFFER.stop)
+    logging.info("write-behind buffer for aya_messages/aya_events enabled")
+    return _BUFFER
@@ -0,0 +1,39 @@
+"""
+Test functions for the bot context of the multi-bot runtime.
+"""
+import threading
+import pytest
+import src.bots as b
+
+
+def test_bots_parse_bots_keeps_colons_of_token():
+    bots = b.parse_bots("aya:prod:123:ABC, aya_test:test:456:DEF")
+    assert [(bot.name, bot.schema, bot.token) for bot in bots] == [
+        ("aya", "prod", "123:ABC"),
+        ("aya_test", "test", "456:DEF"),
+    ]
+    assert bots[0].url == "https://api.telegram.org/bot123:ABC/"
+    assert b.parse_bots("") == []
+    with pytest.raises(ValueError):
+        b.parse_bots("aya:prod:123:ABC,aya:test:456:DEF")
+
+
+def test_bots_get_schema_of_current_bot(monkeypatch):
+    monkeypatch.setenv("DB_PROD_LEVEL", "prod")
+    assert b.get_schema() == "prod"
+    with b.bot_context(b.Bot("aya_test", "test", "456:DEF")):
+        assert b.get_schema() == "test"
+        assert b.current_bot_name() == "aya_test"
+    assert b.get_schema() == "prod"
+    assert b.current_bot_name() == ""
+
+
+def test_bots_start_thread_keeps_bot_of_caller():
+    names = []
+    with b.bot_context(b.Bot("aya_test", "test", "456:DEF")):
+        b.start_thread(lambda: names.append(b.current_bot_name()), "test").join()
+        # a plain thread starts without the bot
+        thread = threading.Thread(target=lambda: names.append(b.current_bot_name()))
+        thread.start()
+        thread.join()
+    assert names == ["aya_test", ""]
@@ -0,0 +1,197 @@
+"""
+Test functions for broadcast jobs.
+"""
+from contextlib import nullcontext
+
+import psycopg2
+import pytest
+
+import src.broadcast as bc
+import src.send_dispatcher as sd
+
+
+class FakeBroadcastDb:
+    """
+    users, broadcast_jobs and broadcast_recipients of one job, changed by the statements
+    the job sends
+    """
+
+    def __init__(self, users, recipients=None):
+        self.users = users
+        self.recipients = dict(recipients or {})  # telegram_id -> status
+        self.messages = []
+        self.heartbeats = 0
+        self.finished = False
+        self.batches = []  # (sql, rows) passed to execute_values
+
+    def execute_values(self, cur, sql, rows, page_size):
+        assert page_size == len(rows)
+        self.batches.append((sql, rows))
+        if sql.strip().startswith("INSERT INTO test.broadcast_recipients"):
+            assert sql.strip().endswith("ON CONFLICT DO NOTHING")
+            for job_id, telegram_id, status in rows:
+                assert job_id == 1
+                self.recipients.setdefault(telegram_id, status)
+        else:
+            assert "UPDATE test.broadcast_recipients r" in sql
+            assert "FROM (VALUES %s) AS v (telegram_id, status, sent_at)" in sql
+            assert "WHERE r.job_id = 1 AND r.telegram_id = v.telegram_id" in sql
+            for telegram_id, status, sent_at in rows:
+                assert self.recipients[telegram_id] == "sending"
+                self.recipients[telegram_id] = status
+
+    def cursor(self, name=None):
+        return FakeCursor(self)
+
+    def close(self):
+        pass
+
+
+class FakeCursor:
+    def __init__(self, db):
+        self.db = db
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, params):
+        sql = " ".join(sql.split())
+        if "from test.users u where not exists" in sql:
+            # the users the job hasn't claimed yet
+            assert "r.job_id = %s and r.telegram_id = u.telegram_id" in sql
+            assert params == (1,)
+            unclaimed = [u for u in self.db.users if u not in self.db.recipients]
+            if sql.startswith("select count(distinct telegram_id)"):
+                self.rows = [(len(unclaimed),)]
+            else:
+                self.rows = [(telegram_id,) for telegram_id in unclaimed]
+        elif sql.startswith("select message_text from test.broadcast_jobs"):
+            self.rows = [("Hallo",)]
+        elif sql.startswith("UPDATE test.broadcast_jobs SET heartbeat_at"):
+            assert not self.db.finished
+            self.db.heartbeats += 1
+        elif sql.startswith("UPDATE test.broadcast_jobs SET finished_at"):
+            self.db.finished = True
+        else:
+            raise AssertionError(f"unexpected statement {sql}")
+
+    def fetchone(self):
+        return self.rows.pop(0)
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = FakeBroadcastDb(users=[1, 2, 3, 4, 5])
+    monkeypatch.setenv("DB_PROD_LEVEL", "test")
+    monkeypatch.setattr(bc, "db_conn", lambda: db)
+    monkeypatch.setattr(bc, "db_cursor", lambda: FakeCursor(db))
+    monkeypatch.setattr(bc, "update_transaction", nullcontext)
+    monkeypatch.setattr(bc, "execute_values", db.execute_values)
+    monkeypatch.setattr(
+        bc, "_write_rows", lambda rows: db.messages.extend(row for _, row in rows)
+    )
+    return db
+
+
+def send(message):
+    if message.chat_id == 3:
+        raise sd.TelegramApiError({"ok": False, "error_code": 403})
+    return {
+        "ok": True,
+        "result": {
+            "chat": {"id": message.chat_id},
+            "from": {"id": 987654321},
+            "text": message.text,
+            "date": 1650282548,
+        },
+    }
+
+
+def new_job(sent):
+    def record(message):
+        sent.append(message.chat_id)
+        return send(message)
+
+    return bc.BroadcastJob(
+        1,
+        dispatcher=sd.SendDispatcher(
+            send=record, global_rate=1000, global_burst=1000, workers=2
+        ),
+        batch_size=2,
+        max_pending=2,
+    )
+
+
+def test_broadcast_format_progress():
+    assert bc.format_progress(100, 300, 10) == "10.0 msgs/s, eta 0:00:30"
+    assert bc.format_progress(0, 300, 10) == "0.0 msgs/s, eta unknown"
+
+
+def test_broadcast_job_claims_sends_and_saves_in_batches(db):
+    sent = []
+    stats = new_job(sent).run()
+    assert sorted(sent) == [1, 2, 3, 4, 5]
+    assert stats == {"sent": 4, "failed": 1, "remaining": 0}
+    assert db.recipients == {1: "sent", 2: "sent", 3: "failed", 4: "sent", 5: "sent"}
+    claims = [rows for sql, rows in db.batches if sql.strip().startswith("INSERT")]
+    assert claims == [
+        [(1, 1, "sending"), (1, 2, "sending")],
+        [(1, 3, "sending"), (1, 4, "sending")],
+        [(1, 5, "sending")],
+    ]
+    assert {row[0] for row in db.messages} == {1, 2, 4, 5}
+    assert all(row[4] == bc.EVENT_NAME for row in db.messages)
+    assert db.heartbeats >= 2
+    assert db.finished
+
+
+def test_broadcast_job_resumes_with_unclaimed_users(db):
+    # a run that crashed after claiming 1 to 3, the outcome for 3 is unknown
+    db.recipients = {1: "sent", 2: "failed", 3: "sending"}
+    sent = []
+    stats = new_job(sent).run()
+    assert sorted(sent) == [4, 5]
+    assert stats == {"sent": 2, "failed": 0, "remaining": 0}
+    assert db.recipients == {1: "sent", 2: "failed", 3: "sending", 4: "sent", 5: "sent"}
+
+
+class FakeDispatcher:
+    def __init__(self):
+        self.rates = []
+
+    def set_global_rate(self, rate):
+        self.rates.append(rate)
+
+
+def test_broadcast_watch_lowers_the_bot_rate_while_jobs_run(monkeypatch):
+    monkeypatch.setattr(bc, "SEND_RATE_GLOBAL", 30)
+    monkeypatch.setattr(bc, "BROADCAST_RATE", 20)
+    jobs = [0, 1, 1, 2, None, 0]
+
+    def running_jobs():
+        job_count = jobs.pop(0)
+        if job_count is None:
+            raise psycopg2.OperationalError("db down")
+        return job_count
+
+    dispatcher = FakeDispatcher()
+    watch = bc.BroadcastWatch(dispatcher, running_jobs=running_jobs)
+    for _ in range(6):
+        watch.check()
+    # unchanged while the db is down, at least one msg/s left for the bot's replies
+    assert dispatcher.rates == [10, 1, 30]
+
+
+def test_send_dispatcher_set_global_rate():
+    dispatcher = sd.SendDispatcher(send=send, global_rate=30, global_burst=30)
+    dispatcher.set_global_rate(10)
+    assert dispatcher.global_rate == 10
+    assert dispatcher._global_bucket("").capacity == 10
@@ -0,0 +1,149 @@
+"""
+Test functions for the Parquet export of aya_events.
+"""
+from datetime import date, datetime
+
+import pytest
+
+import analytics.export as ex
+import analytics.get_overview as go
+
+
+def write_events(export_dir, rows):
+    ex._write_part(
+        str(export_dir / "aya_events"),
+        ex.TABLES["aya_events"],
+        rows,
+        f"day={rows[0][-1].date().isoformat()}",
+        "part-0.parquet",
+    )
+
+
+def test_export_read_export_filters_days_and_columns(tmp_path):
+    write_events(tmp_path, [(1, 1, "fast_end", 16.0, datetime(2022, 4, 17, 9))])
+    write_events(tmp_path, [(2, 2, "recipes", None, datetime(2022, 4, 18, 9))])
+    batches = list(
+        ex.read_export("aya_events", str(tmp_path), date(2022, 4, 18), ["chat_id"])
+    )
+    assert [batch.to_pylist() for batch in batches] == [[{"chat_id": 2}]]
+
+
+def test_export_fasting_stats_from_export(tmp_path, monkeypatch):
+    monkeypatch.syspath_prepend("analytics")
+    write_events(
+        tmp_path,
+        [
+            (1, 1, "fast_end", 16.0, datetime(2022, 4, 18, 9)),
+            (2, 2, "recipes", None, datetime(2022, 4, 18, 10)),
+            (2, 2, "fast_end", 12.0, datetime(2022, 4, 18, 11)),
+        ],
+    )
+    stats = go.FastingStats(days=7)
+    for chunk in go.iter_exported_fast_ends(7, str(tmp_path), today=date(2022, 4, 18)):
+        stats.add(*chunk)
+    assert stats.group()["total_hours"] == 28.0
+    assert stats.group()["users_on_streak"] == 2
+
+
+class FakeExportCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+
+    def execute(self, sql, params):
+        if "statement_timestamp" in sql:
+            self.rows = [(self.conn.now,)]
+            return
+        watermark, until = params
+        self.rows = [
+            row
+            for inserted_at, row in sorted(self.conn.rows)
+            if watermark < inserted_at <= until
+        ]
+
+    def fetchone(self):
+        return self.rows.pop(0)
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class FakeExportConnection:
+    """aya_events as [(inserted_at, row)], `now` is the db's time minus the export lag"""
+
+    def __init__(self):
+        self.rows = []
+        self.now = None
+
+    def cursor(self, name=None):
+        return FakeExportCursor(self)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def db(monkeypatch):
+    conn = FakeExportConnection()
+    monkeypatch.setattr(ex, "db_conn", lambda: conn)
+    return conn
+
+
+def exported_chat_ids(export_dir):
+    return sorted(
+        row["chat_id"]
+        for batch in ex.read_export("aya_events", str(export_dir))
+        for row in batch.to_pylist()
+    )
+
+
+def test_export_table_advances_watermark_by_insert_time(tmp_path, db):
+    db.rows = [
+        (datetime(2022, 4, 18, 9), (1, 1, "recipes", None, datetime(2022, 4, 18, 9)))
+    ]
+    db.now = datetime(2022, 4, 18, 10)
+    assert ex.export_table("aya_events", str(tmp_path), chunk_size=1) == 1
+    assert ex.load_watermark("aya_events", str(tmp_path)) == db.now
+    assert not (tmp_path / "aya_events" / "_staging").exists()
+    # saved by the bot before the watermark, but inserted after it, e.g. by a retried flush
+    db.rows.append(
+        (
+            datetime(2022, 4, 18, 10, 30),
+            (2, 2, "recipes", None, datetime(2022, 4, 18, 9, 30)),
+        )
+    )
+    db.now = datetime(2022, 4, 18, 11)
+    assert ex.export_table("aya_events", str(tmp_path), chunk_size=1) == 1
+    assert exported_chat_ids(tmp_path) == [1, 2]
+
+
+def test_export_table_rerun_after_crash_replaces_files(tmp_path, db, monkeypatch):
+    db.rows = [
+        (datetime(2022, 4, 18, 9), (1, 1, "recipes", None, datetime(2022, 4, 18, 9))),
+        (
+            datetime(2022, 4, 18, 9, 1),
+            (2, 2, "recipes", None, datetime(2022, 4, 18, 9)),
+        ),
+    ]
+    db.now = datetime(2022, 4, 18, 10)
+
+    def crash(*args):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(ex, "save_watermark", crash)
+    with pytest.raises(OSError):
+        ex.export_table("aya_events", str(tmp_path), chunk_size=1)
+    assert exported_chat_ids(tmp_path) == [1, 2]
+    monkeypatch.undo()
+    monkeypatch.setattr(ex, "db_conn", lambda: db)
+    # split into other files than before: the files of the crashed run must not stay
+    assert ex.export_table("aya_events", str(tmp_path), chunk_size=2) == 2
+    assert exported_chat_ids(tmp_path) == [1, 2]
+    assert ex.load_watermark("aya_events", str(tmp_path)) == db.now
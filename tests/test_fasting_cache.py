@@ -0,0 +1,28 @@
+"""
+Test functions for the in-memory fasting state cache.
+"""
+from datetime import datetime
+import src.fasting_cache as fc
+
+
+def test_fasting_cache_distinguishes_not_fasting_from_missing():
+    cache = fc.FastingCache(max_size=10)
+    cache.set(123456789, None)
+    assert cache.get(123456789) is None
+    assert cache.get(987654321) is fc.MISSING
+
+
+def test_fasting_cache_evicts_least_recently_used():
+    cache = fc.FastingCache(max_size=2)
+    cache.warm([(1, datetime(2022, 4, 18, 9)), (2, None)])
+    cache.get(1)
+    cache.set(3, None)
+    assert cache.get(2) is fc.MISSING
+    assert cache.get(1) == datetime(2022, 4, 18, 9)
+    assert cache.stats["evictions"] == 1
+
+
+def test_fasting_cache_with_size_zero_caches_nothing():
+    cache = fc.FastingCache(max_size=0)
+    cache.set(1, None)
+    assert cache.get(1) is fc.MISSING
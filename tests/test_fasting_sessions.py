@@ -0,0 +1,26 @@
+"""
+Test functions for rebuilding fasting sessions from aya_messages.
+"""
+from datetime import datetime
+import src.fasting_sessions as fs
+
+
+def test_fasting_sessions_build_sessions():
+    events = [
+        (1, "fast_start", datetime(2022, 4, 17, 20)),
+        (1, "fast_end", datetime(2022, 4, 18, 12)),
+        (1, "fast_end", datetime(2022, 4, 18, 13)),
+        (1, "fast_start", datetime(2022, 4, 18, 20)),
+        (2, "fast_end", datetime(2022, 4, 18, 8)),
+        (2, "fast_start", datetime(2022, 4, 18, 9)),
+        (2, "fast_start", datetime(2022, 4, 18, 10)),
+    ]
+    assert list(fs.build_sessions(events)) == [
+        (1, datetime(2022, 4, 17, 20), datetime(2022, 4, 18, 12), 16.0),
+        (1, datetime(2022, 4, 18, 20), None, None),
+        (2, datetime(2022, 4, 18, 9), None, None),
+    ]
+
+
+def test_fasting_sessions_build_sessions_without_events():
+    assert list(fs.build_sessions([])) == []
@@ -0,0 +1,30 @@
+"""
+Test functions for the fasting analytics.
+"""
+import numpy as np
+
+import analytics.get_overview as go
+
+
+def test_get_overview_group_and_per_user_stats():
+    stats = go.FastingStats(days=5)
+    stats.add(
+        np.array([111, 222, 111]), np.array([16.0, 12.0, 18.0]), np.array([0, 1, 1])
+    )
+    stats.add(np.array([111, 333]), np.array([20.0, 14.0]), np.array([4, 4]))
+
+    group = stats.group()
+    assert group["users"] == 3
+    assert group["fasts"] == 5
+    assert group["total_hours"] == 80.0
+    assert group["avg_hours"] == 16.0
+    assert group["longest_streak"] == 2
+    assert group["users_on_streak"] == 2
+    assert 14 <= group["p50_hours"] <= 16.5
+
+    per_user = stats.per_user()
+    anna = list(per_user["telegram_id"]).index(111)
+    assert per_user["fasts"][anna] == 3
+    assert per_user["total_hours"][anna] == 54.0
+    assert per_user["current_streak"][anna] == 1
+    assert per_user["longest_streak"][anna] == 2
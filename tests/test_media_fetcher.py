@@ -0,0 +1,77 @@
+"""
+Test functions for the background media download.
+"""
+import threading
+import time
+
+import src.media_fetcher as mf
+
+
+class FakeClient:
+    def __init__(self):
+        self.downloads = 0
+
+    def get_file(self, file_id):
+        return {"ok": True, "result": {"file_path": f"photos/{file_id}.jpg"}}
+
+    def download_file(self, file_path, f, chunk_size):
+        self.downloads += 1
+        f.write(b"x" * 100)
+        return 100
+
+
+def test_media_fetcher_downloads_once_and_evicts_lru(tmp_path, monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(mf, "get_client", lambda: client)
+    cache = mf.MediaCache(str(tmp_path), max_bytes=250)
+    fetcher = mf.MediaFetcher(cache, workers=1).start()
+    for file_unique_id in ["aaa1", "aaa1", "bbb2", "ccc3"]:
+        fetcher.submit(f"id_{file_unique_id}", file_unique_id)
+        fetcher._queue.join()
+    fetcher.stop()
+
+    assert client.downloads == 3
+    assert len(cache) == 2 and cache.bytes == 200
+    assert "aaa1" not in cache
+    assert (tmp_path / "cc" / "ccc3").read_bytes() == b"x" * 100
+    assert mf.MediaCache(str(tmp_path), max_bytes=250).bytes == 200
+
+
+def test_media_cache_forgets_files_deleted_on_disk(tmp_path):
+    cache = mf.MediaCache(str(tmp_path), max_bytes=250)
+    tmp_file = tmp_path / "tmp" / "aaa1"
+    tmp_file.write_bytes(b"x" * 100)
+    cache.add("aaa1", str(tmp_file), 100)
+    (tmp_path / "aa" / "aaa1").unlink()
+    assert "aaa1" not in cache
+    assert len(cache) == 0 and cache.bytes == 0
+
+
+def test_media_cache_removes_tmp_files_of_dead_processes(tmp_path):
+    (tmp_path / "tmp").mkdir()
+    (tmp_path / "tmp" / "aaa1.999999999.1").write_bytes(b"x")
+    (tmp_path / "tmp" / "bbb2.140211").write_bytes(b"x")
+    running = tmp_path / "tmp" / f"ccc3.{mf.os.getpid()}.1"
+    running.write_bytes(b"x")
+    mf.MediaCache(str(tmp_path))
+    assert [f.name for f in (tmp_path / "tmp").iterdir()] == [running.name]
+
+
+def test_media_fetcher_stop_skips_queued_files(tmp_path, monkeypatch):
+    client, downloading = FakeClient(), threading.Event()
+    get_file = client.get_file
+    monkeypatch.setattr(
+        client, "get_file", lambda file_id: downloading.wait() and get_file(file_id)
+    )
+    monkeypatch.setattr(mf, "get_client", lambda: client)
+    fetcher = mf.MediaFetcher(
+        mf.MediaCache(str(tmp_path)), workers=1, queue_size=1
+    ).start()
+    fetcher.submit("id_aaa1", "aaa1")
+    while fetcher.depth:
+        time.sleep(0.01)
+    fetcher.submit("id_bbb2", "bbb2")
+    threading.Timer(0.1, downloading.set).start()
+    fetcher.stop()
+    assert client.downloads == 1
+    assert not fetcher._in_flight
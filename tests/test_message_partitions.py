@@ -0,0 +1,151 @@
+"""
+Test functions for the monthly partitions of aya_messages.
+"""
+import re
+from datetime import date, datetime
+
+import src.message_partitions as mp
+import src.offset_store as offset_store
+
+
+class FakeCatalog:
+    """
+    Index names of a schema -> their table, changed by the statements run. As in postgres,
+    index names are unique per schema, whatever their table.
+    """
+
+    def __init__(self):
+        self.indexes = {}
+        self.executed = []
+
+    def cursor(self):
+        return FakeCatalogCursor(self)
+
+
+class FakeCatalogCursor:
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, params=None):
+        self.catalog.executed.append(sql)
+        indexes = self.catalog.indexes
+        if sql.startswith("select indexname from pg_indexes"):
+            table = ".".join(params)
+            self.rows = [(name,) for name, on in indexes.items() if on == table]
+            return
+        if "count(*) filter (where timestamp_received is null)" in sql:
+            self.rows = [(0, datetime(2022, 4, 18, 8, 30))]
+        for statement in sql.split(";"):
+            statement = " ".join(statement.split())
+            renamed_table = re.match(
+                r"ALTER TABLE (\w+)\.(\w+) RENAME TO (\w+)", statement
+            )
+            renamed_index = re.match(
+                r"ALTER INDEX \w+\.(\w+) RENAME TO (\w+)", statement
+            )
+            created_index = re.match(
+                r"CREATE (?:UNIQUE )?INDEX IF NOT EXISTS (\w+) ON (\S+)", statement
+            )
+            if renamed_table:
+                schema, old, new = renamed_table.groups()
+                for name, on in indexes.items():
+                    if on == f"{schema}.{old}":
+                        indexes[name] = f"{schema}.{new}"
+            elif renamed_index:
+                old, new = renamed_index.groups()
+                assert new not in indexes
+                indexes[new] = indexes.pop(old)
+            elif created_index:
+                indexes.setdefault(*created_index.groups())
+
+    def fetchone(self):
+        return self.rows.pop(0)
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+
+def test_message_partitions_add_months_crosses_years():
+    assert mp.add_months(date(2022, 11, 1), 3) == date(2023, 2, 1)
+    assert mp.add_months(date(2022, 1, 1), -1) == date(2021, 12, 1)
+    assert mp.partition_name(date(2022, 4, 1)) == "aya_messages_p2022_04"
+
+
+def test_message_partitions_sql_covers_months_ahead():
+    sql = mp._partitions_sql("prod", date(2022, 11, 1), 2)
+    assert "FOR VALUES FROM ('2022-11-01') TO ('2022-12-01')" in sql
+    assert "FOR VALUES FROM ('2023-01-01') TO ('2023-02-01')" in sql
+    assert "2023-02-01') TO" not in sql
+    assert "PARTITION OF prod.aya_messages DEFAULT" in sql
+    assert "(update_id, timestamp_received) WHERE update_id IS NOT NULL" in sql
+
+
+def test_message_partitions_expired_partitions_keep_current_months():
+    partitions = [
+        ("aya_messages_default", "DEFAULT"),
+        (
+            "aya_messages_p2022_04",
+            "FOR VALUES FROM ('2022-04-01 00:00:00') TO ('2022-05-01 00:00:00')",
+        ),
+        (
+            "aya_messages_p2022_03",
+            "FOR VALUES FROM ('2022-03-01 00:00:00') TO ('2022-04-01 00:00:00')",
+        ),
+        (
+            "aya_messages_legacy",
+            "FOR VALUES FROM (MINVALUE) TO ('2022-03-01 00:00:00')",
+        ),
+    ]
+    assert mp.expired_partitions(partitions, date(2022, 5, 18), keep_months=2) == [
+        "aya_messages_legacy",
+        "aya_messages_p2022_03",
+    ]
+    assert mp.expired_partitions(partitions, datetime(2022, 5, 18), keep_months=3) == [
+        "aya_messages_legacy"
+    ]
+
+
+def test_message_partitions_partition_after_offset_store_schema(monkeypatch):
+    catalog = FakeCatalog()
+    monkeypatch.setenv("DB_PROD_LEVEL", "prod")
+    monkeypatch.setattr(offset_store, "db_cursor", catalog.cursor)
+    monkeypatch.setattr(mp, "db_cursor", catalog.cursor)
+    offset_store.ensure_schema()
+    assert catalog.indexes == {
+        "aya_messages_update_id_received_idx": "prod.aya_messages"
+    }
+    mp.partition_table(today=date(2022, 4, 18), months_ahead=1)
+    # the partitioned table gets the unique index ON CONFLICT relies on, not only the legacy one
+    assert catalog.indexes["aya_messages_update_id_received_idx"] == "prod.aya_messages"
+    assert (
+        catalog.indexes["aya_messages_legacy_update_id_received_idx"]
+        == "prod.aya_messages_legacy"
+    )
+    offset_store.ensure_schema()
+    assert len(catalog.indexes) == 4
+
+
+def test_message_partitions_moves_rows_out_of_default_partition():
+    sql = mp._partitions_sql(
+        "prod", date(2022, 4, 1), 2, existing={"aya_messages_p2022_04"}
+    )
+    assert "aya_messages_p2022_04" not in sql
+    assert "CREATE TABLE prod.aya_messages_p2022_05 (LIKE prod.aya_messages" in sql
+    statements = [" ".join(statement.split()) for statement in sql.split(";")]
+    moved = statements.index(
+        "WITH moved AS ( DELETE FROM prod.aya_messages_default "
+        "WHERE timestamp_received >= '2022-05-01' AND timestamp_received < '2022-06-01' "
+        "RETURNING * ) INSERT INTO prod.aya_messages_p2022_05 SELECT * FROM moved"
+    )
+    assert statements[moved + 1] == (
+        "ALTER TABLE prod.aya_messages ATTACH PARTITION prod.aya_messages_p2022_05 "
+        "FOR VALUES FROM ('2022-05-01') TO ('2022-06-01')"
+    )
@@ -0,0 +1,57 @@
+"""
+Test functions for pipeline metrics.
+"""
+import pytest
+import src.metrics as m
+
+
+def test_metrics_histogram_renders_cumulative_buckets():
+    histogram = m.Histogram("test_seconds", "Test.", ("stage",), buckets=(0.1, 1))
+    histogram.observe(0.05, stage="a")
+    histogram.observe(0.5, stage="a")
+    histogram.observe(5, stage="a")
+    lines = list(histogram.collect())
+    assert 'test_seconds_bucket{stage="a",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{stage="a",le="1"} 2' in lines
+    assert 'test_seconds_bucket{stage="a",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{stage="a"} 3' in lines
+
+
+def test_metrics_stage_counts_errors():
+    with pytest.raises(ValueError):
+        with m.stage("test_stage"):
+            raise ValueError()
+    assert 'aya_errors_total{stage="test_stage"} 1' in m.render()
+
+
+def test_metrics_disabled_records_nothing(monkeypatch):
+    monkeypatch.setattr(m, "ENABLED", False)
+    counter = m.Counter("test_total", "Test.")
+    counter.inc()
+    assert list(counter.collect())[2:] == []
+    assert m.start_metrics_server() is None
+
+
+def test_metrics_counter_labels_bot(monkeypatch):
+    counter = m.Counter("test_bot_total", "Test.", ("command",))
+    counter.inc(command="/fasten")
+    monkeypatch.setattr(m, "current_bot_name", lambda: "aya_test")
+    counter.inc(command="/fasten")
+    lines = list(counter.collect())
+    assert 'test_bot_total{command="/fasten"} 1' in lines
+    assert 'test_bot_total{command="/fasten",bot="aya_test"} 1' in lines
+
+
+def test_metrics_function_counter_renders_as_counter():
+    hits = {"hits": 3}
+    counter = m.FunctionCounter("test_hits_total", "Test.", lambda: hits["hits"])
+    assert list(counter.collect()) == [
+        "# HELP test_hits_total Test.",
+        "# TYPE test_hits_total counter",
+        "test_hits_total 3",
+    ]
+
+
+def test_metrics_gauge_without_value_renders_no_sample():
+    gauge = m.Gauge("test_depth", "Test.", lambda: None)
+    assert list(gauge.collect())[2:] == []
@@ -0,0 +1,22 @@
+"""
+Test functions for offset checkpointing and update_id deduplication.
+"""
+import src.offset_store as os_
+
+
+def test_offset_store_file_offset_store_round_trip(tmp_path):
+    store = os_.FileOffsetStore(str(tmp_path / "offset"))
+    assert store.load() is None
+    store.save(161176029)
+    store.save(161176030)
+    assert os_.FileOffsetStore(str(tmp_path / "offset")).load() == 161176030
+
+
+def test_offset_store_recent_update_ids():
+    recent = os_.RecentUpdateIds(max_size=2)
+    assert not recent.seen(161176028)
+    assert recent.seen(161176028)
+    assert not recent.seen(161176029)
+    assert not recent.seen(161176030)
+    # the oldest id was forgotten
+    assert not recent.seen(161176028)
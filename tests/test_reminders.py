@@ -0,0 +1,51 @@
+"""
+Test functions for fasting milestone reminders.
+"""
+from datetime import datetime
+
+import src.reminders as rm
+
+START = datetime(2022, 4, 18, 8, 0)
+
+
+def make_scheduler(now_hours):
+    clock = lambda: START.timestamp() + now_hours[0] * 3600
+    return rm.ReminderScheduler(
+        send=None, milestones=[12, 16], forgot_after=24, clock=clock
+    )
+
+
+def test_reminders_fire_milestones_in_order_and_skip_passed_ones():
+    now_hours = [13]
+    scheduler = make_scheduler(now_hours)
+    scheduler.schedule(123456789, START)
+    assert scheduler.pop_due() == []
+    now_hours[0] = 17
+    assert scheduler.pop_due() == [(123456789, rm.milestone_text(16), "fast_milestone")]
+    now_hours[0] = 25
+    assert [event_name for _, _, event_name in scheduler.pop_due()] == [
+        "fast_forgot_end"
+    ]
+    assert len(scheduler) == 0
+
+
+def test_reminders_fire_only_latest_step_due_after_downtime():
+    now_hours = [0]
+    scheduler = make_scheduler(now_hours)
+    scheduler.schedule(123456789, START)
+    now_hours[0] = 25
+    assert scheduler.pop_due() == [(123456789, rm.forgot_text(24), "fast_forgot_end")]
+    assert len(scheduler) == 0
+
+
+def test_reminders_cancel_and_reschedule():
+    now_hours = [0]
+    scheduler = make_scheduler(now_hours)
+    scheduler.schedule(123456789, START)
+    scheduler.schedule(987654321, START)
+    scheduler.cancel(123456789)
+    scheduler.schedule(987654321, START.replace(hour=10))
+    now_hours[0] = 12
+    assert scheduler.pop_due() == []
+    now_hours[0] = 14
+    assert scheduler.pop_due() == [(987654321, rm.milestone_text(12), "fast_milestone")]
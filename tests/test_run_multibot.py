@@ -0,0 +1,25 @@
+"""
+Test functions for the multi-bot run mode.
+"""
+import threading
+
+import pytest
+
+import src.run_multibot as rm
+from src.bots import Bot
+
+
+def test_run_multibot_exits_once_a_bot_stops(monkeypatch):
+    running = threading.Event()
+
+    def run_bot(bot):
+        # run_bot() logs the error and returns
+        if bot.name != "aya_test":
+            running.wait()
+
+    monkeypatch.setattr(rm, "start_shared_services", lambda: None)
+    monkeypatch.setattr(rm, "run_bot", run_bot)
+    with pytest.raises(SystemExit) as exit_info:
+        rm.main([Bot("aya", "prod", "123:ABC"), Bot("aya_test", "test", "456:DEF")])
+    running.set()
+    assert exit_info.value.code == "bot_aya_test stopped, exiting"
@@ -0,0 +1,40 @@
+"""
+Test functions for the sharded run mode.
+"""
+import src.run_sharded as rs
+
+
+def test_run_sharded_shard_of_is_stable_per_chat():
+    assert rs.shard_of(123456789, 4) == rs.shard_of(123456789, 4) == 1
+    assert rs.shard_of(-661875399, 4) in range(4)
+    assert rs.shard_of(None, 4) == 0
+
+
+def test_run_sharded_shard_of_spreads_chats():
+    assert {rs.shard_of(chat_id, 4) for chat_id in range(100)} == {0, 1, 2, 3}
+
+
+class FakeProcess:
+    exitcode = 1
+
+    def is_alive(self):
+        return False
+
+    def join(self):
+        pass
+
+
+def test_run_sharded_drops_update_that_keeps_crashing_its_worker(monkeypatch):
+    supervisor = rs.ShardSupervisor(workers=1, max_attempts=2)
+    monkeypatch.setattr(supervisor, "_start_worker", lambda index: None)
+    supervisor._processes = [FakeProcess()]
+    supervisor._in_flight[0] = {
+        161176028: {"update_id": 161176028},
+        161176029: {"update_id": 161176029},
+    }
+    supervisor.check_health()
+    assert list(supervisor._in_flight[0]) == [161176028, 161176029]
+    supervisor.check_health()
+    assert list(supervisor._in_flight[0]) == [161176029]
+    supervisor.check_health()
+    assert list(supervisor._in_flight[0]) == [161176029]
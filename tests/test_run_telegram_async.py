@@ -0,0 +1,118 @@
+"""
+Test functions for the asyncio run mode.
+"""
+import asyncio
+import logging
+import os
+import signal
+import threading
+import time
+
+import src.run_telegram_async as rta
+from src.offset_store import NoOffsetStore
+
+
+def _run_scheduler(updates, concurrency):
+    handled = []
+    running = {"now": 0, "max": 0}
+
+    async def handle(update):
+        running["now"] += 1
+        running["max"] = max(running["max"], running["now"])
+        await asyncio.sleep(update["delay"])
+        handled.append(update["update_id"])
+        running["now"] -= 1
+
+    async def main():
+        scheduler = rta.ChatScheduler(handle, concurrency)
+        for update in updates:
+            scheduler.submit(update["chat_id"], update)
+        assert await scheduler.drain(timeout=5)
+        assert scheduler.pending == 0
+
+    asyncio.run(main())
+    return handled, running["max"]
+
+
+def test_run_telegram_async_chat_scheduler_keeps_order_within_chat():
+    updates = [
+        {"update_id": 1, "chat_id": 1, "delay": 0.05},
+        {"update_id": 2, "chat_id": 1, "delay": 0},
+        {"update_id": 3, "chat_id": 2, "delay": 0},
+    ]
+    handled, _ = _run_scheduler(updates, concurrency=10)
+    assert handled.index(1) < handled.index(2)
+    # the other chat is not blocked by the slow update
+    assert handled[0] == 3
+
+
+def test_run_telegram_async_chat_scheduler_limits_concurrency():
+    updates = [{"update_id": i, "chat_id": i, "delay": 0.01} for i in range(10)]
+    handled, max_running = _run_scheduler(updates, concurrency=3)
+    assert sorted(handled) == list(range(10))
+    assert max_running == 3
+
+
+class FakePoller:
+    """
+    getUpdates returning `limit` updates of different chats, stopping the loop after `polls` polls
+    """
+
+    def __init__(self, polls):
+        self.polls = polls
+        self.fetched = 0
+        self.handled = 0
+        self.pending_at_poll = []
+        self._lock = threading.Lock()
+
+    async def get_updates(self, session, offset=None, limit=100, timeout=30):
+        with self._lock:
+            self.pending_at_poll.append(self.fetched - self.handled + limit)
+        self.polls -= 1
+        if not self.polls:
+            os.kill(os.getpid(), signal.SIGTERM)
+        updates = [
+            {
+                "update_id": self.fetched + i,
+                "message": {"chat": {"id": self.fetched + i}},
+            }
+            for i in range(limit)
+        ]
+        self.fetched += limit
+        return updates, self.fetched
+
+    def process_update(self, incoming_message, delay):
+        time.sleep(delay)
+        with self._lock:
+            self.handled += 1
+
+
+def _run_loop(monkeypatch, poller, delay, **kwargs):
+    monkeypatch.setattr(
+        rta, "get_incoming_messages_and_next_update_id", poller.get_updates
+    )
+    monkeypatch.setattr(
+        rta, "process_update", lambda message: poller.process_update(message, delay)
+    )
+    asyncio.run(
+        rta.open_connection_to_telegram_chatbot(
+            concurrency=2, offset_store=NoOffsetStore(), **kwargs
+        )
+    )
+
+
+def test_run_telegram_async_polls_no_more_than_max_pending(monkeypatch):
+    poller = FakePoller(polls=10)
+    _run_loop(monkeypatch, poller, delay=0.01, max_pending=5, drain_timeout=5)
+    assert max(poller.pending_at_poll) <= 5
+    assert poller.handled == poller.fetched
+
+
+def test_run_telegram_async_cancels_updates_after_drain_timeout(monkeypatch, caplog):
+    poller = FakePoller(polls=1)
+    with caplog.at_level(logging.ERROR):
+        _run_loop(monkeypatch, poller, delay=0.2, max_pending=4, drain_timeout=0.01)
+        # the handlers that were running finish after the loop is closed
+        time.sleep(0.3)
+    assert poller.handled == 2
+    assert not [r for r in caplog.records if "exception calling callback" in r.message]
@@ -0,0 +1,120 @@
+"""
+Test functions for the rate-limited send queue.
+"""
+import src.send_dispatcher as sd
+
+# the bots module send_dispatcher reads the current bot from
+from bots import Bot, bot_context
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_send_dispatcher_token_bucket():
+    clock = FakeClock()
+    bucket = sd.TokenBucket(rate=1, capacity=2, clock=clock)
+    assert bucket.wait_time() == 0
+    bucket.take()
+    bucket.take()
+    assert bucket.wait_time() == 1
+    clock.now = 0.5
+    assert bucket.wait_time() == 0.5
+    clock.now = 10
+    assert bucket.full
+
+
+def test_send_dispatcher_token_bucket_pause():
+    clock = FakeClock()
+    bucket = sd.TokenBucket(rate=30, capacity=30, clock=clock)
+    bucket.pause(5)
+    assert bucket.wait_time() == 5
+    # a shorter pause doesn't cut a longer one short
+    bucket.pause(1)
+    assert bucket.wait_time() == 5
+    clock.now = 5
+    assert bucket.wait_time() == 0
+
+
+def test_send_dispatcher_retries_after_429_in_order():
+    sent = []
+    confirmed = []
+    failed_once = set()
+
+    def send(message):
+        if message.text == "a" and "a" not in failed_once:
+            failed_once.add("a")
+            raise sd.TelegramApiError(
+                {"ok": False, "error_code": 429, "parameters": {"retry_after": 0.05}}
+            )
+        sent.append((message.chat_id, message.text))
+        return {"ok": True, "result": {"text": message.text}}
+
+    dispatcher = sd.SendDispatcher(
+        send=send,
+        global_rate=1000,
+        global_burst=1000,
+        chat_rate=1000,
+        chat_burst=1000,
+        workers=2,
+    ).start()
+    dispatcher.submit(
+        1, "a", on_sent=lambda response: confirmed.append(response["result"]["text"])
+    )
+    dispatcher.submit(1, "b")
+    dispatcher.submit(2, "c")
+    dispatcher.stop(timeout=5)
+    assert [text for chat_id, text in sent if chat_id == 1] == ["a", "b"]
+    assert (2, "c") in sent
+    assert confirmed == ["a"]
+    assert dispatcher.stats["rate_limited"] == 1
+    assert dispatcher.depth == 0
+
+
+def test_send_dispatcher_drops_message_on_client_error():
+    def send(message):
+        raise sd.TelegramApiError(
+            {
+                "ok": False,
+                "error_code": 403,
+                "description": "Forbidden: bot was blocked by the user",
+            }
+        )
+
+    dispatcher = sd.SendDispatcher(send=send, workers=1).start()
+    dispatcher.submit(1, "a")
+    dispatcher.stop(timeout=5)
+    assert dispatcher.stats["dropped"] == 1
+
+
+def test_send_dispatcher_limits_every_bot_on_its_own():
+    sent = []
+    dispatcher = sd.SendDispatcher(
+        send=lambda message: sent.append((message.bot, message.text)),
+        global_rate=0.01,
+        global_burst=1,
+        chat_rate=1000,
+        chat_burst=1000,
+        workers=1,
+    ).start()
+    for name in ["aya", "aya_test"]:
+        with bot_context(Bot(name, name, "123:ABC")):
+            dispatcher.submit(1, f"{name} 1")
+            dispatcher.submit(1, f"{name} 2")
+    dispatcher.stop(timeout=0.5)
+    # chat 1 of each bot is a chat of its own, and every bot gets its own burst
+    assert sorted(sent) == [("aya", "aya 1"), ("aya_test", "aya_test 1")]
+    assert dispatcher.depth == 2
+
+
+def test_send_dispatcher_set_global_rate_of_one_bot():
+    dispatcher = sd.SendDispatcher(send=lambda message: None, global_rate=30)
+    with bot_context(Bot("aya", "prod", "123:ABC")):
+        dispatcher.set_global_rate(10)
+        assert dispatcher.global_rate == 10
+    with bot_context(Bot("aya_test", "test", "456:DEF")):
+        assert dispatcher.global_rate == 30
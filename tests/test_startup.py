@@ -0,0 +1,71 @@
+"""
+Test functions for the cache snapshot used on startup.
+"""
+from datetime import datetime
+
+import pytest
+
+import src.startup as st
+from src.user_directory import UserDirectory
+
+
+@pytest.fixture
+def caches(monkeypatch):
+    """fresh fasting cache and user directory, instead of the ones of the process"""
+    # the FastingCache class startup.py uses, whose MISSING it compares with
+    cache, directory = st.utils.FastingCache(max_size=10), UserDirectory(max_size=10)
+    monkeypatch.setattr(st, "get_fasting_cache", lambda: cache)
+    monkeypatch.setattr(st, "get_user_directory", lambda: directory)
+    return cache, directory
+
+
+def test_startup_snapshot_round_trip(tmp_path, caches):
+    cache, directory = caches
+    path = str(tmp_path / "snapshot.json")
+    started_at = datetime(2022, 4, 18, 8, 30)
+    cache.set(123456789, started_at)
+    cache.set(987654321, None)
+    directory.warm([(123456789, "Anna")])
+    st.save_snapshot(path)
+
+    cache.discard(123456789)
+    cache.discard(987654321)
+    directory.clear()
+    assert st.load_snapshot(path)
+    assert cache.get(123456789) == started_at
+    assert cache.get(987654321) is None
+    assert directory.get_name(123456789) == "Anna"
+
+
+def test_startup_load_snapshot_skips_missing_and_broken_files(tmp_path, caches):
+    assert st.load_snapshot(str(tmp_path / "missing.json")) is None
+    broken = tmp_path / "broken.json"
+    broken.write_text("{")
+    assert st.load_snapshot(str(broken)) is None
+
+
+def test_startup_refresh_caches_keeps_changes_made_meanwhile(monkeypatch, caches):
+    cache, directory = caches
+    snapshot_start, db_start = datetime(2022, 4, 17, 20), datetime(2022, 4, 18, 8)
+    snapshot = {
+        "fasting": [(1, snapshot_start), (2, snapshot_start), (3, snapshot_start)],
+        "users": [(1, "alex"), (2, "kim")],
+    }
+    cache.warm(snapshot["fasting"])
+    directory.warm(snapshot["users"])
+    # updates handled since the start: chat 2 ended its fast, user 2 took a new name
+    cache.set(2, None)
+    directory.warm([(2, "sam")])
+    monkeypatch.setattr(
+        st.utils,
+        "load_open_fasting_sessions",
+        lambda limit: [(1, db_start), (2, snapshot_start), (4, db_start)],
+    )
+    monkeypatch.setattr(st.utils, "load_user_names", lambda ids: {1: "alexa", 2: "kim"})
+    st.refresh_caches(snapshot, path=None)
+    assert cache.get(1) == db_start
+    assert cache.get(2) is None
+    assert cache.get(3) is st.MISSING
+    assert cache.get(4) == db_start
+    assert directory.get_name(1) == "alexa"
+    assert directory.get_name(2) == "sam"
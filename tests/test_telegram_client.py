@@ -0,0 +1,77 @@
+"""
+Test functions for the Telegram api client.
+"""
+import json
+import pytest
+import src.telegram_client as tc
+from src.bots import Bot
+
+
+class FakeResponse:
+    def __init__(self, js):
+        self.content = json.dumps(js).encode("utf8")
+
+
+class FakeSession:
+    def __init__(self, js):
+        self.js = js
+        self.calls = []
+
+    def get(self, url, params=None, timeout=None):
+        self.calls.append(("GET", url, params, timeout))
+        return FakeResponse(self.js)
+
+    def post(self, url, json=None, timeout=None):
+        self.calls.append(("POST", url, json, timeout))
+        return FakeResponse(self.js)
+
+
+def test_telegram_client_send_message_posts_json_body():
+    session = FakeSession({"ok": True, "result": {}})
+    client = tc.TelegramClient(base_url="https://api.test/botTOKEN/", session=session)
+    client.send_message(123456789, "Hallo & tschüss")
+    method, url, body, _ = session.calls[0]
+    assert (method, url) == ("POST", "https://api.test/botTOKEN/sendMessage")
+    assert body["text"] == "Hallo & tschüss"
+    assert body["reply_markup"] == {"remove_keyboard": True}
+
+
+def test_telegram_client_get_updates_extends_read_timeout_by_poll_timeout():
+    session = FakeSession({"ok": True, "result": []})
+    client = tc.TelegramClient(read_timeout=30, connect_timeout=5, session=session)
+    client.get_updates(offset=161176029, limit=100, timeout=50)
+    _, _, params, timeout = session.calls[0]
+    assert params == {"timeout": 50, "limit": 100, "offset": 161176029}
+    assert timeout == (5, 80)
+
+
+def test_telegram_client_raises_on_error_response():
+    session = FakeSession(
+        {
+            "ok": False,
+            "error_code": 429,
+            "description": "Too Many Requests",
+            "parameters": {"retry_after": 3},
+        }
+    )
+    client = tc.TelegramClient(session=session)
+    with pytest.raises(tc.TelegramApiError) as e:
+        client.send_message(123456789, "Hallo")
+    assert e.value.error_code == 429
+    assert e.value.parameters == {"retry_after": 3}
+
+
+def test_telegram_client_get_client_per_bot_shares_session(monkeypatch):
+    session = FakeSession({"ok": True, "result": []})
+    monkeypatch.setattr(
+        tc,
+        "_CLIENT",
+        tc.TelegramClient(base_url="https://api.test/botTOKEN/", session=session),
+    )
+    monkeypatch.setattr(tc, "_BOT_CLIENTS", {})
+    monkeypatch.setattr(tc, "current_bot", lambda: Bot("aya_test", "test", "456:DEF"))
+    client = tc.get_client()
+    client.get_updates()
+    assert client.session is session
+    assert session.calls[0][1] == "https://api.telegram.org/bot456:DEF/getUpdates"
+    assert tc.get_client() is client
@@ -1,8 +1,12 @@
 """
 Test functions for sender of outgoing messages to Telegram.
 """
+import contextlib
+import types
 import pytest
 import src.telegram_sender as ts
+# the utils module telegram_sender queues its requests with
+import utils
 
 @pytest.fixture
 def outgoing_message():
@@ -28,3 +32,25 @@ def outgoing_message():
 def test_telegram_sender__extract_response(outgoing_message):
     assert ts._extract_response(outgoing_message) == (123456789, 987654321, 'Hallo, ich bin ein Chatbot.', '2022-04-18 13:49:08')
 
+
+
+class FakeDispatcher:
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, chat_id, text, reply_markup=None, on_sent=None, on_dropped=None):
+        self.submitted.append((chat_id, text))
+
+def test_telegram_sender_queues_nothing_for_rolled_back_update(monkeypatch):
+    dispatcher = FakeDispatcher()
+    monkeypatch.setattr(ts, 'get_dispatcher', lambda: dispatcher)
+    monkeypatch.setattr(utils, 'db_session', lambda: contextlib.nullcontext(types.SimpleNamespace(statements=0)))
+    with pytest.raises(RuntimeError):
+        with utils.update_transaction():
+            ts._send_message_to_telegram(123456789, 'Hallo')
+            raise RuntimeError('handler failed')
+    assert dispatcher.submitted == []
+    with utils.update_transaction():
+        ts._send_message_to_telegram(123456789, 'Hallo')
+        assert dispatcher.submitted == []
+    assert dispatcher.submitted == [(123456789, 'Hallo')]
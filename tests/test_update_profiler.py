@@ -0,0 +1,39 @@
+"""
+Test functions for the update profiler.
+"""
+import time
+import src.update_profiler as up
+
+
+def handle_slowly():
+    time.sleep(0.05)
+
+
+def test_update_profiler_saves_slow_updates(tmp_path):
+    profiler = up.UpdateProfiler(
+        directory=str(tmp_path), sample_rate=0, slow_secs=0.02, interval=0.001
+    ).start()
+    with profiler.profile(161176028) as capture:
+        capture.command = up.command_of("/fasten jetzt")
+        with capture.stage("find_response"):
+            handle_slowly()
+    with profiler.profile(161176029):
+        pass
+    captures = list(up.load_captures(str(tmp_path)))
+    assert [(c["update_id"], c["command"], c["reason"]) for c in captures] == [
+        (161176028, "/fasten", "slow")
+    ]
+    assert captures[0]["timings"]["find_response"] >= 0.05
+    functions = up.hot_functions(captures)
+    assert any("handle_slowly" in function for function in functions)
+    assert "handle_slowly" in up.summarize(str(tmp_path))
+
+
+def test_update_profiler_deletes_oldest_captures(tmp_path):
+    profiler = up.UpdateProfiler(
+        directory=str(tmp_path), sample_rate=1, slow_secs=60, max_bytes=1
+    )
+    for update_id in [161176028, 161176029]:
+        with profiler.profile(update_id):
+            pass
+    assert [c["update_id"] for c in up.load_captures(str(tmp_path))] == [161176029]
@@ -0,0 +1,88 @@
+"""
+Test functions for the user directory.
+"""
+import threading
+
+import psycopg2.errors
+import pytest
+import src.user_directory as ud
+
+
+@pytest.fixture
+def users(monkeypatch):
+    """user_names table as dict name -> telegram_id"""
+    user_names = {"alex": 1}
+
+    def write_user_to_db(telegram_id, name):
+        if user_names.get(name, telegram_id) != telegram_id:
+            raise psycopg2.errors.UniqueViolation()
+        user_names[name] = telegram_id
+
+    monkeypatch.setattr(ud.utils, "load_user_id_by_name", user_names.get)
+    monkeypatch.setattr(
+        ud.utils,
+        "load_user_name",
+        lambda telegram_id: next(
+            (n for n, t in user_names.items() if t == telegram_id), None
+        ),
+    )
+    monkeypatch.setattr(ud.utils, "write_user_to_db", write_user_to_db)
+    return user_names
+
+
+def test_user_directory_rejects_name_of_other_user(users):
+    directory = ud.UserDirectory()
+    assert not directory.set_name(2, "alex")
+    assert directory.set_name(2, "kim")
+    assert directory.get_id("kim") == 2
+    assert directory.get_name(2) == "kim"
+
+
+def test_user_directory_relies_on_db_constraint_for_stale_cache(users, monkeypatch):
+    directory = ud.UserDirectory()
+    assert directory.get_name(2) is None
+    # another process claims the name between our lookup and our write
+    monkeypatch.setattr(ud.utils, "load_user_id_by_name", lambda name: None)
+    users["sam"] = 3
+    assert not directory.set_name(2, "sam")
+    assert users["sam"] == 3
+    assert directory.stats["invalidations"] == 1
+    monkeypatch.setattr(ud.utils, "load_user_id_by_name", users.get)
+    assert directory.get_id("sam") == 3
+
+
+def test_user_directory_evicts_least_recently_used(users):
+    directory = ud.UserDirectory(max_size=1)
+    assert directory.get_name(1) == "alex"
+    assert directory.get_name(2) is None
+    assert len(directory) == 1
+    directory.invalidate(2)
+    assert len(directory) == 0
+
+
+class FakeListenConnection:
+    def __init__(self, connections, stopped):
+        self.connections = connections
+        self.stopped = stopped
+        self.autocommit = False
+        self.closed = False
+        connections.append(self)
+
+    def cursor(self):
+        if len(self.connections) == 3:
+            self.stopped.set()
+        raise psycopg2.OperationalError("server closed the connection unexpectedly")
+
+    def close(self):
+        self.closed = True
+
+
+def test_user_directory_listener_closes_connection_before_reconnecting(monkeypatch):
+    connections, stopped = [], threading.Event()
+    monkeypatch.setattr(ud, "LISTEN_RETRY_SECS", 0)
+    monkeypatch.setattr(
+        ud, "db_conn", lambda: FakeListenConnection(connections, stopped)
+    )
+    ud.listen_for_changes(ud.UserDirectory(max_size=10), stopped)
+    assert len(connections) == 3
+    assert all(conn.closed for conn in connections)
@@ -0,0 +1,301 @@
+"""
+Test functions for db helpers.
+"""
+import contextlib
+import pytest
+import psycopg2.pool
+import src.utils as ut
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+
+    def close(self):
+        self.closed = 1
+
+
+def test_utils_connection_pool_reuses_connections():
+    pool = ut.ConnectionPool(minconn=1, maxconn=2, connect=FakeConnection)
+    conn = pool.getconn()
+    pool.putconn(conn)
+    assert pool.getconn() is conn
+    assert pool.stats["checkouts"] == 2
+
+
+def test_utils_connection_pool_times_out_when_exhausted():
+    pool = ut.ConnectionPool(minconn=0, maxconn=1, timeout=0.01, connect=FakeConnection)
+    pool.getconn()
+    with pytest.raises(psycopg2.pool.PoolError):
+        pool.getconn()
+    assert pool.stats["timeouts"] == 1
+
+
+def test_utils_pool_totals_are_exported_as_counters():
+    rendered = ut.metrics.render()
+    assert "# TYPE aya_db_pool_wait_seconds_total counter" in rendered
+    assert "# TYPE aya_db_pool_timeouts_total counter" in rendered
+
+
+def test_utils_connection_pool_replaces_broken_connections():
+    pool = ut.ConnectionPool(minconn=1, maxconn=1, connect=FakeConnection)
+    conn = pool.getconn()
+    conn.closed = 2
+    pool.putconn(conn)
+    new_conn = pool.getconn()
+    assert new_conn is not conn
+    assert not new_conn.closed
+
+
+def test_utils_get_time_since_fasting_start_from_cache():
+    ut.set_fasting_state(
+        123456789, ut.datetime.now() - ut.timedelta(hours=16, minutes=5)
+    )
+    hours_as_float, hours_as_text = ut.get_time_since_fasting_start(123456789)
+    assert round(hours_as_float, 2) == 16.08
+    assert hours_as_text == "16 Stunden und 5 Minuten"
+
+
+def test_utils_get_time_since_fasting_start_when_not_fasting():
+    ut.set_fasting_state(123456789, None)
+    assert ut.get_time_since_fasting_start(123456789) == (None, None)
+
+
+class FakeCursor:
+    def __init__(self):
+        self.executed = []
+
+    def mogrify(self, sql, params):
+        return (sql % tuple(repr(p) for p in params)).encode("utf8")
+
+    def execute(self, sql):
+        self.executed.append(sql)
+
+
+class FakeDbConnection(FakeConnection):
+    def commit(self):
+        pass
+
+
+class FakeIndexCursor:
+    def __init__(self, found):
+        self.found = found
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def execute(self, sql, params):
+        assert params == ("prod",)
+
+    def fetchone(self):
+        return (self.found,)
+
+
+def test_utils_messages_are_saved_without_missing_dedup_index(monkeypatch):
+    monkeypatch.setattr(ut, "_MESSAGE_DEDUP", {})
+    monkeypatch.setattr(ut, "_WRITE_BUFFER", None)
+    monkeypatch.setenv("DB_PROD_LEVEL", "prod")
+    assert "ON CONFLICT" in ut.message_conflict_clause()
+    monkeypatch.setattr(ut, "db_cursor", lambda: FakeIndexCursor(False))
+    assert not ut.check_message_dedup()
+    assert ut.message_conflict_clause() == ""
+    session = ut.DbSession(FakeDbConnection(), FakeCursor())
+    monkeypatch.setattr(ut, "db_session", lambda: contextlib.nullcontext(session))
+    ut.write_msg_to_db(123456789, 987654321, "Hallo", "2022-04-18 13:49:08")
+    assert "INSERT INTO prod.aya_messages" in session._deferred[0]
+    assert "ON CONFLICT" not in session._deferred[0]
+
+
+def test_utils_numbered_placeholders():
+    sql = "insert into t (a, b) values (%s, %s)"
+    assert ut._numbered_placeholders(sql) == "insert into t (a, b) values ($1, $2)"
+
+
+def test_utils_db_session_prepares_once_and_batches_deferred_writes():
+    conn = FakeDbConnection()
+    session = ut.DbSession(conn, FakeCursor())
+    session.execute("write", "insert into t values (%s)", (1,), defer=True)
+    session.execute("read", "select a from t where a = %s", (1,))
+    assert session.round_trips == 1
+    assert session.cur.executed[0].count("PREPARE") == 2
+    session.commit()
+
+    session = ut.DbSession(conn, FakeCursor())
+    session.execute("write", "insert into t values (%s)", (2,))
+    assert "PREPARE" not in session.cur.executed[0]
+    assert session.statements == 1
+
+
+def test_utils_recent_writes_expire_after_window():
+    now = [0.0]
+    recent = ut.RecentWrites(window=5, clock=lambda: now[0])
+    recent.add(("prod", "fasting_sessions", 123456789))
+    now[0] = 4
+    assert ("prod", "fasting_sessions", 123456789) in recent
+    recent.add(("prod", "fasting_sessions", 987654321))
+    now[0] = 6
+    assert ("prod", "fasting_sessions", 123456789) not in recent
+    assert ("prod", "fasting_sessions", 987654321) in recent
+
+
+class FakeReplicaCursor(FakeCursor):
+    def __init__(self, lag):
+        super().__init__()
+        self.lag = lag
+
+    def execute(self, sql, params=None):
+        self.executed.append(sql)
+
+    def fetchone(self):
+        return (self.lag,)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class FakeReplicaConnection(FakeDbConnection):
+    lag = 0
+
+    def cursor(self):
+        return FakeReplicaCursor(self.lag)
+
+    def rollback(self):
+        pass
+
+
+@pytest.fixture
+def replica(monkeypatch):
+    FakeReplicaConnection.lag = 0
+    pool = ut.ConnectionPool(minconn=0, maxconn=1, connect=FakeReplicaConnection)
+    monkeypatch.setattr(ut, "DB_REPLICA", "postgres://replica/aya")
+    monkeypatch.setattr(ut, "get_replica_pool", lambda: pool)
+    monkeypatch.setattr(ut, "RECENT_WRITES", ut.RecentWrites(window=5))
+    monkeypatch.setattr(ut, "_REPLICA", {"lag": None, "checked": None, "failed": False})
+
+    @contextlib.contextmanager
+    def primary_session():
+        yield "primary"
+
+    monkeypatch.setattr(ut, "db_session", primary_session)
+    return FakeReplicaConnection
+
+
+def route(table, key=None):
+    with ut.read_session(table, key) as session:
+        return "primary" if session == "primary" else "replica"
+
+
+def test_utils_read_session_reads_own_writes_from_primary(replica):
+    assert route("fasting_sessions", 123456789) == "replica"
+    ut.mark_written("fasting_sessions", 123456789)
+    assert route("fasting_sessions", 123456789) == "primary"
+    assert route("fasting_sessions", 987654321) == "replica"
+    assert (
+        'aya_db_reads_total{route="primary",reason="read_your_writes"}'
+        in ut.metrics.render()
+    )
+
+
+def test_utils_read_session_skips_lagging_replica(replica, monkeypatch):
+    replica.lag = ut.DB_REPLICA_MAX_LAG_SECS + 1
+    monkeypatch.setattr(ut, "DB_REPLICA_CHECK_SECS", 0)
+    assert route("users") == "primary"
+    assert ut._REPLICA["lag"] == ut.DB_REPLICA_MAX_LAG_SECS + 1
+    replica.lag = 0
+    assert route("users") == "replica"
+
+
+class FakeSession:
+    def __init__(self, row):
+        self.row = row
+
+    def execute(self, name, sql, params=(), defer=False):
+        return self
+
+    def fetchone(self):
+        return self.row
+
+    def on_rollback(self, hook):
+        pass
+
+
+class FakeReadSession(FakeSession):
+    def __init__(self, row, replica):
+        super().__init__(row)
+        self.replica = replica
+
+    def fetchall(self):
+        return [self.row] if self.row else []
+
+
+def test_utils_fasting_state_read_from_replica_is_not_cached(monkeypatch):
+    cache = ut.FastingCache(max_size=10)
+    monkeypatch.setattr(ut, "get_fasting_cache", lambda: cache)
+    started_at = ut.datetime.now() - ut.timedelta(hours=2)
+    sessions = [
+        FakeReadSession((started_at,), replica=True),
+        FakeReadSession(None, replica=False),
+    ]
+
+    @contextlib.contextmanager
+    def read_session(table, key=None):
+        yield sessions.pop(0)
+
+    monkeypatch.setattr(ut, "read_session", read_session)
+    hours, _ = ut.get_time_since_fasting_start(123456789)
+    assert hours == pytest.approx(2, abs=0.01)
+    assert cache.get(123456789) is ut.MISSING
+    # read again, this time from the primary, which is cached
+    assert ut.get_time_since_fasting_start(123456789) == (None, None)
+    assert cache.get(123456789) is None
+
+
+def test_utils_start_fasting_session_keeps_open_session(monkeypatch):
+    started_at = ut.datetime(2022, 4, 18, 20)
+    rows = [(started_at,), None]
+
+    @contextlib.contextmanager
+    def session():
+        yield FakeSession(rows.pop(0))
+
+    monkeypatch.setattr(ut, "db_session", session)
+    ut.start_fasting_session(123456789, started_at)
+    assert ut.get_fasting_cache().get(123456789) == started_at
+    # a session is open already: the cached start is dropped, not overwritten
+    ut.start_fasting_session(123456789, ut.datetime(2022, 4, 18, 21))
+    assert ut.get_fasting_cache().get(123456789) is ut.MISSING
+
+
+def test_utils_update_transaction_calls_network_after_commit(monkeypatch):
+    events = []
+
+    @contextlib.contextmanager
+    def session():
+        try:
+            yield ut.DbSession(FakeDbConnection(), FakeCursor())
+            events.append("commit")
+        except Exception:
+            events.append("rollback")
+            raise
+
+    monkeypatch.setattr(ut, "db_session", session)
+    with ut.update_transaction():
+        ut.after_commit(lambda: events.append("send"))
+        events.append("write")
+    assert events == ["write", "commit", "send"]
+
+    events.clear()
+    with pytest.raises(RuntimeError):
+        with ut.update_transaction():
+            ut.after_commit(lambda: events.append("send"))
+            raise RuntimeError("not a db error")
+    assert events == ["rollback"]
+    # outside of an update, the action runs right away
+    ut.after_commit(lambda: events.append("send"))
+    assert events == ["rollback", "send"]
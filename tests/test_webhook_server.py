@@ -0,0 +1,66 @@
+"""
+Test functions for the webhook run mode, posting the listener fixtures to a local server.
+"""
+import json
+import threading
+import urllib.error
+import urllib.request
+import pytest
+import src.webhook_server as ws
+
+
+@pytest.fixture
+def webhook():
+    handled = []
+    workers = ws.UpdateWorkers(handle=handled.append, workers=2).start()
+    server = ws.create_server(
+        workers, host="127.0.0.1", port=0, path="/hook", secret="SECRET"
+    )
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", workers, handled
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def _post(url, body, secret="SECRET"):
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(body).encode("utf8"),
+        headers={"Content-Type": "application/json", ws.SECRET_HEADER: secret},
+    )
+    try:
+        return urllib.request.urlopen(request).status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def test_webhook_server_hands_updates_to_workers(
+    webhook, input_single_message, input_single_callback, input_single_pdf
+):
+    url, workers, handled = webhook
+    for update in [input_single_message, input_single_callback, input_single_pdf]:
+        assert _post(url + "/hook", update) == 200
+    workers.stop()
+    assert sorted(update["update_id"] for update in handled) == [
+        161176028,
+        161176348,
+        161176353,
+    ]
+
+
+def test_webhook_server_rejects_wrong_secret(webhook, input_single_message):
+    url, workers, handled = webhook
+    assert _post(url + "/hook", input_single_message, secret="WRONG") == 403
+    assert _post(url + "/other", input_single_message) == 404
+    workers.stop()
+    assert handled == []
+
+
+def test_webhook_server_rejects_bodies_that_are_no_update(webhook):
+    url, workers, handled = webhook
+    for body in [[], 1, "update", None]:
+        assert _post(url + "/hook", body) == 400
+    workers.stop()
+    assert handled == []
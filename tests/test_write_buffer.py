@@ -0,0 +1,151 @@
+"""
+Test functions for the write-behind buffer.
+"""
+import queue
+import threading
+
+import psycopg2
+import pytest
+
+import src.write_buffer as wb
+from src.bots import Bot
+
+
+def test_write_buffer_flush_writes_queued_rows(monkeypatch):
+    written = []
+    monkeypatch.setattr(wb, "_write_rows", written.extend)
+    buffer = wb.WriteBuffer(flush_rows=10, flush_secs=60, max_rows=10)
+    buffer.add(
+        "aya_events", (123456789, 123456789, "recipes", None, "2022-04-18 09:44:06")
+    )
+    buffer.add(
+        "aya_messages",
+        (
+            123456789,
+            123456789,
+            161176028,
+            "hi there",
+            None,
+            "2022-04-18 09:44:06",
+            "2022-04-18 09:44:06",
+        ),
+    )
+    assert buffer.depth == 2
+    buffer.flush()
+    assert [table for table, _ in written] == ["aya_events", "aya_messages"]
+    assert buffer.depth == 0
+    assert buffer.stats["rows_written"] == 2
+
+
+def test_write_buffer_keeps_rows_of_failed_flush(monkeypatch):
+    def fail(rows):
+        raise RuntimeError("db down")
+
+    monkeypatch.setattr(wb, "_write_rows", fail)
+    buffer = wb.WriteBuffer()
+    buffer.add(
+        "aya_events", (123456789, 123456789, "recipes", None, "2022-04-18 09:44:06")
+    )
+    buffer.flush()
+    assert buffer.depth == 1
+    written = []
+    monkeypatch.setattr(wb, "_write_rows", written.extend)
+    buffer.stop()
+    assert len(written) == 1
+
+
+def test_write_buffer_writes_rows_to_schema_of_bot(monkeypatch):
+    written = []
+    monkeypatch.setenv("DB_PROD_LEVEL", "prod")
+    monkeypatch.setattr(
+        wb, "_write_rows", lambda rows: written.append((wb.get_schema(), len(rows)))
+    )
+    buffer = wb.WriteBuffer()
+    buffer.add(
+        "aya_events", (123456789, 123456789, "recipes", None, "2022-04-18 09:44:06")
+    )
+    with wb.bot_context(Bot("aya_test", "test", "456:DEF")):
+        buffer.add(
+            "aya_events", (123456789, 123456789, "recipes", None, "2022-04-18 09:44:06")
+        )
+        buffer.add(
+            "aya_events", (987654321, 987654321, "recipes", None, "2022-04-18 09:44:06")
+        )
+    buffer.flush()
+    assert written == [("prod", 1), ("test", 2)]
+
+
+def _event(name):
+    return 123456789, 123456789, name, None, "2022-04-18 09:44:06"
+
+
+def test_write_buffer_drops_rows_rejected_by_db(monkeypatch):
+    written = []
+
+    def write_rows(rows):
+        if any(row[2] == "bad" for _, row in rows):
+            raise psycopg2.DataError("invalid input syntax")
+        written.extend(rows)
+
+    monkeypatch.setattr(wb, "_write_rows", write_rows)
+    buffer = wb.WriteBuffer()
+    for name in ["recipes", "bad", "recipes", "recipes", "recipes"]:
+        buffer.add("aya_events", _event(name))
+    buffer.flush()
+    assert len(written) == 4
+    assert buffer.depth == 0
+    assert buffer.stats["rows_dropped"] == 1
+
+
+def test_write_buffer_counts_failed_rows_against_max_rows(monkeypatch):
+    def fail(rows):
+        raise RuntimeError("db down")
+
+    monkeypatch.setattr(wb, "_write_rows", fail)
+    buffer = wb.WriteBuffer(max_rows=2)
+    buffer.add("aya_events", _event("recipes"))
+    buffer.add("aya_events", _event("recipes"))
+    buffer.flush()
+    adding = threading.Thread(target=buffer.add, args=("aya_events", _event("recipes")))
+    adding.start()
+    adding.join(0.1)
+    assert adding.is_alive()
+    # while the failed rows keep failing, no new rows are taken from the queue
+    buffer.flush()
+    assert len(buffer._retry) == 2
+    written = []
+    monkeypatch.setattr(wb, "_write_rows", written.extend)
+    buffer.flush()
+    adding.join(1)
+    assert not adding.is_alive()
+    buffer.flush()
+    assert len(written) == 3
+
+
+def test_write_buffer_add_times_out_inside_transaction(monkeypatch):
+    monkeypatch.setattr(wb.utils, "in_update_transaction", lambda: True)
+    buffer = wb.WriteBuffer(max_rows=1, add_timeout=0.05)
+    buffer.add("aya_events", _event("recipes"))
+    # a full buffer must not keep the update's connection checked out indefinitely
+    with pytest.raises(queue.Full):
+        buffer.add("aya_events", _event("recipes"))
+    assert buffer.stats["add_timeouts"] == 1
+    assert buffer.stats["rows_added"] == 1
+
+
+def test_write_buffer_counts_stats_from_many_threads(monkeypatch):
+    monkeypatch.setattr(wb, "_write_rows", lambda rows: None)
+    buffer = wb.WriteBuffer(max_rows=100000)
+
+    def add_rows():
+        for _ in range(1000):
+            buffer.add("aya_events", _event("recipes"))
+
+    adding = [threading.Thread(target=add_rows) for _ in range(8)]
+    for thread in adding:
+        thread.start()
+    for thread in adding:
+        thread.join()
+    buffer.flush()
+    assert buffer.stats["rows_added"] == 8000
+    assert buffer.stats["rows_written"] == 8000